@@ -1,40 +1,98 @@
-from flask import Flask, render_template, redirect, url_for, flash, request
+# Patch sockets, threads, time and subprocess first so every blocking call below yields to the
+# eventlet hub instead of stalling it: daemon requests, DB sockets and background tasks all go green.
+import eventlet
+eventlet.monkey_patch()
+
+from flask import Flask, render_template, redirect, url_for, flash, request, jsonify
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from flask_sqlalchemy import SQLAlchemy
-from flask_bcrypt import Bcrypt
-from models import db, User, Instance, Node, UserCredits
+from models import db, bcrypt, User, Instance, Node, UserCredits, engine_options, normalize_database_url
 import os
 from forms import RegistrationForm, LoginForm
-import subprocess
+from billing import bill_due_instances, BILLING_PERIOD
+import credits
+from migrations import upgrade_schema
+from plan_catalog import PlanCatalog
+from placement import PlacementScheduler
+from live_status import LiveStatusTable, follow_node_events
+from node_health import HealthChecker
+from rebalance import node_load, plan_moves
+from status_cache import StatusCache, MemoryBackend, RedisBackend
 import re
-import requests
+import node_client
+from node_client import get_client, sign_terminal_token
+from instrumentation import instrument_app, instrument_engine, submit_traced, timed, timed_job
+from user_cache import UserCache, CachedUser
+from sqlalchemy import event
+from eventlet import tpool
 import logging
-from flask_socketio import SocketIO, emit
-import eventlet
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from flask_socketio import SocketIO, join_room
 
 
 
 
 app = Flask(__name__)
 app.secret_key = 'your_secret_key'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///users.db'
+# Any SQLAlchemy URL, e.g. postgresql://panel:secret@db/panel; defaults to the bundled SQLite file
+app.config['SQLALCHEMY_DATABASE_URI'] = normalize_database_url(os.environ.get('DATABASE_URL', 'sqlite:///users.db'))
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(
+    app.config['SQLALCHEMY_DATABASE_URI'],
+    pool_size=int(os.environ.get('DATABASE_POOL_SIZE', 10)),
+    max_overflow=int(os.environ.get('DATABASE_MAX_OVERFLOW', 20)),
+)
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['NODE_CONNECT_TIMEOUT'] = 3
+app.config['NODE_READ_TIMEOUT'] = 30
+app.config['NODE_MAX_RETRIES'] = 2
+app.config['NODE_FAILURE_THRESHOLD'] = 5
+# Shared with every daemon: signs terminal tokens and authenticates the panel's (and other nodes') daemon calls
+app.config['NODE_SECRET'] = os.environ.get('NODE_SECRET', '')
+
+node_client.configure(connect_timeout=app.config['NODE_CONNECT_TIMEOUT'],
+                      read_timeout=app.config['NODE_READ_TIMEOUT'],
+                      max_retries=app.config['NODE_MAX_RETRIES'],
+                      failure_threshold=app.config['NODE_FAILURE_THRESHOLD'],
+                      node_secret=app.config['NODE_SECRET'])
+
+# bcrypt cost for new hashes; older hashes are upgraded the next time their owner logs in
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_ROUNDS', 12))
+app.config['USER_CACHE_TTL'] = int(os.environ.get('USER_CACHE_TTL', 60))  # Seconds another worker's user change can go unseen
 
 db.init_app(app)
-bcrypt = Bcrypt(app)
+bcrypt.init_app(app)
+
+# Request, SQL and daemon-call timing exported on /metrics; set SLOW_REQUEST_THRESHOLD (seconds)
+# to log slow requests with a breakdown of where their time went
+app.config['SLOW_REQUEST_THRESHOLD'] = float(os.environ.get('SLOW_REQUEST_THRESHOLD', 0))
+instrument_app(app, slow_request_threshold=app.config['SLOW_REQUEST_THRESHOLD'])
+with app.app_context():
+    instrument_engine(db.engine)
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 
-socketio = SocketIO(app, cors_allowed_origins='*')
+# With more than one worker process, Socket.IO emits must go through a shared queue such as Redis
+socketio = SocketIO(app, cors_allowed_origins='*', async_mode='eventlet',
+                    message_queue=os.environ.get('SOCKETIO_MESSAGE_QUEUE'))
+
+# psycopg2 talks to PostgreSQL from C; psycogreen makes it wait on the hub like any other socket
+if app.config['SQLALCHEMY_DATABASE_URI'].startswith('postgresql'):
+    try:
+        from psycogreen.eventlet import patch_psycopg
+        patch_psycopg()
+    except ImportError:
+        logging.warning("psycogreen is not installed; PostgreSQL queries will block the eventlet hub")
+
 
 
+plan_catalog = PlanCatalog(os.path.join(os.path.dirname(__file__), 'plans.json'))
 
-PLANS = {
-    'Basic': {'ram': '512MB', 'disk': '10GB'},
-    'Standard': {'ram': '1GB', 'disk': '20GB'},
-    'Premium': {'ram': '2GB', 'disk': '40GB'},
-    'Pro': {'ram': '4GB', 'disk': '80GB'},
-}
+# Automatic node placement for new instances
+app.config['PLACEMENT_POLICY'] = os.environ.get('PLACEMENT_POLICY', 'least-loaded')  # bin-pack, spread or least-loaded
+app.config['OVERCOMMIT_RATIO'] = float(os.environ.get('OVERCOMMIT_RATIO', 1.0))
+placement = PlacementScheduler(plan_catalog, policy=app.config['PLACEMENT_POLICY'],
+                               overcommit_ratio=app.config['OVERCOMMIT_RATIO'])
 
 def create_admin_account():
     with app.app_context():
@@ -47,37 +105,51 @@ def create_admin_account():
             db.session.commit()
 
 
-def add_credits(user_id, amount):
-    user_credits = UserCredits.query.filter_by(user_id=user_id).first()
-    if user_credits:
-        user_credits.balance += amount
-        db.session.commit()
+def add_credits(user_id, amount, reason='purchase', reference=None):
+    if not credits.post(user_id, amount, reason, reference):
+        return False
 
-        # Unsuspend instances if user now has enough credits
-        instances = Instance.query.filter_by(user_id=user_id, suspended=True).all()
-        for instance in instances:
-            plans = load_plans()
-            plan_details = next((plan for plan in plans if plan['name'] == instance.plan), None)
-            if plan_details and user_credits.balance >= plan_details['cost']:
-                instance.suspended = False  # Unsuspend the instance
-                db.session.commit()
+    # Unsuspend instances the new balance covers, in the same commit as the credit
+    balance = credits.current_balance(user_id)
+    for instance in Instance.query.filter_by(user_id=user_id, suspended=True):
+        plan_details = plan_catalog.get(instance.plan)
+        if plan_details and balance >= plan_details['cost']:
+            instance.suspended = False
+    db.session.commit()
+    return True
 
-        return True
-    return False
-
-def deduct_credits(user_id, amount):
-    user_credits = UserCredits.query.filter_by(user_id=user_id).first()
-    if user_credits and user_credits.balance >= amount:
-        user_credits.balance -= amount
+def deduct_credits(user_id, amount, reason='instance_create', reference=None):
+    # Atomic: the balance check and the charge are one conditional UPDATE
+    if credits.post(user_id, -amount, reason, reference):
         db.session.commit()
         return True
     return False
 
 
 
+def hash_password(password):
+    # bcrypt releases the GIL, so hashing on a real OS thread keeps every other greenlet running
+    return tpool.execute(bcrypt.generate_password_hash, password).decode('utf-8')
+
+def verify_password(user, password):
+    return tpool.execute(bcrypt.check_password_hash, user.password, password)
+
+
+def load_cached_user(user_id):
+    user = User.query.get(user_id)
+    return CachedUser(user.id, user.username, user.is_admin) if user else None
+
+user_cache = UserCache(load_cached_user, ttl=app.config['USER_CACHE_TTL'])
+
+# Any change to a user row (admin flag, password, ...) drops this process's cached copy
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def invalidate_cached_user(mapper, connection, target):
+    user_cache.invalidate(target.id)
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return user_cache.get(int(user_id))
 
 @app.route('/')
 def index():
@@ -96,16 +168,14 @@ def register():
             return redirect(url_for('register'))
         
         # Create new user and set password
-        new_user = User(username=username)
-        new_user.set_password(password)
+        new_user = User(username=username, password=hash_password(password))
         
         # Add the user to the database
         db.session.add(new_user)
-        db.session.commit()
+        db.session.flush()
 
-        # Create a new UserCredits entry with a starting balance of 5000
-        user_credits = UserCredits(user_id=new_user.id, balance=5000)
-        db.session.add(user_credits)
+        # Open their credit account with a starting balance of 5000
+        credits.open_account(new_user.id, 5000)
         db.session.commit()
         
         flash('Your account has been created! You can now log in.', 'success')
@@ -119,7 +189,13 @@ def login():
     form = LoginForm()
     if form.validate_on_submit():
         user = User.query.filter_by(username=form.username.data).first()
-        if user and user.check_password(form.password.data):  # Check hashed password
+        with timed('password_hash'):
+            password_ok = user is not None and verify_password(user, form.password.data)
+        if password_ok:  # Check hashed password
+            if user.password_rounds() != app.config['BCRYPT_LOG_ROUNDS']:
+                with timed('password_hash'):
+                    user.password = hash_password(form.password.data)  # Upgrade to the configured cost
+                db.session.commit()
             login_user(user)
             return redirect(url_for('manage_instances'))
         flash('Login unsuccessful. Please check username and password.', 'danger')
@@ -135,44 +211,20 @@ def logout():
 @app.route('/plans', methods=['GET'])
 @login_required
 def view_plans():
-    plans = load_plans()  # Fetch plans from the JSON file
+    plans = plan_catalog.all()
     return render_template('view_plans.html', plans=plans)
 
 
 from apscheduler.schedulers.background import BackgroundScheduler
 from datetime import datetime, timedelta
-import subprocess
 import json
 
 
 
 
 def monthly_billing_job():
-    with app.app_context():
-        instances = Instance.query.all()
-        for instance in instances:
-            if instance.last_billed_date:
-                days_since_last_billing = (datetime.utcnow() - instance.last_billed_date).days
-                if days_since_last_billing >= 30:
-                    # Get plan details from plans.json
-                    plans = load_plans()
-                    plan_details = next((plan for plan in plans if plan['name'] == instance.plan), None)
-
-                    if plan_details:
-                        cost = plan_details['cost']
-                        
-                        # Deduct credits for the monthly cost
-                        if deduct_credits(instance.user_id, cost):
-                            instance.last_billed_date = datetime.utcnow()
-                            instance.suspended = False  # Ensure it's active if they can pay
-                            db.session.commit()
-                        else:
-                            # Suspend the instance if there aren't enough credits
-                            instance.suspended = True
-                            db.session.commit()
-                            flash(f'Instance {instance.name} suspended due to insufficient credits.', 'warning')
-                    else:
-                        flash(f'Plan {instance.plan} not found for billing instance {instance.name}.', 'danger')
+    with timed_job('monthly_billing'), app.app_context():
+        bill_due_instances(plan_catalog)
 
 
 
@@ -186,32 +238,79 @@ import atexit
 atexit.register(lambda: scheduler.shutdown())
 
 
+# Live container states pushed by each node's /events stream
+NODE_WATCH_INTERVAL = 30  # Seconds between checks for added, removed or toggled nodes
+live_statuses = LiveStatusTable()
+watched_nodes = set()  # IPs with a running event stream
+instance_owners = {}  # Instance name -> user id, so events can be routed to the owner's room
+
+
+def instance_owner(name):
+    user_id = instance_owners.get(name)
+    if user_id is None:
+        with app.app_context():
+            instance = Instance.query.filter_by(name=name).first()
+            user_id = instance.user_id if instance else None
+        if user_id is not None:
+            instance_owners[name] = user_id
+    return user_id
+
+
+def instance_moved_away(ip_address, name):
+    """True if the instance lives on another node now, e.g. its old node deleting it after a migration."""
+    with app.app_context():
+        instance = Instance.query.filter_by(name=name).first()
+        return instance is not None and instance.node.ip_address != ip_address
+
+
+def push_instance_status(ip_address, event):
+    if event['state'] == 'DELETED':
+        status_cache.invalidate(ip_address, event['name'])
+        if instance_moved_away(ip_address, event['name']):
+            return
+    else:
+        status_cache.set(ip_address, event['name'], event['state'])
+    user_id = instance_owner(event['name'])
+    if user_id is not None:
+        socketio.emit('instance_status', {'name': event['name'], 'state': event['state']}, room=f'user_{user_id}')
+    if event['state'] == 'DELETED':
+        instance_owners.pop(event['name'], None)
+
+
+def watch_node_events():
+    """Keep one event stream open per active node, starting and stopping them as nodes change."""
+    while True:
+        try:
+            with app.app_context():
+                active = {node.ip_address for node in Node.query.filter_by(is_active=True)}
+            watched_nodes.intersection_update(active)  # Streams of removed nodes stop on their next line
+            for ip_address in active - watched_nodes:
+                watched_nodes.add(ip_address)
+                socketio.start_background_task(follow_node_events, ip_address, live_statuses, push_instance_status,
+                                               lambda ip_address=ip_address: ip_address in watched_nodes,
+                                               socketio.sleep)
+        except Exception as e:
+            logging.error(f"Error updating node event streams: {str(e)}")
+        socketio.sleep(NODE_WATCH_INTERVAL)
+
 
 
-# Load plans from JSON file
-def load_plans():
-    plans_file_path = os.path.join(os.path.dirname(__file__), 'plans.json')
-    with open(plans_file_path) as plans_file:
-        plans = json.load(plans_file)
-    return plans
 
 @app.route('/create', methods=['GET', 'POST'])
 @login_required
 def create_instance():
-    nodes = Node.query.all()  # Fetch nodes for selection
-    plans = load_plans()  # Load plans from JSON
+    plans = plan_catalog.all()
 
     if request.method == 'POST':
         instance_name = request.form['name']
         selected_plan = request.form['plan']
-        selected_node_id = request.form['node']  # Get selected node
-        
+
         # Validate instance name and find the selected plan
         if not re.match("^[a-zA-Z0-9_-]*$", instance_name):
             flash('Invalid instance name. Only alphanumeric characters, dashes, and underscores are allowed.', 'danger')
             return redirect(url_for('create_instance'))
 
-        plan_details = next((plan for plan in plans if plan['name'] == selected_plan), None)
+        plan_details = plan_catalog.get(selected_plan)
         if not plan_details:
             flash('Selected plan is invalid.', 'danger')
             return redirect(url_for('create_instance'))
@@ -220,51 +319,147 @@ def create_instance():
         disk = plan_details['disk']
         cost = plan_details['cost']
 
-        # Check if the user has enough credits
-        if not deduct_credits(current_user.id, cost):
-            flash('You do not have enough credits to create this instance.', 'danger')
+        if Instance.query.filter_by(name=instance_name).first():
+            flash('An instance with that name already exists. Please choose a different one.', 'danger')
+            return redirect(url_for('create_instance'))
+
+        nodes = [node for node in Node.query.filter_by(is_active=True) if node_health.is_available(node.id)]
+        selected_node = placement.place(selected_plan, nodes)
+        if not selected_node:
+            flash('No node currently has room for this plan. Please try again later.', 'danger')
             return redirect(url_for('create_instance'))
 
-        selected_node = Node.query.get(selected_node_id)
-        if not selected_node.is_active:
-            flash(f'The selected node ({selected_node.name}) is not active. Please choose another node.', 'danger')
+        # Check if the user has enough credits
+        if not deduct_credits(current_user.id, cost, reference=instance_name):
+            placement.release(selected_node.id, selected_plan)
+            flash('You do not have enough credits to create this instance.', 'danger')
             return redirect(url_for('create_instance'))
 
         # Create the container and attempt to add the instance to the database
         instance_created = False
         try:
-            url = f'http://{selected_node.ip_address}:8080/create'
-            response = requests.post(url, json={'name': instance_name, 'ram': ram, 'disk': disk, 'node': selected_node.name})
+            response = get_client(selected_node.ip_address).post(
+                '/create', json={'name': instance_name, 'ram': ram, 'disk': disk, 'node': selected_node.name,
+                                 'ram_bytes': plan_details['ram_bytes'], 'disk_bytes': plan_details['disk_bytes'],
+                                 'idle_policy': plan_details.get('idle_policy'), 'limits': plan_details['limits']})
 
-            if response.status_code == 201:
+            if response.status_code == 202:
                 instance_created = True
-                flash(f'Container {instance_name} created successfully!', 'success')
+                job_id = response.json().get('job_id')
+                socketio.start_background_task(track_provisioning_job, current_user.id,
+                                               selected_node.ip_address, job_id, instance_name)
+                flash(f'Container {instance_name} is being created. You can follow its progress below.', 'success')
             else:
                 flash(f'Failed to create the container: {response.json().get("message")}', 'danger')
 
         except Exception as e:
             flash(f'Error connecting to the daemon: {str(e)}', 'danger')
 
-        # Regardless of success, add the instance to the database with relevant details
+        if not instance_created:
+            # Nothing was built, so hand back the credits and the room reserved on the node
+            add_credits(current_user.id, cost, reason='refund', reference=instance_name)
+            placement.release(selected_node.id, selected_plan)
+            return redirect(url_for('create_instance'))
+
         new_instance = Instance(
             name=instance_name,
             user_id=current_user.id,
             plan=selected_plan,
-            node_id=selected_node_id,
+            node_id=selected_node.id,
             creation_date=datetime.utcnow(),
             last_billed_date=datetime.utcnow(),  # Initialize with creation date
+            next_billing_date=datetime.utcnow() + BILLING_PERIOD,
         )
         db.session.add(new_instance)
         db.session.commit()
 
         return redirect(url_for('manage_instances'))
 
-    return render_template('create_instance.html', plans=plans, nodes=nodes)
+    return render_template('create_instance.html', plans=plans)
+
+
+
 
 
 
+STATUS_TIMEOUT = 3  # Seconds to wait on a single node before giving up on its statuses
+PROVISION_TIMEOUT = 1800  # Stop following a provisioning job after this many seconds
+JOB_POLL_INTERVAL = 2  # Seconds between provisioning progress checks
 
 
+def track_provisioning_job(user_id, ip_address, job_id, instance_name):
+    """Follow a provisioning job on its node and push progress to the owner's Socket.IO room."""
+    deadline = time.monotonic() + PROVISION_TIMEOUT
+    last_update = None
+    while time.monotonic() < deadline:
+        try:
+            response = get_client(ip_address).get(f'/jobs/{job_id}', timeout=STATUS_TIMEOUT)
+            if response.status_code == 200:
+                job = response.json()['job']
+                update = {'name': instance_name, 'state': job['state'],
+                          'progress': job['progress'], 'message': job['message']}
+                if update != last_update:
+                    socketio.emit('provisioning_progress', update, room=f'user_{user_id}')
+                    last_update = update
+                if job['state'] in ('succeeded', 'failed'):
+                    return
+            elif response.status_code == 404:
+                logging.error(f"Provisioning job {job_id} for {instance_name} is unknown to {ip_address}")
+                return
+        except Exception as e:
+            logging.error(f"Failed to fetch provisioning job {job_id} from {ip_address}: {str(e)}")
+        socketio.sleep(JOB_POLL_INTERVAL)
+    logging.error(f"Gave up following provisioning job {job_id} for {instance_name}")
+
+
+def fetch_node_statuses(ip_address, names):
+    """Fetch the statuses of several containers from one node daemon in a single request."""
+    try:
+        response = get_client(ip_address).get('/status', params={'names': ','.join(names)},
+                                              timeout=STATUS_TIMEOUT)
+        if response.status_code == 200:
+            return response.json().get('instance_statuses', {})
+        logging.error(f"Failed to fetch statuses from {ip_address}: HTTP {response.status_code}")
+    except Exception as e:
+        logging.error(f"Failed to fetch statuses from {ip_address}: {str(e)}")
+    return {}
+
+
+# Background /health probes; unhealthy nodes get no new instances and no status requests
+app.config['NODE_HEALTH_INTERVAL'] = int(os.environ.get('NODE_HEALTH_INTERVAL', 10))  # Seconds between probe rounds
+app.config['NODE_HEALTH_FAILURES'] = 3  # Failed probes in a row before a node leaves the rotation
+app.config['NODE_HEALTH_RECOVERIES'] = 2  # Passed probes in a row before it comes back
+
+
+def active_nodes():
+    with app.app_context():
+        return [(node.id, node.ip_address) for node in Node.query.filter_by(is_active=True)]
+
+
+node_health = HealthChecker(
+    active_nodes,
+    on_report=lambda node_id, report: placement.update_live(node_id, report['ram_free']),
+    interval=app.config['NODE_HEALTH_INTERVAL'],
+    failure_threshold=app.config['NODE_HEALTH_FAILURES'],
+    recovery_threshold=app.config['NODE_HEALTH_RECOVERIES'],
+    sleep=socketio.sleep,
+)
+
+
+# Statuses fetched from daemons, shared by page views; optionally in Redis to share across workers
+app.config['STATUS_CACHE_TTL'] = 5  # Seconds a status is served without refreshing
+app.config['STATUS_CACHE_STALE_TTL'] = 60  # Seconds a stale status is still served while it refreshes
+app.config['STATUS_CACHE_SIZE'] = 10000  # Entries kept by the in-process LRU
+app.config['STATUS_CACHE_REDIS_URL'] = os.environ.get('STATUS_CACHE_REDIS_URL')
+status_cache = StatusCache(
+    fetch_node_statuses,
+    backend=(RedisBackend(app.config['STATUS_CACHE_REDIS_URL']) if app.config['STATUS_CACHE_REDIS_URL']
+             else MemoryBackend(max_size=app.config['STATUS_CACHE_SIZE'])),
+    ttl=app.config['STATUS_CACHE_TTL'],
+    stale_ttl=app.config['STATUS_CACHE_STALE_TTL'],
+    spawn=socketio.start_background_task,
+)
+
 
 @app.route('/manage')
 @login_required
@@ -276,18 +471,30 @@ def manage_instances():
     user_credits = UserCredits.query.filter_by(user_id=current_user.id).first()
     balance = user_credits.balance if user_credits else 0  # Default balance if no entry found
 
-    # Fetch statuses for each instance
+    # States pushed by the node daemons need no round trip; only ask nodes about the rest
+    statuses = live_statuses.get_many([instance.name for instance in instances])
+
+    # Group instances by node so each node's cache entries are looked up (and fetched) together
+    instances_by_node = {}
     for instance in instances:
-        # Fetch the status using the API endpoint
-        try:
-            status_response = requests.get(f'http://45.137.70.53:8080/status?name={instance.name}')
-            if status_response.status_code == 200:
-                instance.status = status_response.json().get('instance_status', 'UNKNOWN')
-            else:
-                instance.status = 'UNKNOWN'
-        except Exception as e:
-            logging.error(f"Failed to fetch status for {instance.name}: {str(e)}")
-            instance.status = 'UNKNOWN'  # Fallback status
+        if instance.name in statuses:
+            continue
+        if not node_health.is_available(instance.node_id):
+            statuses[instance.name] = 'UNREACHABLE'  # Don't wait on a node the health checker gave up on
+            continue
+        instances_by_node.setdefault(instance.node, []).append(instance)
+
+    if instances_by_node:
+        with ThreadPoolExecutor(max_workers=len(instances_by_node)) as executor:
+            futures = {
+                submit_traced(executor, status_cache.get_many, node.ip_address, [i.name for i in node_instances]): node
+                for node, node_instances in instances_by_node.items()
+            }
+            for future in as_completed(futures):
+                statuses.update(future.result())
+
+    for instance in instances:
+        instance.status = statuses.get(instance.name, 'UNKNOWN')
 
     # Render the manage instances template, passing instances and balance
     return render_template('manage_instances.html', instances=instances, balance=balance)
@@ -299,13 +506,21 @@ def manage_instances():
 @login_required
 def start_instance(name):
     instance = Instance.query.filter_by(name=name, user_id=current_user.id).first()
+    if not instance:
+        flash('Instance not found or you do not have access to it.', 'danger')
+        return redirect(url_for('manage_instances'))
+
+    if instance.migrating:
+        flash(f'Instance {name} is being moved to another node. Please try again shortly.', 'danger')
+        return redirect(url_for('manage_instances'))
 
     if instance.suspended:
         flash(f'Instance {name} is suspended. Please top up your credits to unsuspend it.', 'danger')
         return redirect(url_for('manage_instances'))
 
     try:
-        response = requests.post('http://45.137.70.53:8080/start', json={'name': name})
+        response = get_client(instance.node.ip_address).post('/start', json={'name': name})
+        status_cache.invalidate(instance.node.ip_address, name)
         if response.status_code == 200:
             flash(f'Instance {name} started successfully!', 'success')
         else:
@@ -319,8 +534,18 @@ def start_instance(name):
 @app.route('/stop/<name>')
 @login_required
 def stop_instance(name):
+    instance = Instance.query.filter_by(name=name, user_id=current_user.id).first()
+    if not instance:
+        flash('Instance not found or you do not have access to it.', 'danger')
+        return redirect(url_for('manage_instances'))
+
+    if instance.migrating:
+        flash(f'Instance {name} is being moved to another node. Please try again shortly.', 'danger')
+        return redirect(url_for('manage_instances'))
+
     try:
-        response = requests.post('http://45.137.70.53:8080/stop', json={'name': name})
+        response = get_client(instance.node.ip_address).post('/stop', json={'name': name})
+        status_cache.invalidate(instance.node.ip_address, name)
         if response.status_code == 200:
             flash(f'Instance {name} stopped successfully!', 'success')
         else:
@@ -333,9 +558,21 @@ def stop_instance(name):
 @app.route('/delete/<name>')
 @login_required
 def delete_instance(name):
+    instance = Instance.query.filter_by(name=name, user_id=current_user.id).first()
+    if not instance:
+        flash('Instance not found or you do not have access to it.', 'danger')
+        return redirect(url_for('manage_instances'))
+
+    if instance.migrating:
+        flash(f'Instance {name} is being moved to another node. Please try again shortly.', 'danger')
+        return redirect(url_for('manage_instances'))
+
     try:
-        response = requests.post('http://localhost:8080/delete', json={'name': name})
+        response = get_client(instance.node.ip_address).post('/delete', json={'name': name})
         if response.status_code == 200:
+            db.session.delete(instance)
+            db.session.commit()
+            placement.release(instance.node_id, instance.plan)
             flash(f'Instance {name} deleted successfully!', 'success')
         else:
             flash('Failed to delete the container: ' + response.json().get('message'), 'danger')
@@ -346,6 +583,379 @@ def delete_instance(name):
 
 
 
+@app.route('/plan/<name>', methods=['GET', 'POST'])
+@login_required
+def change_plan(name):
+    """Move an instance to another plan. Its limits change in place, without a restart."""
+    instance = Instance.query.filter_by(name=name, user_id=current_user.id).first()
+    if not instance:
+        flash('Instance not found or you do not have access to it.', 'danger')
+        return redirect(url_for('manage_instances'))
+
+    if request.method == 'GET':
+        return render_template('change_plan.html', instance=instance, plans=plan_catalog.all())
+
+    if instance.migrating:
+        flash(f'Instance {name} is being moved to another node. Please try again shortly.', 'danger')
+        return redirect(url_for('manage_instances'))
+
+    old_plan = plan_catalog.get(instance.plan)
+    new_plan = plan_catalog.get(request.form.get('plan'))
+    if not new_plan or new_plan['name'] == instance.plan:
+        flash('Please choose a different plan.', 'danger')
+        return redirect(url_for('change_plan', name=name))
+
+    if not placement.resize(instance.node, instance.plan, new_plan['name']):
+        flash(f'The node {name} runs on has no room for the {new_plan["name"]} plan. Please contact support.', 'danger')
+        return redirect(url_for('change_plan', name=name))
+
+    # Upgrades pay the difference for the current period up front; downgrades take effect at the next bill
+    difference = new_plan['cost'] - (old_plan['cost'] if old_plan else 0)
+    if difference > 0 and not deduct_credits(current_user.id, difference, reason='plan_change', reference=name):
+        placement.resize(instance.node, new_plan['name'], instance.plan)
+        flash(f'You need {difference} more credits to move to the {new_plan["name"]} plan.', 'danger')
+        return redirect(url_for('change_plan', name=name))
+
+    try:
+        response = get_client(instance.node.ip_address).post('/limits', json={'name': name, 'limits': new_plan['limits'],
+                                                                              'idle_policy': new_plan.get('idle_policy')})
+        data = response.json()
+    except Exception as e:
+        response, data = None, {'message': f'Error connecting to the daemon: {str(e)}'}
+    if response is None or response.status_code != 200:
+        if difference > 0:
+            add_credits(current_user.id, difference, reason='refund', reference=name)
+        placement.resize(instance.node, new_plan['name'], instance.plan)
+        flash('Failed to change the plan: ' + str(data.get('message')), 'danger')
+        return redirect(url_for('manage_instances'))
+
+    instance.plan = new_plan['name']
+    db.session.commit()
+    if data.get('warnings'):
+        logging.warning(f"Plan change of {name} partly deferred to its next start: {', '.join(data['warnings'])}")
+    flash(f'Instance {name} is now on the {new_plan["name"]} plan.', 'success')
+    return redirect(url_for('manage_instances'))
+
+
+@app.route('/backups/<name>', methods=['GET', 'POST'])
+@login_required
+def instance_backups(name):
+    """List an instance's backups, or take a new one."""
+    instance = Instance.query.filter_by(name=name, user_id=current_user.id).first()
+    if not instance:
+        flash('Instance not found or you do not have access to it.', 'danger')
+        return redirect(url_for('manage_instances'))
+
+    client = get_client(instance.node.ip_address)
+    if request.method == 'POST':
+        if instance.migrating:
+            flash(f'Instance {name} is being moved to another node. Please try again shortly.', 'danger')
+            return redirect(url_for('instance_backups', name=name))
+        try:
+            response = client.post('/backups', json={'name': name})
+            if response.status_code == 202:
+                flash(f'Backup of {name} started. It will appear below once it finishes.', 'success')
+            else:
+                flash('Failed to start the backup: ' + response.json().get('message'), 'danger')
+        except Exception as e:
+            flash('Error connecting to the daemon: ' + str(e), 'danger')
+        return redirect(url_for('instance_backups', name=name))
+
+    backups = []
+    try:
+        response = client.get(f'/backups/{name}', timeout=STATUS_TIMEOUT)
+        if response.status_code == 200:
+            backups = sorted(response.json()['backups'], key=lambda backup: backup['id'], reverse=True)
+            for backup in backups:
+                backup['created_at'] = datetime.utcfromtimestamp(backup['created_at'])
+        else:
+            flash('Failed to list backups: ' + response.json().get('message'), 'danger')
+    except Exception as e:
+        flash('Error connecting to the daemon: ' + str(e), 'danger')
+    return render_template('backups.html', instance=instance, backups=backups)
+
+
+@app.route('/backups/<name>/restore/<backup_id>', methods=['POST'])
+@login_required
+def restore_instance_backup(name, backup_id):
+    instance = Instance.query.filter_by(name=name, user_id=current_user.id).first()
+    if not instance:
+        flash('Instance not found or you do not have access to it.', 'danger')
+        return redirect(url_for('manage_instances'))
+
+    if instance.migrating:
+        flash(f'Instance {name} is being moved to another node. Please try again shortly.', 'danger')
+        return redirect(url_for('instance_backups', name=name))
+
+    try:
+        response = get_client(instance.node.ip_address).post(f'/backups/{name}/{backup_id}/restore')
+        status_cache.invalidate(instance.node.ip_address, name)
+        if response.status_code == 202:
+            flash(f'Restoring {name} from {backup_id}. It is stopped until the restore finishes.', 'success')
+        else:
+            flash('Failed to start the restore: ' + response.json().get('message'), 'danger')
+    except Exception as e:
+        flash('Error connecting to the daemon: ' + str(e), 'danger')
+    return redirect(url_for('instance_backups', name=name))
+
+
+
+@app.route('/usage/<name>')
+@login_required
+def instance_usage(name):
+    """Usage samples for one of the user's instances, for drawing graphs."""
+    instance = Instance.query.filter_by(name=name, user_id=current_user.id).first()
+    if not instance:
+        return jsonify({'status': 'error', 'message': 'Instance not found.'}), 404
+
+    resolution = request.args.get('resolution', 'raw')
+    try:
+        response = get_client(instance.node.ip_address).get(
+            '/metrics/containers', params={'names': name, 'resolution': resolution}, timeout=STATUS_TIMEOUT)
+        data = response.json()
+    except Exception as e:
+        logging.error(f"Failed to fetch usage for {name}: {str(e)}")
+        return jsonify({'status': 'error', 'message': 'Could not reach the node.'}), 502
+    if response.status_code != 200:
+        return jsonify(data), response.status_code
+    return jsonify({'status': 'success', 'fields': data['fields'], 'usage': data['metrics'].get(name)})
+
+
+@app.route('/admin/nodes/<int:id>/usage')
+@login_required
+def node_usage(id):
+    """Latest usage of every container on a node, busiest first, to spot noisy neighbors."""
+    if not current_user.is_admin:
+        return redirect(url_for('index'))
+
+    node = Node.query.get_or_404(id)
+    containers = []
+    try:
+        response = get_client(node.ip_address).get('/metrics/containers', timeout=STATUS_TIMEOUT)
+        data = response.json()
+        for name, usage in data.get('metrics', {}).items():
+            if usage['latest']:
+                containers.append(dict(zip(data['fields'], usage['latest']), name=name))
+    except Exception as e:
+        flash(f'Error connecting to the daemon: {str(e)}', 'danger')
+
+    containers.sort(key=lambda container: container['cpu_percent'], reverse=True)
+    return render_template('admin/node_usage.html', node=node, containers=containers)
+
+
+MIGRATION_TIMEOUT = 6 * 3600  # Stop following a migration job after this many seconds
+
+
+def start_migration(instance, target_node, live=False):
+    """Ask the instance's node to push it to `target_node`. Returns (success, message)."""
+    if instance.migrating:
+        return False, f'{instance.name} is already being migrated.'
+    if target_node.id == instance.node_id:
+        return False, f'{instance.name} is already on {target_node.name}.'
+    if not target_node.is_active:
+        return False, f'{target_node.name} is not accepting instances.'
+    source_ip = instance.node.ip_address
+    try:
+        response = get_client(source_ip).post('/migrate', json={'name': instance.name, 'target': target_node.ip_address,
+                                                                'live': live})
+        if response.status_code != 202:
+            return False, response.json().get('message')
+    except Exception as e:
+        return False, f'Error connecting to the daemon: {str(e)}'
+
+    instance.migrating = True
+    db.session.commit()
+    socketio.start_background_task(track_migration_job, instance.id, instance.node_id, target_node.id, source_ip,
+                                   response.json()['job_id'])
+    return True, f'Moving {instance.name} to {target_node.name}.'
+
+
+def track_migration_job(instance_id, source_id, target_id, source_ip, job_id):
+    """Follow a migration on the source node, then point the instance at the target and clean up the source."""
+    deadline = time.monotonic() + MIGRATION_TIMEOUT
+    state = None
+    while time.monotonic() < deadline:
+        try:
+            response = get_client(source_ip).get(f'/jobs/{job_id}', timeout=STATUS_TIMEOUT)
+            if response.status_code == 200:
+                job = response.json()['job']
+                state = job['state']
+                if state == 'failed':
+                    logging.error(f"Migration job {job_id} failed: {job['message']}")
+                if state in ('succeeded', 'failed'):
+                    break
+            elif response.status_code == 404:
+                logging.error(f"Migration job {job_id} is unknown to {source_ip}")
+                break
+        except Exception as e:
+            logging.error(f"Failed to fetch migration job {job_id} from {source_ip}: {str(e)}")
+        socketio.sleep(JOB_POLL_INTERVAL)
+
+    with app.app_context():
+        if state != 'succeeded':
+            Instance.query.filter_by(id=instance_id).update({Instance.migrating: False}, synchronize_session=False)
+            db.session.commit()
+            return
+        # Only move the instance if nothing else did meanwhile; the update and the flag change commit together
+        moved = Instance.query.filter_by(id=instance_id, node_id=source_id).update(
+            {Instance.node_id: target_id, Instance.migrating: False}, synchronize_session=False)
+        db.session.commit()
+        instance = Instance.query.get(instance_id)
+        name, plan = instance.name, instance.plan
+    if not moved:
+        logging.error(f"Instance {name} changed node during its migration, leaving the copy on {source_ip}")
+        return
+
+    placement.release(source_id, plan)
+    placement.reserve(target_id, plan)
+    status_cache.invalidate(source_ip, name)
+    try:
+        response = get_client(source_ip).post('/delete', json={'name': name})
+        if response.status_code != 200:
+            logging.error(f"Failed to remove migrated container {name} from {source_ip}: {response.json().get('message')}")
+    except Exception as e:
+        logging.error(f"Failed to remove migrated container {name} from {source_ip}: {str(e)}")
+    logging.info(f"Instance {name} migrated from node {source_id} to node {target_id}")
+
+
+def rebalance_candidates():
+    """Current load of every active, healthy node and the moves that would even it out."""
+    nodes = [node for node in Node.query.filter_by(is_active=True) if node_health.is_available(node.id)]
+    instances = Instance.query.filter(Instance.node_id.in_([node.id for node in nodes]),
+                                      Instance.migrating.isnot(True)).all()
+    committed = {}
+    sized = []
+    for instance in instances:
+        plan_details = plan_catalog.get(instance.plan)
+        ram = plan_details['ram_bytes'] if plan_details else 0
+        committed[instance.node_id] = committed.get(instance.node_id, 0) + ram
+        sized.append((instance, instance.node_id, ram))
+
+    loads = {}
+    for node in nodes:
+        health = node_health.get(node.id)
+        loads[node.id] = (node_load(node.ram_capacity, committed.get(node.id, 0), health and health['report']),
+                          node.ram_capacity)
+    nodes_by_id = {node.id: node for node in nodes}
+    moves = [(instance, nodes_by_id[source], nodes_by_id[target]) for instance, source, target in plan_moves(loads, sized)]
+    return nodes, loads, moves
+
+
+@app.route('/admin/rebalance', methods=['GET', 'POST'])
+@login_required
+def rebalance_nodes():
+    """Show per-node load and proposed moves; POST starts all of them."""
+    if not current_user.is_admin:
+        return redirect(url_for('index'))
+
+    nodes, loads, moves = rebalance_candidates()
+    if request.method == 'POST':
+        for instance, _, target in moves:
+            success, message = start_migration(instance, target, live=bool(request.form.get('live')))
+            flash(message, 'success' if success else 'danger')
+        if not moves:
+            flash('Nodes are already balanced.', 'success')
+        return redirect(url_for('rebalance_nodes'))
+
+    return render_template('admin/rebalance.html', nodes=nodes, loads=loads, moves=moves,
+                           migrating=Instance.query.filter_by(migrating=True).all())
+
+
+@app.route('/admin/instances/<int:id>/migrate', methods=['POST'])
+@login_required
+def migrate_instance(id):
+    if not current_user.is_admin:
+        return redirect(url_for('index'))
+
+    instance = Instance.query.get_or_404(id)
+    target = Node.query.get_or_404(request.form.get('target_node_id', type=int))
+    success, message = start_migration(instance, target, live=bool(request.form.get('live')))
+    flash(message, 'success' if success else 'danger')
+    return redirect(url_for('rebalance_nodes'))
+
+
+BATCH_TIMEOUT = 300  # Seconds to wait between results of a bulk operation
+
+
+def run_node_batch(ip_address, action, names):
+    """Run a bulk start/stop/delete on one node. Returns {name: (success, message)}."""
+    results = {}
+    try:
+        response = get_client(ip_address).post(f'/batch/{action}', json={'names': names},
+                                               stream=True, timeout=BATCH_TIMEOUT)
+        if response.status_code != 200:
+            message = response.json().get('message')
+            return {name: (False, message) for name in names}
+        # The daemon streams one JSON object per container as each finishes
+        for line in response.iter_lines():
+            if line:
+                result = json.loads(line)
+                results[result['name']] = (result['status'] == 'success', result['message'])
+    except Exception as e:
+        logging.error(f"Bulk {action} on {ip_address} failed: {str(e)}")
+    for name in names:
+        results.setdefault(name, (False, 'No result from the daemon.'))
+    return results
+
+
+def run_batch(action, instances):
+    """Run a bulk action on instances spread over any number of nodes, one parallel call per node."""
+    instances_by_node = {}
+    for instance in instances:
+        instances_by_node.setdefault(instance.node.ip_address, []).append(instance.name)
+
+    results = {}
+    if instances_by_node:
+        with ThreadPoolExecutor(max_workers=len(instances_by_node)) as executor:
+            futures = [submit_traced(executor, run_node_batch, ip_address, action, names)
+                       for ip_address, names in instances_by_node.items()]
+            for future in as_completed(futures):
+                results.update(future.result())
+    return results
+
+
+def flash_batch_results(action, results):
+    failed = sorted(name for name, (success, _) in results.items() if not success)
+    if failed:
+        flash(f'Could not {action} {len(failed)} of {len(results)} instances: {", ".join(failed)}', 'danger')
+    else:
+        flash(f'{action.capitalize()} finished for {len(results)} instances.', 'success')
+
+
+@app.route('/admin/nodes/<int:id>/stop_all')
+@login_required
+def stop_node_instances(id):
+    if not current_user.is_admin:
+        return redirect(url_for('index'))
+
+    node = Node.query.get_or_404(id)
+    if node.instances:
+        flash_batch_results('stop', run_batch('stop', node.instances))
+    else:
+        flash(f'Node {node.name} has no instances.', 'success')
+    return redirect(url_for('manage_nodes'))
+
+
+@app.route('/admin/users/suspend', methods=['POST'])
+@login_required
+def suspend_user_instances():
+    if not current_user.is_admin:
+        return redirect(url_for('index'))
+
+    user = User.query.filter_by(username=request.form.get('username')).first()
+    if not user:
+        flash('User not found.', 'danger')
+        return redirect(url_for('manage_credits'))
+
+    instances = Instance.query.filter_by(user_id=user.id).all()
+    for instance in instances:
+        instance.suspended = True
+    db.session.commit()
+    if instances:
+        flash_batch_results('stop', run_batch('stop', instances))
+    flash(f'Suspended {len(instances)} instances of {user.username}.', 'success')
+    return redirect(url_for('manage_credits'))
+
 
 @app.route('/admin/nodes', methods=['GET', 'POST'])
 @login_required
@@ -356,14 +966,32 @@ def manage_nodes():
     if request.method == 'POST':
         node_name = request.form['name']
         node_ip = request.form['ip_address']
-        new_node = Node(name=node_name, ip_address=node_ip)
+        ram_gb = request.form.get('ram_capacity', type=float)
+        disk_gb = request.form.get('disk_capacity', type=float)
+        new_node = Node(name=node_name, ip_address=node_ip,
+                        ram_capacity=int(ram_gb * 1024 ** 3) if ram_gb else None,
+                        disk_capacity=int(disk_gb * 1024 ** 3) if disk_gb else None)
         db.session.add(new_node)
         db.session.commit()
         flash('Node added successfully!', 'success')
         return redirect(url_for('manage_nodes'))
 
     nodes = Node.query.all()
-    return render_template('manage_nodes.html', nodes=nodes)
+    return render_template('manage_nodes.html', nodes=nodes, health={node.id: node_health.get(node.id) for node in nodes})
+
+
+@app.route('/admin/plans/reload')
+@login_required
+def reload_plans():
+    if not current_user.is_admin:
+        return redirect(url_for('index'))
+
+    try:
+        plan_catalog.reload()
+        flash(f'Reloaded {len(plan_catalog.all())} plans.', 'success')
+    except (OSError, ValueError, KeyError) as e:
+        flash(f'Failed to reload plans: {str(e)}', 'danger')
+    return redirect(url_for('manage_nodes'))
 
 
 @app.route('/admin/nodes/toggle/<int:id>')
@@ -406,16 +1034,19 @@ def manage_credits():
 
         # Find user by username
         user = User.query.filter_by(username=username).first()
-        if user:
-            user_credits = UserCredits.query.filter_by(user_id=user.id).first()
+        if user and amount and amount > 0:
             if action == 'give':
-                user_credits.balance += amount
+                if add_credits(user.id, amount, 'admin', current_user.username):
+                    flash(f'Successfully gave {amount} credits to {username}.', 'success')
+                else:
+                    flash(f'{username} has no credit account.', 'danger')
             elif action == 'deduct':
-                user_credits.balance -= amount
-                if user_credits.balance < 0:
-                    user_credits.balance = 0  # Prevent negative balance
-            db.session.commit()
-            flash(f'Successfully {action}ed {amount} credits to {username}.', 'success')
+                # Never goes below zero; takes what's left if the balance is smaller
+                deducted = credits.debit_up_to(user.id, amount, 'admin', current_user.username)
+                db.session.commit()
+                flash(f'Successfully deducted {deducted} credits from {username}.', 'success')
+        elif user:
+            flash('Enter a positive amount.', 'danger')
         else:
             flash('User not found.', 'danger')
 
@@ -424,69 +1055,52 @@ def manage_credits():
 
 
 
-@socketio.on('execute_command')
-def handle_command(data):
-    command = data['command']
-    user_id = current_user.id
-
-    # Ensure that only the logged-in user can execute commands
-    if not user_id:
-        emit('command_output', {'output': 'Unauthorized'}, room=request.sid)
-        return
-
-    try:
-        # Execute the command securely
-        output = subprocess.check_output(command, shell=True, stderr=subprocess.STDOUT, universal_newlines=True)
-        emit('command_output', {'output': output}, room=request.sid)
-    except subprocess.CalledProcessError as e:
-        emit('command_output', {'output': e.output}, room=request.sid)
-
-
 @app.route('/terminal/<name>')
 @login_required
 def terminal(name):
-    # Set your daemon IP address here
-    daemon_ip = "45.137.70.53"  # Replace with your actual daemon IP
     instance = Instance.query.filter_by(name=name, user_id=current_user.id).first()
     
     if not instance:
         flash('Instance not found or you do not have access to it.', 'danger')
         return redirect(url_for('manage_instances'))
 
-    # Pass the instance and daemon IP to the template
-    return render_template('terminal.html', instance=instance, DAEMON_IP=daemon_ip)
-
+    if not app.config['NODE_SECRET']:
+        flash('Terminals are disabled until NODE_SECRET is configured.', 'danger')
+        return redirect(url_for('manage_instances'))
 
+    # The browser opens the terminal WebSocket directly on the instance's node, with a short-lived token for it
+    return render_template('terminal.html', instance=instance, DAEMON_IP=instance.node.ip_address,
+                           token=sign_terminal_token(app.config['NODE_SECRET'], instance.name))
 
 
-socketio = SocketIO(app)
+background_tasks_started = False
 
 
-@socketio.on('command')
-def handle_command(data):
-    name = data['name']
-    command = data['command'].strip()
+def start_background_tasks():
+    """Start the panel's long-running tasks, once per server process.
 
-    # Here, use subprocess or a library to execute commands on the LXC container
-    try:
-        # Example: executing command via LXC
-        process = subprocess.Popen(['lxc-execute', '-n', name, '--', 'bash', '-c', command],
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.PIPE)
+    Not done on import, so migrations.py and other tools that import app don't start
+    probing or following nodes. `python app.py` and wsgi.py (for gunicorn) call it.
+    """
+    global background_tasks_started
+    if background_tasks_started:
+        return
+    background_tasks_started = True
+    socketio.start_background_task(node_health.run_forever)
+    socketio.start_background_task(watch_node_events)
 
-        output, error = process.communicate()
 
-        if output:
-            emit('output', output.decode())
-        if error:
-            emit('output', error.decode())
-    except Exception as e:
-        emit('output', f'Error: {str(e)}')
+@socketio.on('connect')
+def handle_connect():
+    # Each user gets a private room so background tasks can push updates to their pages
+    if current_user.is_authenticated:
+        join_room(f'user_{current_user.id}')
 
 
 if __name__ == '__main__':
     with app.app_context():
-        db.create_all()
+        upgrade_schema()
         create_admin_account()
+    start_background_tasks()
     socketio.run(app, host='0.0.0.0', port=5000, debug=True)
 
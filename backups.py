@@ -0,0 +1,320 @@
+import gzip
+import hashlib
+import importlib
+import json
+import logging
+import os
+import stat
+import time
+import uuid
+import zlib
+from datetime import datetime, timezone
+
+try:
+    import zstandard
+except ImportError:  # Optional; backups fall back to zlib and can still read zstd chunks once it's installed
+    zstandard = None
+
+CHUNK_SIZE = 4 * 1024 ** 2  # Files are split into chunks of this size and each distinct chunk is stored once
+GC_GRACE = 12 * 3600  # Seconds an unreferenced chunk is kept, so a backup running elsewhere can still reuse it
+
+
+def compress(data):
+    if zstandard is not None:
+        return '.zst', zstandard.ZstdCompressor(level=3).compress(data)
+    return '.z', zlib.compress(data, 6)
+
+
+def decompress(suffix, data):
+    if suffix == '.zst':
+        if zstandard is None:
+            raise RuntimeError('This chunk is zstd-compressed; install the zstandard package to read it.')
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+class LocalTarget:
+    """Backup storage in a local (or mounted network) directory.
+
+    Other targets only need the same methods: chunks are immutable blobs keyed by
+    the sha256 of their content, manifests are small JSON documents per container.
+    """
+
+    SUFFIXES = ('.zst', '.z')
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(os.path.join(root, 'chunks'), exist_ok=True)
+        os.makedirs(os.path.join(root, 'manifests'), exist_ok=True)
+
+    def _chunk_path(self, digest):
+        return os.path.join(self.root, 'chunks', digest[:2], digest)
+
+    def _write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def has_chunk(self, digest):
+        """True if the chunk is stored. Its timestamp is refreshed so garbage collection keeps it."""
+        for suffix in self.SUFFIXES:
+            path = self._chunk_path(digest) + suffix
+            try:
+                os.utime(path)
+                return True
+            except FileNotFoundError:
+                continue
+        return False
+
+    def put_chunk(self, digest, data):
+        suffix, compressed = compress(data)
+        self._write(self._chunk_path(digest) + suffix, compressed)
+        return len(compressed)
+
+    def get_chunk(self, digest):
+        for suffix in self.SUFFIXES:
+            try:
+                with open(self._chunk_path(digest) + suffix, 'rb') as f:
+                    return decompress(suffix, f.read())
+            except FileNotFoundError:
+                continue
+        raise FileNotFoundError(f'Chunk {digest} is missing from the backup target')
+
+    def list_chunks(self):
+        """Yield (digest, modified_at) for every stored chunk."""
+        chunks_dir = os.path.join(self.root, 'chunks')
+        for prefix in os.listdir(chunks_dir):
+            for filename in os.listdir(os.path.join(chunks_dir, prefix)):
+                digest, suffix = os.path.splitext(filename)
+                if suffix in self.SUFFIXES:
+                    yield digest, os.path.getmtime(os.path.join(chunks_dir, prefix, filename))
+
+    def delete_chunk(self, digest):
+        for suffix in self.SUFFIXES:
+            try:
+                os.remove(self._chunk_path(digest) + suffix)
+            except FileNotFoundError:
+                pass
+
+    def _manifest_path(self, container_name, backup_id):
+        return os.path.join(self.root, 'manifests', container_name, f'{backup_id}.json.gz')
+
+    def put_manifest(self, container_name, backup_id, manifest):
+        self._write(self._manifest_path(container_name, backup_id), gzip.compress(json.dumps(manifest).encode()))
+
+    def get_manifest(self, container_name, backup_id):
+        with open(self._manifest_path(container_name, backup_id), 'rb') as f:
+            return json.loads(gzip.decompress(f.read()))
+
+    def list_backups(self, container_name):
+        directory = os.path.join(self.root, 'manifests', container_name)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(filename[:-len('.json.gz')] for filename in os.listdir(directory) if filename.endswith('.json.gz'))
+
+    def list_containers(self):
+        return os.listdir(os.path.join(self.root, 'manifests'))
+
+    def delete_manifest(self, container_name, backup_id):
+        os.remove(self._manifest_path(container_name, backup_id))
+
+
+def make_target(spec):
+    """Build a target from 'local:/path' or 'package.module:ClassName:argument' for other storage."""
+    kind, _, argument = spec.partition(':')
+    if kind == 'local':
+        return LocalTarget(argument)
+    class_name, _, argument = argument.partition(':')
+    return getattr(importlib.import_module(kind), class_name)(argument)
+
+
+class BackupEngine:
+    """Incremental, deduplicated backups of container root filesystems.
+
+    A backup is a manifest of every file with the sha256 of each of its chunks.
+    Chunks already in the target are not written again, and files whose size and
+    mtime match the previous backup are not even read, so a nightly run's I/O
+    follows the data that changed rather than the size of the container.
+    `limiter.consume(bytes)` throttles reads during backup and writes during restore.
+    """
+
+    def __init__(self, target, limiter=None):
+        self.target = target
+        self.limiter = limiter
+
+    def _throttle(self, amount):
+        if self.limiter:
+            self.limiter.consume(amount)
+
+    def _previous_files(self, container_name):
+        backups = self.target.list_backups(container_name)
+        if not backups:
+            return {}
+        try:
+            manifest = self.target.get_manifest(container_name, backups[-1])
+        except (OSError, ValueError) as e:
+            logging.warning(f"Could not read the last backup of {container_name}, reading every file: {str(e)}")
+            return {}
+        return {entry['path']: entry for entry in manifest['entries'] if entry['type'] == 'file'}
+
+    def _store_file(self, path, stats, throttled=True):
+        digests = []
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(CHUNK_SIZE)
+                if not data:
+                    break
+                if throttled:
+                    self._throttle(len(data))
+                stats['read_bytes'] += len(data)
+                digest = hashlib.sha256(data).hexdigest()
+                if not self.target.has_chunk(digest):
+                    stats['stored_bytes'] += self.target.put_chunk(digest, data)
+                digests.append(digest)
+        return digests
+
+    def _scan(self, rootfs, previous, stats, progress=None, throttled=True):
+        """List every entry under `rootfs`, reading only files that differ from `previous` (path -> entry)."""
+        stats['files'] = stats['total_bytes'] = 0
+        entries = []
+        for directory, dirnames, filenames in os.walk(rootfs):
+            dirnames.sort()  # Walk in a stable order so parents always precede their contents
+            for name in dirnames + sorted(filenames):
+                path = os.path.join(directory, name)
+                relative = os.path.relpath(path, rootfs)
+                info = os.lstat(path)
+                entry = {'path': relative, 'mode': stat.S_IMODE(info.st_mode), 'uid': info.st_uid,
+                         'gid': info.st_gid, 'mtime_ns': info.st_mtime_ns}
+                if stat.S_ISDIR(info.st_mode):
+                    entry['type'] = 'dir'
+                elif stat.S_ISLNK(info.st_mode):
+                    entry.update(type='symlink', target=os.readlink(path))
+                elif stat.S_ISREG(info.st_mode):
+                    entry.update(type='file', size=info.st_size)
+                    old = previous.get(relative)
+                    if old and old['size'] == info.st_size and old['mtime_ns'] == info.st_mtime_ns:
+                        entry['chunks'] = old['chunks']  # Unchanged since the last backup, not read at all
+                    else:
+                        entry['chunks'] = self._store_file(path, stats, throttled)
+                    stats['files'] += 1
+                    stats['total_bytes'] += info.st_size
+                elif stat.S_ISCHR(info.st_mode) or stat.S_ISBLK(info.st_mode) or stat.S_ISFIFO(info.st_mode):
+                    entry.update(type='node', file_mode=info.st_mode, rdev=info.st_rdev)
+                else:
+                    continue  # Sockets are recreated by whatever listens on them
+                xattrs = read_xattrs(path)
+                if xattrs:
+                    entry['xattrs'] = xattrs  # File capabilities, ACLs, overlayfs opaque markers
+                entries.append(entry)
+                if progress and len(entries) % 1000 == 0:
+                    progress(stats)
+        return entries
+
+    def backup(self, container_name, rootfs, progress=None, quiesce=None):
+        """Back up the directory `rootfs`. Returns (backup id, stats).
+
+        For a running container, `quiesce` is a context manager that pauses it (e.g. freezes
+        it). The tree is first read while the container runs, then walked again inside
+        `quiesce` to re-read only the files that changed meanwhile, so the backup is a
+        consistent point in time and the container is paused for the second pass only.
+        """
+        stats = {'files': 0, 'total_bytes': 0, 'read_bytes': 0, 'stored_bytes': 0}
+        entries = self._scan(rootfs, self._previous_files(container_name), stats, progress)
+        if quiesce is not None:
+            first_pass = {entry['path']: entry for entry in entries if entry['type'] == 'file'}
+            with quiesce():
+                entries = self._scan(rootfs, first_pass, stats, throttled=False)  # Not slowed down while paused
+
+        backup_id = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+        self.target.put_manifest(container_name, backup_id, {
+            'container': container_name, 'created_at': time.time(), 'stats': stats, 'entries': entries})
+        logging.info(f"Backed up {container_name} as {backup_id}: {stats['files']} files, "
+                     f"{stats['read_bytes']} bytes read, {stats['stored_bytes']} bytes stored")
+        return backup_id, stats
+
+    def restore(self, container_name, backup_id, rootfs, progress=None):
+        """Rebuild `rootfs` (which must not exist yet) from a backup."""
+        manifest = self.target.get_manifest(container_name, backup_id)
+        os.makedirs(rootfs)
+        directories = []
+        for index, entry in enumerate(manifest['entries']):
+            path = os.path.join(rootfs, entry['path'])
+            if entry['type'] == 'dir':
+                os.mkdir(path)
+                directories.append((path, entry))  # Permissions and times are set once their contents exist
+                continue
+            if entry['type'] == 'symlink':
+                os.symlink(entry['target'], path)
+            elif entry['type'] == 'file':
+                with open(path, 'wb') as f:
+                    for digest in entry['chunks']:
+                        data = self.target.get_chunk(digest)
+                        self._throttle(len(data))
+                        f.write(data)
+            elif entry['type'] == 'node':
+                os.mknod(path, entry['file_mode'], entry['rdev'])
+            apply_metadata(path, entry)
+            if progress and index % 1000 == 0:
+                progress(index, len(manifest['entries']))
+        for path, entry in reversed(directories):
+            apply_metadata(path, entry)
+
+    def list(self, container_name):
+        backups = []
+        for backup_id in self.target.list_backups(container_name):
+            manifest = self.target.get_manifest(container_name, backup_id)
+            backups.append({'id': backup_id, 'created_at': manifest['created_at'], 'stats': manifest['stats']})
+        return backups
+
+    def prune(self, container_name, keep_last, keep_weekly):
+        """Delete backups outside the retention policy. Returns the ids removed."""
+        backups = self.target.list_backups(container_name)  # Oldest first; ids sort by time
+        keep = set(backups[-keep_last:]) if keep_last else set()
+        weeks = set()
+        for backup_id in reversed(backups):
+            week = datetime.strptime(backup_id, '%Y%m%dT%H%M%SZ').isocalendar()[:2]
+            if week not in weeks and len(weeks) < keep_weekly:
+                weeks.add(week)
+                keep.add(backup_id)
+        expired = [backup_id for backup_id in backups if backup_id not in keep]
+        for backup_id in expired:
+            self.target.delete_manifest(container_name, backup_id)
+        return expired
+
+    def collect_garbage(self):
+        """Delete chunks no backup refers to any more. Returns the number removed."""
+        referenced = set()
+        for container_name in self.target.list_containers():
+            for backup_id in self.target.list_backups(container_name):
+                for entry in self.target.get_manifest(container_name, backup_id)['entries']:
+                    referenced.update(entry.get('chunks', ()))
+        cutoff = time.time() - GC_GRACE
+        removed = 0
+        for digest, modified_at in list(self.target.list_chunks()):
+            if digest not in referenced and modified_at < cutoff:
+                self.target.delete_chunk(digest)
+                removed += 1
+        return removed
+
+
+def read_xattrs(path):
+    """Return a file's extended attributes as {name: hex value}, or {} where they aren't supported."""
+    try:
+        return {name: os.getxattr(path, name, follow_symlinks=False).hex()
+                for name in os.listxattr(path, follow_symlinks=False)}
+    except OSError:
+        return {}
+
+
+def apply_metadata(path, entry):
+    os.lchown(path, entry['uid'], entry['gid'])
+    if entry['type'] != 'symlink':
+        os.chmod(path, entry['mode'])  # After lchown, which clears setuid bits
+    for name, value in entry.get('xattrs', {}).items():
+        try:
+            os.setxattr(path, name, bytes.fromhex(value), follow_symlinks=False)
+        except OSError as e:
+            logging.warning(f"Could not restore {name} on {path}: {e.strerror}")
+    os.utime(path, ns=(entry['mtime_ns'], entry['mtime_ns']), follow_symlinks=False)
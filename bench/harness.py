@@ -0,0 +1,190 @@
+"""Repeatable baseline for the panel and its node daemons, without real LXC.
+
+Spawns --nodes copies of daemon.py with LXC_BACKEND=fake, one per loopback address
+(127.0.0.2, 127.0.0.3, ...) on the usual daemon port, each with its own state directory.
+The panel runs in-process on eventlet against a throwaway SQLite database, and --users
+scripted users each log in, view /manage, create an instance, start and stop it and open
+its terminal page, --rounds times over. Prints p50/p99 latency, throughput and the number
+of database queries per route.
+
+    python bench/harness.py --nodes 3 --users 50 --rounds 2 \\
+        --latency create=2,start=0.3,stop=0.3,ls=0.05 --failure create=0.05
+
+--latency and --failure take per-tool values for the fake backend (create, copy, start,
+stop, destroy, cgroup, ls, ...), see lxc_backend.FakeLxcBackend.
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+# The panel reads its database URL at import time
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'harness.db')
+os.environ.setdefault('NODE_SECRET', 'harness')  # Inherited by the daemons, so terminal pages render
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from app import app, socketio, start_background_tasks  # noqa: E402  (monkey-patches everything for eventlet)
+import eventlet  # noqa: E402
+import requests  # noqa: E402
+from flask import g, has_request_context, request  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+from migrations import upgrade_schema  # noqa: E402
+from models import db, User, UserCredits, Node  # noqa: E402
+from node_client import DAEMON_PORT  # noqa: E402
+
+query_counts = defaultdict(list)  # route -> queries issued by each request
+
+
+def count_queries():
+    """Count SQL statements per request, keyed by the matched route rule."""
+    @app.before_request
+    def start_counting():
+        g.query_count = 0
+
+    @app.after_request
+    def record_count(response):
+        rule = request.url_rule.rule if request.url_rule else request.path
+        query_counts[rule].append(g.get('query_count', 0))
+        return response
+
+    with app.app_context():
+        @event.listens_for(db.engine, 'before_cursor_execute')
+        def on_execute(*args):
+            if has_request_context() and 'query_count' in g:
+                g.query_count += 1
+
+
+def start_daemons(count, latency, failure):
+    processes = []
+    state_dirs = []
+    peers = ','.join(f'127.0.0.{i + 2}' for i in range(count))  # Every node may migrate to every other
+    for i in range(count):
+        ip_address = f'127.0.0.{i + 2}'
+        state_dir = tempfile.mkdtemp(prefix=f'harness-node{i}-')
+        env = dict(os.environ, LXC_BACKEND='fake', LXC_FAKE_LATENCY=latency, LXC_FAKE_FAILURE=failure,
+                   DAEMON_HOST=ip_address, DAEMON_PORT=str(DAEMON_PORT), DAEMON_STATE_DIR=state_dir,
+                   NODE_PEERS=peers)
+        env.pop('DATABASE_URL')
+        processes.append(subprocess.Popen([sys.executable, os.path.join(ROOT, 'daemon.py')], env=env,
+                                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        state_dirs.append(state_dir)
+
+    deadline = time.monotonic() + 30
+    for i in range(count):
+        url = f'http://127.0.0.{i + 2}:{DAEMON_PORT}/resources'
+        while True:
+            try:
+                requests.get(url, timeout=1)
+                break
+            except requests.RequestException:
+                if time.monotonic() > deadline:
+                    raise SystemExit(f'Daemon on 127.0.0.{i + 2} did not come up')
+                eventlet.sleep(0.2)
+    return processes, state_dirs
+
+
+def seed(node_count, user_count):
+    with app.app_context():
+        upgrade_schema()
+        for i in range(node_count):
+            db.session.add(Node(name=f'harness-node{i}', ip_address=f'127.0.0.{i + 2}',
+                                ram_capacity=1024 ** 4, disk_capacity=1024 ** 5))
+        users = []
+        for i in range(user_count):
+            user = User(username=f'harness{i}')
+            user.set_password('harness')
+            db.session.add(user)
+            users.append(user)
+        db.session.commit()
+        for user in users:
+            db.session.add(UserCredits(user_id=user.id, balance=10 ** 9))
+        db.session.commit()
+
+
+def scripted_user(base, index, rounds, think_time, timings):
+    session = requests.Session()
+
+    def call(route, method, path, **kwargs):
+        started = time.monotonic()
+        try:
+            response = session.request(method, base + path, allow_redirects=False, timeout=60, **kwargs)
+            ok = response.status_code < 400
+        except requests.RequestException:
+            ok = False
+        timings[route].append((time.monotonic() - started, ok))
+        eventlet.sleep(think_time)
+
+    call('/login', 'POST', '/login', data={'username': f'harness{index}', 'password': 'harness'})
+    for round_number in range(rounds):
+        name = f'harness{index}-{round_number}'
+        call('/manage', 'GET', '/manage')
+        call('/create', 'POST', '/create', data={'name': name, 'plan': 'Basic'})
+        call('/manage', 'GET', '/manage')
+        call('/start/<name>', 'GET', f'/start/{name}')
+        call('/manage', 'GET', '/manage')
+        call('/stop/<name>', 'GET', f'/stop/{name}')
+        call('/terminal/<name>', 'GET', f'/terminal/{name}')
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)] * 1000
+
+
+def report(timings, elapsed):
+    total = sum(len(samples) for samples in timings.values())
+    print(f'{total} requests in {elapsed:.2f}s ({total / elapsed:.0f} req/s)')
+    print(f'{"route":<20}{"count":>7}{"errors":>8}{"p50 ms":>10}{"p99 ms":>10}{"queries":>9}')
+    for route in sorted(timings):
+        samples = timings[route]
+        latencies = [latency for latency, _ in samples]
+        errors = sum(1 for _, ok in samples if not ok)
+        counts = query_counts.get(route, [])
+        queries = f'{sum(counts) / len(counts):.1f}' if counts else '-'
+        print(f'{route:<20}{len(samples):>7}{errors:>8}{percentile(latencies, 0.5):>10.1f}'
+              f'{percentile(latencies, 0.99):>10.1f}{queries:>9}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--nodes', type=int, default=3)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--rounds', type=int, default=2, help='create/start/stop cycles per user')
+    parser.add_argument('--think-time', type=float, default=0.1, help='seconds between a user\'s requests')
+    parser.add_argument('--latency', default='create=2,copy=0.5,start=0.3,stop=0.3,ls=0.05')
+    parser.add_argument('--failure', default='')
+    parser.add_argument('--port', type=int, default=5056)
+    args = parser.parse_args()
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    count_queries()
+    processes, state_dirs = start_daemons(args.nodes, args.latency, args.failure)
+    try:
+        seed(args.nodes, args.users)
+        start_background_tasks()
+        eventlet.spawn(socketio.run, app, host='127.0.0.1', port=args.port, log_output=False)
+        eventlet.sleep(1)
+
+        timings = defaultdict(list)
+        base = f'http://127.0.0.1:{args.port}'
+        started = time.monotonic()
+        pool = eventlet.GreenPool(args.users)
+        for index in range(args.users):
+            pool.spawn(scripted_user, base, index, args.rounds, args.think_time, timings)
+        pool.waitall()
+        report(timings, time.monotonic() - started)
+    finally:
+        for process in processes:
+            process.terminate()
+        for state_dir in state_dirs:
+            shutil.rmtree(state_dir, ignore_errors=True)
+    os._exit(0)  # Background streams and the scheduler would keep the process alive
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""Show that the panel keeps serving page views while slow daemon calls are in flight.
+
+Starts a fake node daemon on 127.0.0.1:8080 whose /create takes --create-delay seconds,
+runs the panel on eventlet against a throwaway SQLite database, then fires --slow-creates
+create requests followed by --page-views concurrent /manage requests and prints latency
+percentiles for the page views.
+
+    python bench/loadtest_eventlet.py --page-views 500 --concurrency 200 --slow-creates 5
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from urllib.parse import parse_qs
+
+# The panel reads its database URL at import time
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'loadtest.db')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app, socketio, start_background_tasks  # noqa: E402  (monkey-patches everything for eventlet)
+import eventlet  # noqa: E402
+import eventlet.wsgi  # noqa: E402
+import requests  # noqa: E402
+from migrations import upgrade_schema  # noqa: E402
+from models import db, User, UserCredits, Node, Instance  # noqa: E402
+
+
+def fake_daemon(create_delay):
+    def application(environ, start_response):
+        path = environ['PATH_INFO']
+        query = parse_qs(environ.get('QUERY_STRING', ''))
+        if path == '/create':
+            eventlet.sleep(create_delay)  # A node stuck running lxc-create
+            status, body = '202 Accepted', {'status': 'success', 'job_id': 'loadtest'}
+        elif path == '/status':
+            names = query.get('names', [''])[0].split(',')
+            status, body = '200 OK', {'status': 'success', 'instance_statuses': {n: 'RUNNING' for n in names if n}}
+        elif path == '/health':
+            status, body = '200 OK', {'status': 'success', 'health': {'ram_free': 64 * 1024 ** 3}}
+        elif path.startswith('/jobs/'):
+            status, body = '200 OK', {'status': 'success', 'job': {'state': 'succeeded', 'progress': 100,
+                                                                   'message': 'done'}}
+        else:
+            status, body = '404 Not Found', {'status': 'error', 'message': 'Not found.'}
+        start_response(status, [('Content-Type', 'application/json')])
+        return [json.dumps(body).encode()]
+    return application
+
+
+def seed(instance_count):
+    with app.app_context():
+        upgrade_schema()
+        user = User(username='loadtest')
+        user.set_password('loadtest')
+        db.session.add(user)
+        node = Node(name='loadtest-node', ip_address='127.0.0.1', ram_capacity=1024 ** 4, disk_capacity=1024 ** 5)
+        db.session.add(node)
+        db.session.commit()
+        db.session.add(UserCredits(user_id=user.id, balance=10 ** 9))
+        for i in range(instance_count):
+            db.session.add(Instance(name=f'loadtest-{i}', user_id=user.id, plan='Basic', node_id=node.id))
+        db.session.commit()
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--page-views', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--slow-creates', type=int, default=5)
+    parser.add_argument('--create-delay', type=float, default=20.0)
+    parser.add_argument('--instances', type=int, default=20, help='instances listed on every /manage page')
+    parser.add_argument('--port', type=int, default=5055)
+    args = parser.parse_args()
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    seed(args.instances)
+    eventlet.spawn(eventlet.wsgi.server, eventlet.listen(('127.0.0.1', 8080)), fake_daemon(args.create_delay),
+                   log_output=False)
+    start_background_tasks()
+    eventlet.spawn(socketio.run, app, host='127.0.0.1', port=args.port, log_output=False)
+    eventlet.sleep(1)
+
+    base = f'http://127.0.0.1:{args.port}'
+    session = requests.Session()
+    session.post(f'{base}/login', data={'username': 'loadtest', 'password': 'loadtest'})
+
+    def slow_create(i):
+        started = time.monotonic()
+        session.post(f'{base}/create', data={'name': f'slow-{i}', 'plan': 'Basic'})
+        return time.monotonic() - started
+
+    creates = [eventlet.spawn(slow_create, i) for i in range(args.slow_creates)]
+    eventlet.sleep(0.5)  # Let the creates reach the daemon
+
+    def page_view(_):
+        started = time.monotonic()
+        response = session.get(f'{base}/manage')
+        return time.monotonic() - started, response.status_code
+
+    started = time.monotonic()
+    results = list(eventlet.GreenPool(args.concurrency).imap(page_view, range(args.page_views)))
+    elapsed = time.monotonic() - started
+    in_flight = sum(1 for create in creates if not create.dead)
+
+    latencies = [latency for latency, _ in results]
+    errors = sum(1 for _, status in results if status != 200)
+    print(f'{args.page_views} page views at concurrency {args.concurrency} in {elapsed:.2f}s '
+          f'({args.page_views / elapsed:.0f} req/s), {errors} errors')
+    print(f'latency ms: p50 {percentile(latencies, 0.5):.1f}  p95 {percentile(latencies, 0.95):.1f}  '
+          f'p99 {percentile(latencies, 0.99):.1f}  max {max(latencies) * 1000:.1f}')
+    print(f'{in_flight} of {args.slow_creates} slow creates ({args.create_delay:.0f}s each) '
+          f'were still in flight when the page views finished')
+    os._exit(0)  # Background streams and the scheduler would keep the process alive
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+import logging
+from datetime import datetime, timedelta
+
+from credits import change_balance, ledger_entry, post_entries
+from models import db, Instance
+
+BILLING_PERIOD = timedelta(days=30)
+BILLING_BATCH_SIZE = 500  # Due instances billed per transaction
+
+
+def bill_instance(instance, plans, now, entries):
+    """Charge one instance for its next period, suspending it if the owner can't pay.
+
+    The balance is decremented with a single conditional UPDATE so concurrent
+    charges against the same user can never take the balance below zero. The
+    ledger entry for the charge is appended to `entries` for the caller to post.
+    """
+    plan_details = plans.get(instance.plan)
+    if not plan_details:
+        logging.error(f"Plan {instance.plan} not found for billing instance {instance.name}.")
+        return False
+
+    cost = plan_details['cost']
+    if change_balance(instance.user_id, -cost):
+        entries.append(ledger_entry(instance.user_id, -cost, 'billing', instance.name, now))
+        instance.last_billed_date = now
+        instance.next_billing_date = now + BILLING_PERIOD
+        instance.suspended = False  # Ensure it's active if they can pay
+        return True
+
+    # Suspend the instance if there aren't enough credits; it stays due and is retried next run
+    if not instance.suspended:
+        logging.warning(f"Instance {instance.name} suspended due to insufficient credits.")
+    instance.suspended = True
+    return False
+
+
+def bill_due_instances(plans, now=None):
+    """Bill every instance whose next_billing_date has passed, one transaction per batch.
+
+    Only due rows are read, through the index on next_billing_date. Returns the
+    number of instances charged and suspended.
+    """
+    now = now or datetime.utcnow()
+    charged = suspended = 0
+    last_id = 0
+    while True:
+        # Unpaid instances stay due, so page by id to visit each row once per run
+        batch = (Instance.query
+                 .filter(Instance.next_billing_date <= now, Instance.id > last_id)
+                 .order_by(Instance.id)
+                 .limit(BILLING_BATCH_SIZE)
+                 .all())
+        if not batch:
+            break
+        last_id = batch[-1].id
+
+        try:
+            entries = []
+            for instance in batch:
+                if bill_instance(instance, plans, now, entries):
+                    charged += 1
+                else:
+                    suspended += 1
+            post_entries(entries)  # The batch's ledger entries go in with one INSERT, in the same commit
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+    logging.info(f"Billing run finished: {charged} charged, {suspended} unpaid")
+    return charged, suspended
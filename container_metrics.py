@@ -0,0 +1,242 @@
+import logging
+import os
+import time
+from collections import deque
+from threading import Lock
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+FIELDS = ('timestamp', 'memory_bytes', 'cpu_percent', 'io_read_bps', 'io_write_bps', 'pids')
+
+# (name, bucket seconds, buckets kept): one-minute averages for a day, hourly averages for a month
+ROLLUPS = (('minute', 60, 24 * 60), ('hour', 3600, 30 * 24))
+
+
+def cgroup_v2():
+    return os.path.exists(os.path.join(CGROUP_ROOT, 'cgroup.controllers'))
+
+
+def read_int(path):
+    try:
+        with open(path) as f:
+            value = f.read().strip()
+    except OSError:
+        return None
+    return int(value) if value.isdigit() else None
+
+
+def read_keyed(path):
+    """Parse flat `key value` files such as cpu.stat."""
+    values = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                key, _, value = line.partition(' ')
+                if value.strip().isdigit():
+                    values[key] = int(value)
+    except OSError:
+        pass
+    return values
+
+
+def find_cgroup(base, container_name):
+    """The container's cgroup directory under a hierarchy (a v1 controller's or the v2 root), or None if it isn't running."""
+    # LXC 4+ puts the payload in lxc.payload.NAME, older releases in lxc/NAME
+    for candidate in (f'lxc.payload.{container_name}', f'lxc.payload/{container_name}', f'lxc/{container_name}'):
+        path = os.path.join(base, candidate)
+        if os.path.isdir(path):
+            return path
+    return None
+
+
+class ContainerCgroup:
+    """Reads usage counters straight from a container's cgroup files (v1 or v2)."""
+
+    def __init__(self, container_name, unified):
+        self.unified = unified
+        if unified:
+            self.path = find_cgroup(CGROUP_ROOT, container_name)
+        else:
+            self.paths = {controller: find_cgroup(os.path.join(CGROUP_ROOT, controller), container_name)
+                          for controller in ('memory', 'cpuacct', 'blkio', 'pids')}
+
+    def directory(self):
+        """The container's cgroup directory, the memory controller's on v1."""
+        return self.path if self.unified else self.paths['memory']
+
+    def first_pid(self):
+        """A process in the container, e.g. to read its network namespace through /proc/PID/net."""
+        directory = self.directory()
+        if not directory:
+            return None
+        # On v2 processes live in leaf cgroups only, so a systemd container's may be a few levels down
+        for current, _, _ in os.walk(directory):
+            try:
+                with open(os.path.join(current, 'cgroup.procs')) as f:
+                    line = f.readline().strip()
+            except OSError:
+                continue
+            if line.isdigit():
+                return int(line)
+        return None
+
+    def read(self):
+        """Return (memory_bytes, cpu_usec, io_read_bytes, io_write_bytes, pids), or None if the cgroup is gone."""
+        if self.unified:
+            if not self.path:
+                return None
+            memory = read_int(os.path.join(self.path, 'memory.current'))
+            cpu_usec = read_keyed(os.path.join(self.path, 'cpu.stat')).get('usage_usec', 0)
+            io_read = io_write = 0
+            try:
+                with open(os.path.join(self.path, 'io.stat')) as f:
+                    for line in f:
+                        for field in line.split()[1:]:
+                            key, _, value = field.partition('=')
+                            if key == 'rbytes':
+                                io_read += int(value)
+                            elif key == 'wbytes':
+                                io_write += int(value)
+            except OSError:
+                pass
+            pids = read_int(os.path.join(self.path, 'pids.current'))
+        else:
+            if not self.paths['memory']:
+                return None
+            memory = read_int(os.path.join(self.paths['memory'], 'memory.usage_in_bytes'))
+            cpu_ns = read_int(os.path.join(self.paths['cpuacct'] or '', 'cpuacct.usage')) or 0
+            cpu_usec = cpu_ns // 1000
+            io_read = io_write = 0
+            try:
+                with open(os.path.join(self.paths['blkio'] or '', 'blkio.throttle.io_service_bytes')) as f:
+                    for line in f:
+                        fields = line.split()
+                        if len(fields) == 3 and fields[1] == 'Read':
+                            io_read += int(fields[2])
+                        elif len(fields) == 3 and fields[1] == 'Write':
+                            io_write += int(fields[2])
+            except OSError:
+                pass
+            pids = read_int(os.path.join(self.paths['pids'] or '', 'pids.current'))
+
+        if memory is None:
+            return None
+        return memory, cpu_usec, io_read, io_write, pids or 0
+
+
+class Rollup:
+    """Averages samples into fixed-width time buckets kept in a bounded deque."""
+
+    def __init__(self, bucket_seconds, size):
+        self.bucket_seconds = bucket_seconds
+        self.buckets = deque(maxlen=size)
+        self.current_bucket = None
+        self.sums = None
+        self.count = 0
+
+    def add(self, sample):
+        bucket = int(sample[0] // self.bucket_seconds) * self.bucket_seconds
+        if bucket != self.current_bucket:
+            self.flush()
+            self.current_bucket = bucket
+            self.sums = [0] * (len(sample) - 1)
+            self.count = 0
+        for i, value in enumerate(sample[1:]):
+            self.sums[i] += value
+        self.count += 1
+
+    def flush(self):
+        if self.count:
+            self.buckets.append((self.current_bucket,) + tuple(round(total / self.count, 2) for total in self.sums))
+            self.count = 0
+
+    def samples(self):
+        pending = []
+        if self.count:
+            pending.append((self.current_bucket,) + tuple(round(total / self.count, 2) for total in self.sums))
+        return list(self.buckets) + pending
+
+
+class ContainerSeries:
+    def __init__(self, raw_size):
+        self.raw = deque(maxlen=raw_size)
+        self.rollups = {name: Rollup(seconds, size) for name, seconds, size in ROLLUPS}
+        self.previous = None  # (monotonic time, cpu_usec, io_read, io_write) of the last reading
+
+    def add(self, now, monotonic_now, reading):
+        memory, cpu_usec, io_read, io_write, pids = reading
+        cpu_percent = io_read_bps = io_write_bps = 0.0
+        if self.previous:
+            elapsed = monotonic_now - self.previous[0]
+            if elapsed > 0:
+                cpu_percent = max(cpu_usec - self.previous[1], 0) / (elapsed * 1e6) * 100
+                io_read_bps = max(io_read - self.previous[2], 0) / elapsed
+                io_write_bps = max(io_write - self.previous[3], 0) / elapsed
+        self.previous = (monotonic_now, cpu_usec, io_read, io_write)
+
+        sample = (int(now), memory, round(cpu_percent, 2), round(io_read_bps), round(io_write_bps), pids)
+        self.raw.append(sample)
+        for rollup in self.rollups.values():
+            rollup.add(sample)
+
+
+class MetricsCollector:
+    """Samples cgroup usage for every running container on a fixed interval.
+
+    Raw samples cover the last `raw_size` intervals; older data survives only in the
+    minute and hour rollups. No processes are forked: everything comes from cgroupfs.
+    """
+
+    def __init__(self, container_names, interval=10, raw_size=360):
+        self.container_names = container_names  # Callable returning the containers to sample
+        self.interval = interval
+        self.raw_size = raw_size
+        self.unified = cgroup_v2()
+        self.series = {}
+        self.cgroups = {}
+        self.lock = Lock()
+
+    def sample_once(self):
+        now = time.time()
+        monotonic_now = time.monotonic()
+        names = set(self.container_names())
+        for name in names:
+            cgroup = self.cgroups.get(name) or ContainerCgroup(name, self.unified)
+            reading = cgroup.read()
+            if reading is None:
+                self.cgroups.pop(name, None)  # Look the cgroup up again next time, it may have moved
+                continue
+            self.cgroups[name] = cgroup
+            with self.lock:
+                series = self.series.get(name)
+                if series is None:
+                    series = self.series[name] = ContainerSeries(self.raw_size)
+                series.add(now, monotonic_now, reading)
+
+    def forget(self, name):
+        with self.lock:
+            self.series.pop(name, None)
+        self.cgroups.pop(name, None)
+
+    def run_forever(self):
+        while True:
+            started = time.monotonic()
+            try:
+                self.sample_once()
+            except Exception as e:
+                logging.error(f"Error sampling container metrics: {str(e)}")
+            time.sleep(max(self.interval - (time.monotonic() - started), 0))
+
+    def query(self, names, resolution='raw', since=0):
+        """Return {name: {'latest': sample, 'samples': [...]}} for the requested containers."""
+        result = {}
+        with self.lock:
+            for name in names:
+                series = self.series.get(name)
+                if series is None:
+                    continue
+                samples = list(series.raw) if resolution == 'raw' else series.rollups[resolution].samples()
+                result[name] = {
+                    'latest': series.raw[-1] if series.raw else None,
+                    'samples': [sample for sample in samples if sample[0] >= since],
+                }
+        return result
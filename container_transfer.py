@@ -0,0 +1,258 @@
+import hashlib
+import json
+import os
+import posixpath
+import re
+import stat
+import tarfile
+import time
+from threading import Lock
+
+CHUNK_SIZE = 8 * 1024 ** 2  # Bytes sent per request; a failed transfer resumes from the last whole chunk
+COMPRESS_LEVEL = 1  # gzip level; rootfs data is large and the link is the bottleneck, not the CPU
+CONTAINER_NAME_RE = re.compile(r'^[a-zA-Z0-9_-]+$')  # Same rule the panel applies to instance names
+
+
+class RateLimiter:
+    """Token bucket capping the average rate of a transfer to `rate` bytes per second (0 = unlimited)."""
+
+    def __init__(self, rate, burst=CHUNK_SIZE):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated_at = time.monotonic()
+        self.lock = Lock()
+
+    def consume(self, amount):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+def build_archive(container_dir, archive_path, overlay=None):
+    """Write a gzip'd tar of a container directory (config, rootfs, checkpoint) and return its sha256.
+
+    Ownership is stored numerically so unprivileged containers keep their mapped uids.
+    `overlay` is (lower, upper) for an overlay clone: its rootfs is stored flattened, as
+    the merged view of the two, since the image it was cloned from is on this node only.
+    """
+    name = os.path.basename(container_dir)
+    tmp_path = archive_path + '.tmp'
+    with tarfile.open(tmp_path, 'w:gz', compresslevel=COMPRESS_LEVEL, format=tarfile.PAX_FORMAT) as archive:
+        if overlay is None:
+            archive.add(container_dir, arcname=name, recursive=True)
+        else:
+            lower, upper = overlay
+            rootfs = os.path.join(container_dir, 'rootfs')
+            # The upper and work directories are folded into rootfs/, or only matter while mounted
+            skipped = {rootfs, upper, os.path.join(container_dir, 'olwork')}
+            if os.path.dirname(upper) != container_dir:
+                skipped.add(os.path.dirname(upper))  # e.g. overlay/ holding delta/ and work/
+            archive.add(container_dir, arcname=name, recursive=False)
+            for entry in sorted(os.listdir(container_dir)):
+                path = os.path.join(container_dir, entry)
+                if path not in skipped:
+                    archive.add(path, arcname=f'{name}/{entry}', recursive=True)
+            add_merged(archive, [upper, lower], f'{name}/rootfs')
+    os.replace(tmp_path, archive_path)
+    return file_sha256(archive_path)
+
+
+def is_whiteout(path):
+    """overlayfs marks a file deleted from the lower layers with a 0/0 character device in the upper one."""
+    info = os.lstat(path)
+    return stat.S_ISCHR(info.st_mode) and info.st_rdev == 0
+
+
+def is_opaque(path):
+    """An opaque directory in the upper layer hides everything below it in the lower ones."""
+    for attribute in ('trusted.overlay.opaque', 'user.overlay.opaque'):
+        try:
+            if os.getxattr(path, attribute, follow_symlinks=False) == b'y':
+                return True
+        except OSError:
+            continue  # Not set, or no xattr support
+    return False
+
+
+def add_merged(archive, layers, arcname):
+    """Add the directory `layers[0]` as overlayfs would show it over `layers[1:]`, uppermost first."""
+    archive.add(layers[0], arcname=arcname, recursive=False)
+    entries = {}
+    for layer in layers:
+        for entry in os.listdir(layer):
+            entries.setdefault(entry, []).append(os.path.join(layer, entry))
+        if is_opaque(layer):
+            break
+    for entry in sorted(entries):
+        paths = entries[entry]
+        if is_whiteout(paths[0]):
+            continue
+        if not os.path.isdir(paths[0]) or os.path.islink(paths[0]):
+            archive.add(paths[0], arcname=f'{arcname}/{entry}', recursive=False)
+            continue
+        # A directory merges with the directories of the same name directly below it
+        merged = [paths[0]]
+        for path in paths[1:]:
+            if not os.path.isdir(path) or os.path.islink(path):
+                break
+            merged.append(path)
+        add_merged(archive, merged, f'{arcname}/{entry}')
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 ** 2), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_chunks(path, offset, chunk_size=CHUNK_SIZE):
+    """Yield (offset, data) for the rest of a file starting at `offset`."""
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                return
+            yield offset, data
+            offset += len(data)
+
+
+def check_members(members, container_name):
+    """Raise ValueError unless every member lands inside `container_name`/ when extracted in order.
+
+    Paths are checked as the archive will build them: a member at or below an
+    earlier symlink, hard link or file would be written wherever that link points,
+    so any path that runs through a non-directory member is refused, and so is a
+    hard link to a symlink. Symlink targets themselves are left alone; a rootfs is
+    full of absolute links, and nothing is extracted through them.
+    """
+    not_directories = set()
+    symlinks = set()
+    for member in members:
+        for path in [member.name] + ([member.linkname] if member.islnk() else []):
+            normalized = posixpath.normpath(path)
+            if path.startswith('/') or (normalized != container_name and not normalized.startswith(container_name + '/')):
+                raise ValueError(f'Archive member {member.name} is outside {container_name}')
+            parts = normalized.split('/')
+            for depth in range(1, len(parts)):
+                if '/'.join(parts[:depth]) in not_directories:
+                    raise ValueError(f'Archive member {member.name} is below the link or file {"/".join(parts[:depth])}')
+        name = posixpath.normpath(member.name)
+        if name in not_directories:
+            raise ValueError(f'Archive member {member.name} would be written over an earlier link or file')
+        if member.islnk() and posixpath.normpath(member.linkname) in symlinks:
+            raise ValueError(f'Archive member {member.name} is a hard link to the symlink {member.linkname}')
+        if member.issym():
+            symlinks.add(name)
+        if not member.isdir():
+            not_directories.add(name)
+
+
+def extract_archive(archive_path, lxc_path, container_name):
+    """Unpack a transferred container into lxc_path, refusing anything outside its own directory."""
+    if not CONTAINER_NAME_RE.match(container_name):
+        raise ValueError(f'Invalid container name {container_name!r}')
+    if os.path.lexists(os.path.join(lxc_path, container_name)):
+        raise ValueError(f'{container_name} already exists')
+    with tarfile.open(archive_path, 'r:gz') as archive:
+        members = archive.getmembers()
+        check_members(members, container_name)
+        # Checked above; newer Pythons' default 'data' filter would strip the setuid bits a rootfs needs
+        extra = {'filter': 'fully_trusted'} if hasattr(tarfile, 'fully_trusted_filter') else {}
+        archive.extractall(lxc_path, members=members, numeric_owner=True, **extra)
+
+
+class IncomingTransfers:
+    """Transfers being received by this daemon, staged on disk so a dropped connection can resume.
+
+    Each transfer is a `<id>.part` file that only ever grows by whole chunks at its
+    current size, plus a `<id>.json` with what the sender announced.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _paths(self, transfer_id):
+        if not transfer_id.isalnum():
+            raise ValueError('Invalid transfer id.')
+        base = os.path.join(self.directory, transfer_id)
+        return base + '.part', base + '.json'
+
+    def create(self, transfer_id, meta):
+        """Start (or rejoin) a transfer. Returns the offset the sender should continue from."""
+        part_path, meta_path = self._paths(transfer_id)
+        with self.lock:
+            if not os.path.exists(meta_path):
+                with open(meta_path, 'w') as f:
+                    json.dump(meta, f)
+                open(part_path, 'wb').close()
+            return os.path.getsize(part_path)
+
+    def meta(self, transfer_id):
+        _, meta_path = self._paths(transfer_id)
+        try:
+            with open(meta_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def offset(self, transfer_id):
+        part_path, _ = self._paths(transfer_id)
+        return os.path.getsize(part_path) if os.path.exists(part_path) else None
+
+    def append(self, transfer_id, offset, stream, length):
+        """Append a chunk if it starts where the file ends. Returns the new offset, or the current one on a mismatch."""
+        part_path, _ = self._paths(transfer_id)
+        with self.lock:
+            current = os.path.getsize(part_path)
+            if offset != current:
+                return current
+            written = 0
+            with open(part_path, 'ab') as f:
+                while written < length:
+                    data = stream.read(min(1024 ** 2, length - written))
+                    if not data:
+                        break
+                    f.write(data)
+                    written += len(data)
+                if written != length:
+                    f.truncate(current)  # A half-received chunk is dropped and resent
+                    return current
+            return current + written
+
+    def verify(self, transfer_id):
+        part_path, _ = self._paths(transfer_id)
+        meta = self.meta(transfer_id)
+        if os.path.getsize(part_path) != meta['size']:
+            return False
+        return file_sha256(part_path) == meta['sha256']
+
+    def archive_path(self, transfer_id):
+        return self._paths(transfer_id)[0]
+
+    def mark_complete(self, transfer_id):
+        """Drop the received data but remember the transfer finished, so a retried /complete succeeds."""
+        part_path, meta_path = self._paths(transfer_id)
+        meta = dict(self.meta(transfer_id), completed=True)
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+        os.remove(part_path)
+
+    def discard(self, transfer_id):
+        for path in self._paths(transfer_id):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
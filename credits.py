@@ -0,0 +1,77 @@
+from datetime import datetime
+
+from sqlalchemy import func
+
+from models import db, UserCredits, CreditEntry
+
+# Nothing here commits: callers commit once the ledger entry and whatever it paid for are both in place
+
+
+def change_balance(user_id, amount):
+    """Add `amount` to a balance in a single UPDATE. Charges (negative amounts) only apply if the balance covers them.
+
+    Returns True if the balance changed. Concurrent callers can't lose updates or overdraw,
+    because the check and the change happen in the database, not in Python.
+    """
+    query = UserCredits.query.filter(UserCredits.user_id == user_id)
+    if amount < 0:
+        query = query.filter(UserCredits.balance >= -amount)
+    return query.update({UserCredits.balance: UserCredits.balance + amount}, synchronize_session=False) == 1
+
+
+def ledger_entry(user_id, amount, reason, reference=None, now=None):
+    return {'user_id': user_id, 'amount': amount, 'reason': reason, 'reference': reference,
+            'created_at': now or datetime.utcnow()}
+
+
+def post_entries(entries):
+    """Write many ledger entries with one multi-row INSERT (billing runs post a whole batch at once)."""
+    if entries:
+        db.session.execute(CreditEntry.__table__.insert(), entries)
+
+
+def post(user_id, amount, reason, reference=None):
+    """Change the balance and record it in the ledger. Returns False if a charge wasn't covered."""
+    if not change_balance(user_id, amount):
+        return False
+    post_entries([ledger_entry(user_id, amount, reason, reference)])
+    return True
+
+
+def debit_up_to(user_id, amount, reason, reference=None, attempts=5):
+    """Charge `amount`, or whatever is left if the balance is smaller. Returns the amount charged."""
+    for _ in range(attempts):
+        if post(user_id, -amount, reason, reference):
+            return amount
+        balance = current_balance(user_id)
+        if not balance or balance <= 0:
+            return 0
+        # Take exactly what's there, unless another request changed it in the meantime
+        charged = UserCredits.query.filter(UserCredits.user_id == user_id, UserCredits.balance == balance) \
+            .update({UserCredits.balance: 0}, synchronize_session=False)
+        if charged:
+            post_entries([ledger_entry(user_id, -balance, reason, reference)])
+            return balance
+    return 0
+
+
+def open_account(user_id, balance, reason='signup'):
+    db.session.add(UserCredits(user_id=user_id, balance=balance))
+    if balance:
+        post_entries([ledger_entry(user_id, balance, reason)])
+
+
+def current_balance(user_id):
+    return db.session.query(UserCredits.balance).filter(UserCredits.user_id == user_id).scalar()
+
+
+def find_balance_mismatches():
+    """Return (user_id, balance, ledger total) for every balance that doesn't match its ledger."""
+    totals = (db.session.query(CreditEntry.user_id, func.sum(CreditEntry.amount).label('total'))
+              .group_by(CreditEntry.user_id)
+              .subquery())
+    total = func.coalesce(totals.c.total, 0)
+    return (db.session.query(UserCredits.user_id, UserCredits.balance, total)
+            .outerjoin(totals, totals.c.user_id == UserCredits.user_id)
+            .filter(func.coalesce(UserCredits.balance, 0) != total)
+            .all())
@@ -2,71 +2,559 @@ import subprocess
 import json
 import logging
 from flask import Flask, request, jsonify, Response
-from threading import Thread, Lock
+from threading import Thread, Lock, BoundedSemaphore
 import time
 import os
-from flask_cors import CORS 
+import re
+import tarfile
+import uuid
+import queue
+import hmac
+from contextlib import contextmanager
+from functools import wraps
+import shutil
+import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from image_cache import ImageCache
+from lxc_backend import make_backend, TimedBackend, rootfs_layers, set_rootfs_setting
+from instrumentation import instrument_app, record, registry
+from pty_sessions import PtySessionManager
+from state_store import StateStore
+from container_metrics import MetricsCollector, FIELDS as METRIC_FIELDS
+from container_transfer import (CONTAINER_NAME_RE, RateLimiter, IncomingTransfers, build_archive, extract_archive,
+                                read_chunks)
+from backups import BackupEngine, make_target
+from idle_freezer import IdleFreezer
+from resource_limits import ResourceLimiter, PROJECT_ID_BASE
+from plan_catalog import parse_size
+import node_client
+from node_client import get_client, check_terminal_token, NodeUnavailable
+from flask_sock import Sock
+from simple_websocket import ConnectionClosed
 
 app = Flask(__name__)
-CORS(app)
+sock = Sock(app)
 
 # Set up logging
 logging.basicConfig(level=logging.DEBUG)
 
-# A global dictionary to store container statuses
+# Request timing and /metrics; SLOW_REQUEST_THRESHOLD (seconds) logs slow requests with their lxc breakdown
+SLOW_REQUEST_THRESHOLD = float(os.environ.get('SLOW_REQUEST_THRESHOLD', 0))
+instrument_app(app, slow_request_threshold=SLOW_REQUEST_THRESHOLD,
+               exclude=('/events', '/terminal/<instance_name>'))
+lxc_command_duration = registry.histogram('lxc_command_duration_seconds', 'Time spent in lxc-* and other commands.',
+                                          ('command', 'outcome'))
+
+# Where the daemon listens and keeps its files; several daemons on one host need their own
+DAEMON_HOST = os.environ.get('DAEMON_HOST', '0.0.0.0')
+DAEMON_PORT = int(os.environ.get('DAEMON_PORT', 8080))
+STATE_DIR = os.environ.get('DAEMON_STATE_DIR', os.path.dirname(os.path.abspath(__file__)))
+# Shared by the panel and every daemon: authenticates panel and node-to-node requests; unset refuses them
+NODE_SECRET = os.environ.get('NODE_SECRET', '')
+node_client.configure(node_secret=NODE_SECRET)
+# Comma-separated IP addresses of the daemons this node may migrate containers to; unset refuses migrations
+NODE_PEERS = {peer.strip() for peer in os.environ.get('NODE_PEERS', '').split(',') if peer.strip()}
+
+
+def observe_lxc_command(command, seconds, ok):
+    lxc_command_duration.observe(seconds, command=command, outcome='ok' if ok else 'failed')
+    record('lxc', seconds)
+
+
+# Real lxc-* tools, or an in-memory fake with LXC_BACKEND=fake
+lxc = TimedBackend(make_backend(STATE_DIR), observe_lxc_command)
+
+# A global dictionary to store container statuses, backed by a local SQLite file
 container_statuses = {}
 status_lock = Lock()  # For thread safety
-terminal_processes = {}  # To store subprocess references for terminals
-terminal_process_lock = Lock()  # Lock for terminal process management
+state_store = StateStore(os.path.join(STATE_DIR, 'containers.db'))
+TERMINAL_IDLE_TIMEOUT = 900  # Seconds before an untouched terminal session is closed
+terminal_sessions = PtySessionManager(lxc.attach_command, idle_timeout=TERMINAL_IDLE_TIMEOUT)
+
+# Provisioning jobs, persisted so queued work survives a daemon restart
+JOBS_FILE = os.path.join(STATE_DIR, 'jobs.json')
+PROVISION_WORKERS = 2  # Containers built concurrently on this node
+JOB_RETENTION = 24 * 3600  # Seconds finished jobs are kept for the panel to read
+provisioning_jobs = {}
+jobs_lock = Lock()
+provisioning_pool = ThreadPoolExecutor(max_workers=PROVISION_WORKERS)
+
+# Plan limits (RAM, swap, CPU, cpuset, I/O, pids, disk quota), written straight to configs and cgroupfs
+resource_limiter = ResourceLimiter(lxc.lxc_path)
+container_limits = {}  # Name -> limits last applied, including the container's disk project id
+
+# Golden images new containers are cloned from instead of running the template each time
+DEFAULT_DISTRO = 'ubuntu'
+IMAGE_CACHE_REFRESH_INTERVAL = 3600  # Seconds between golden image maintenance passes
+image_cache = ImageCache(os.path.join(STATE_DIR, 'image_cache.json'), lxc, distros=[DEFAULT_DISTRO])
+# Provisioning durations in seconds, split by whether the container was cloned or built from the template
+provisioning_times = {method: {'count': 0, 'total': 0.0, 'max': 0.0, 'last': 0.0} for method in ('clone', 'template')}
+provisioning_times_lock = Lock()
+
+# Moving containers to other nodes: the source pushes a compressed archive in resumable chunks
+TRANSFERS_DIR = os.path.join(STATE_DIR, 'transfers')
+MIGRATION_WORKERS = 1  # Outgoing migrations at once, so they queue rather than share the uplink
+MIGRATION_RATE_LIMIT = int(os.environ.get('MIGRATION_RATE_LIMIT', 50 * 1024 ** 2))  # Bytes/second per migration, 0 = unlimited
+MIGRATION_RETRIES = 5  # Times a transfer is resumed after a network error before the job fails
+TRANSFER_COMPLETE_TIMEOUT = 1800  # Seconds the target may take to verify and unpack an archive
+TRANSFER_POLL_INTERVAL = 10  # Seconds between asking the target how a restore went when /complete got no answer
+migration_pool = ThreadPoolExecutor(max_workers=MIGRATION_WORKERS)
+incoming_transfers = IncomingTransfers(os.path.join(TRANSFERS_DIR, 'incoming'))
+busy_containers = {}  # Name -> what is being done to it (migrated, restored); start/delete are refused meanwhile
+restoring_transfers = set()  # Incoming transfers being unpacked right now
+restoring_transfers_lock = Lock()
+
+# Incremental, deduplicated backups of container root filesystems
+BACKUP_TARGET = os.environ.get('BACKUP_TARGET', 'local:' + os.path.join(STATE_DIR, 'backups'))  # local:/path or module:Class:arg
+BACKUP_INTERVAL = int(os.environ.get('BACKUP_INTERVAL', 0))  # Seconds between automatic backups of every container, 0 = off
+BACKUP_IO_RATE = int(os.environ.get('BACKUP_IO_RATE', 20 * 1024 ** 2))  # Bytes/second a backup reads or a restore writes
+BACKUP_KEEP_LAST = max(1, int(os.environ.get('BACKUP_KEEP_LAST', 7)))  # Most recent backups kept per container
+BACKUP_KEEP_WEEKLY = int(os.environ.get('BACKUP_KEEP_WEEKLY', 4))  # Plus the newest backup of each of this many weeks
+BACKUP_ID_RE = re.compile(r'^\d{8}T\d{6}Z$')
+backup_pool = ThreadPoolExecutor(max_workers=1)  # Backups and restores run one at a time, they share the disk
+backup_lock = Lock()  # Held while a backup writes chunks and manifests, so garbage collection never sees half a backup
+backup_engine = BackupEngine(make_target(BACKUP_TARGET), limiter=RateLimiter(BACKUP_IO_RATE))
+
+# Bulk start/stop/delete
+BATCH_MAX_CONCURRENCY = 8  # lxc-* commands run at once across all batch requests
+batch_semaphore = BoundedSemaphore(BATCH_MAX_CONCURRENCY)
+
+# Per-container usage read from cgroupfs
+METRICS_INTERVAL = 10  # Seconds between samples
+METRICS_RAW_SAMPLES = 360  # Raw samples kept per container (an hour at the default interval)
+
+
+def running_containers():
+    with status_lock:
+        return [name for name, state in container_statuses.items() if state == 'RUNNING']
+
+
+metrics_collector = MetricsCollector(running_containers, interval=METRICS_INTERVAL, raw_size=METRICS_RAW_SAMPLES)
+
+# Freezing idle containers (plans opt in with an idle_policy) so a node can hold more than fits awake
+IDLE_CHECK_INTERVAL = 30  # Seconds between CPU/network measurements of running containers
+IDLE_WAKE_INTERVAL = 2  # Seconds between checks for traffic to frozen containers
+
+# Subscribers to the /events stream, normally one per panel worker
+EVENT_QUEUE_SIZE = 1000  # Undelivered events buffered per subscriber before it is dropped
+EVENT_HEARTBEAT_INTERVAL = 15  # Seconds between keep-alive lines on an idle stream
+event_subscribers = set()
+event_subscribers_lock = Lock()
+
+STATE_RESYNC_INTERVAL = 60  # Seconds between full lxc-ls sweeps backing up the event stream
+MONITOR_RESTART_DELAY = 2  # Seconds to wait before restarting a dead lxc-monitor
+MONITOR_EVENT_RE = re.compile(r"'(?P<name>[^']+)' changed state to \[(?P<state>[A-Z]+)\]")
+
+
+class EventSubscriber:
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=EVENT_QUEUE_SIZE)
+        self.dropped = False  # Set when the subscriber fell behind and must reconnect to resync
+
+
+def publish_event(container_name, state):
+    """Push a state change to every connected /events stream."""
+    event = {'type': 'state', 'name': container_name, 'state': state, 'time': time.time()}
+    with event_subscribers_lock:
+        subscribers = list(event_subscribers)
+    for subscriber in subscribers:
+        try:
+            subscriber.queue.put_nowait(event)
+        except queue.Full:
+            subscriber.dropped = True
+            with event_subscribers_lock:
+                event_subscribers.discard(subscriber)
+
+
+def set_container_status(container_name, state):
+    """Record a state transition for a container this daemon manages."""
+    with status_lock:
+        if container_statuses.get(container_name, state) == state:
+            return
+        container_statuses[container_name] = state
+    state_store.upsert(container_name, state=state)
+    publish_event(container_name, state)
+
+
+def add_container(container_name, state, idle_policy=None, limits=None, **fields):
+    """Start managing a container, e.g. once it has been provisioned."""
+    with status_lock:
+        container_statuses[container_name] = state
+        container_limits[container_name] = limits
+    state_store.upsert(container_name, state=state, idle_policy=json.dumps(idle_policy) if idle_policy else None,
+                       limits=json.dumps(limits) if limits else None, **fields)
+    idle_freezer.set_policy(container_name, idle_policy)
+    publish_event(container_name, state)
+
+
+def remove_container(container_name):
+    with status_lock:
+        container_statuses.pop(container_name, None)
+        container_limits.pop(container_name, None)
+    state_store.delete(container_name)
+    idle_freezer.forget(container_name)
+    publish_event(container_name, 'DELETED')
+
 
-def update_container_status():
-    """Function to periodically check the status of all containers."""
+def container_states():
+    with status_lock:
+        return dict(container_statuses)
+
+
+def freeze_idle(container_name):
+    """Freeze a container for the idle freezer. Returns False if it is in use or the freeze failed."""
+    if container_name in busy_containers:
+        return False
+    try:
+        lxc.run(['lxc-freeze', '-n', container_name])
+        set_container_status(container_name, 'FROZEN')
+        return True
+    except subprocess.CalledProcessError as e:
+        logging.error(f"Error freezing idle container {container_name}: {str(e)}")
+        return False
+
+
+def thaw(container_name):
+    """Unfreeze a container if it is frozen. Returns (success, message)."""
+    if container_statuses.get(container_name) != 'FROZEN':
+        return True, f'Container {container_name} is not frozen.'
+    try:
+        lxc.run(['lxc-unfreeze', '-n', container_name])
+        set_container_status(container_name, 'RUNNING')
+        idle_freezer.touch(container_name)
+        return True, f'Container {container_name} started successfully!'
+    except subprocess.CalledProcessError as e:
+        logging.error(f"Error thawing container {container_name}: {str(e)}")
+        return False, f'Failed to thaw the container: {str(e)}'
+
+
+idle_freezer = IdleFreezer(container_states, lambda: terminal_sessions.containers_in_use() | set(busy_containers),
+                           freeze_idle, thaw, interval=IDLE_CHECK_INTERVAL, wake_interval=IDLE_WAKE_INTERVAL)
+
+
+def restore_container_statuses():
+    """Reload managed containers after a restart and reconcile them with one lxc-ls call."""
+    stored = state_store.load()
+    try:
+        states = list_container_states()
+    except (subprocess.CalledProcessError, OSError) as e:
+        logging.error(f"Could not reconcile container state with lxc-ls: {str(e)}")
+        states = None
+
+    with status_lock:
+        for name, row in stored.items():
+            container_statuses[name] = row['state']
+            container_limits[name] = json.loads(row['limits']) if row['limits'] else None
+    for name, row in stored.items():
+        if row['idle_policy']:
+            idle_freezer.set_policy(name, json.loads(row['idle_policy']))
+    if states is None:
+        return
+
+    for name in stored:
+        if name in states:
+            set_container_status(name, states[name])
+        else:
+            logging.warning(f"Container {name} no longer exists, forgetting it")
+            remove_container(name)
+    state_store.flush()
+    logging.info(f"Restored {len(container_statuses)} containers from {state_store.path}")
+
+
+def list_container_states():
+    """Return {name: state} for every container on the host using a single lxc-ls call."""
+    output = lxc.output(['lxc-ls', '--fancy', '--fancy-format', 'NAME,STATE'])
+    states = {}
+    for line in output.splitlines()[1:]:  # Skip the header row
+        fields = line.split()
+        if len(fields) >= 2:
+            states[fields[0]] = fields[1]
+    return states
+
+
+def monitor_container_events():
+    """Follow lxc-monitor and apply state transitions as soon as LXC reports them."""
     while True:
-        with status_lock:
-            for container_name in container_statuses.keys():
-                try:
-                    output = subprocess.check_output(['lxc-info', '-n', container_name]).decode()
-                    if "RUNNING" in output:
-                        container_statuses[container_name] = 'RUNNING'
-                    elif "STOPPED" in output:
-                        container_statuses[container_name] = 'STOPPED'
-                    else:
-                        container_statuses[container_name] = 'UNKNOWN'
-                except subprocess.CalledProcessError:
-                    container_statuses[container_name] = 'UNKNOWN'
-        time.sleep(10)  # Check every 10 seconds
+        try:
+            for line in lxc.monitor():
+                match = MONITOR_EVENT_RE.search(line)
+                if match:
+                    set_container_status(match.group('name'), match.group('state'))
+            logging.warning("lxc-monitor exited, restarting")
+        except Exception as e:
+            logging.error(f"Error following lxc-monitor: {str(e)}")
+        time.sleep(MONITOR_RESTART_DELAY)
 
-@app.route('/create', methods=['POST'])
-def create_container():
-    data = request.json
-    instance_name = data.get('name')
-    ram = data.get('ram').replace("MB", "")  # Remove the 'MB' part for correct command usage
-    disk = data.get('disk')
-    node = data.get('node')
 
+def resync_container_statuses():
+    """Periodically reconcile with lxc-ls in case the event stream missed a transition."""
+    while True:
+        try:
+            states = list_container_states()
+            with status_lock:
+                names = list(container_statuses.keys())
+            for container_name in names:
+                set_container_status(container_name, states.get(container_name, 'UNKNOWN'))
+        except (subprocess.CalledProcessError, OSError) as e:
+            logging.error(f"Error listing containers: {str(e)}")
+        time.sleep(STATE_RESYNC_INTERVAL)
+
+def load_jobs():
+    """Load provisioning jobs saved by a previous run of the daemon."""
+    if not os.path.exists(JOBS_FILE):
+        return {}
     try:
-        # Create LXC container
-        subprocess.run(['lxc-create', '-n', instance_name, '-t', 'ubuntu'], check=True)
-        
-        # Set resource limits after container creation
-        subprocess.run(['lxc-cgroup', '-n', instance_name, 'memory.limit_in_bytes', f'{ram}M'], check=True)
+        with open(JOBS_FILE) as jobs_file:
+            return json.load(jobs_file)
+    except (OSError, ValueError) as e:
+        logging.error(f"Could not read {JOBS_FILE}: {str(e)}")
+        return {}
+
+
+def save_jobs():
+    """Write all jobs to disk atomically. Caller must hold jobs_lock."""
+    tmp_path = JOBS_FILE + '.tmp'
+    with open(tmp_path, 'w') as jobs_file:
+        json.dump(provisioning_jobs, jobs_file)
+    os.replace(tmp_path, JOBS_FILE)
+
+
+def prune_jobs(now):
+    """Forget finished jobs older than JOB_RETENTION. Caller must hold jobs_lock."""
+    for job_id, job in list(provisioning_jobs.items()):
+        if job['state'] in ('succeeded', 'failed') and now - job['updated_at'] > JOB_RETENTION:
+            del provisioning_jobs[job_id]
+
+
+def update_job(job_id, **fields):
+    with jobs_lock:
+        job = provisioning_jobs[job_id]
+        job.update(fields, updated_at=time.time())
+        save_jobs()
+        return dict(job)
+
+
+def with_project_id(container_name, limits):
+    """Return limits with the container's disk project id, allocating a free one the first time."""
+    with status_lock:
+        current = container_limits.get(container_name) or {}
+        project_id = current.get('project_id')
+        if not project_id:
+            used = [other.get('project_id') or 0 for other in container_limits.values() if other]
+            project_id = max(used + [PROJECT_ID_BASE - 1]) + 1
+        limits = dict(limits, project_id=project_id)
+        container_limits[container_name] = limits  # Claims the id before another job can pick it
+    return limits
+
+
+def job_limits(job):
+    """Limits for a new container. Older panels only send the plan's RAM and disk strings, e.g. '512MB'."""
+    if job.get('limits'):
+        return job['limits']
+    return {'ram_bytes': job.get('ram_bytes') or parse_size(job['ram']),
+            'disk_bytes': job.get('disk_bytes') or (parse_size(job['disk']) if job.get('disk') else None)}
+
+
+def apply_limits(container_name, limits):
+    """Apply limits to a container, logging the ones the host refused. Returns them."""
+    errors = resource_limiter.apply(container_name, limits)
+    if errors:
+        logging.warning(f"Limits not fully applied to {container_name}: {', '.join(errors)}")
+    return errors
+
+
+def run_provisioning_job(job_id):
+    """Run the lxc-create and resource limit steps for a queued job on a worker thread."""
+    with jobs_lock:
+        job = dict(provisioning_jobs[job_id])
+    instance_name = job['name']
+    distro = job.get('distro', DEFAULT_DISTRO)
+
+    try:
+        exists = instance_name in list_container_states()
+        # Only a job interrupted by a restart after it started creating may find its own container there
+        if exists and not (job.get('resumed') and job['state'] == 'running'):
+            update_job(job_id, state='failed', message=f'Container {instance_name} already exists.')
+            return
+        if not exists:
+            update_job(job_id, state='running', progress=10, message='Creating container')
+            started = time.monotonic()
+            if image_cache.clone(distro, instance_name):
+                method = 'clone'
+            else:
+                method = 'template'
+                lxc.run(['lxc-create', '-n', instance_name, '-t', distro])
+            record_provisioning_time(method, time.monotonic() - started)
+
+        update_job(job_id, state='running', progress=80, message='Applying resource limits')
+        limits = with_project_id(instance_name, job_limits(job))
+        apply_limits(instance_name, limits)
 
         # Initialize the container status
-        with status_lock:
-            container_statuses[instance_name] = 'STOPPED'
+        add_container(instance_name, 'STOPPED', ram_bytes=limits.get('ram_bytes'), disk_bytes=limits.get('disk_bytes'),
+                      distro=distro, idle_policy=job.get('idle_policy'), limits=limits)
 
-        return jsonify({'status': 'success', 'message': f'Container {instance_name} created successfully!'}), 201
+        update_job(job_id, state='succeeded', progress=100, message=f'Container {instance_name} created successfully!')
     except subprocess.CalledProcessError as e:
         logging.error(f"Error creating container: {str(e)}")
-        return jsonify({'status': 'error', 'message': str(e)}), 500
+        update_job(job_id, state='failed', message=str(e))
     except Exception as e:
         logging.error(f"Unexpected error: {str(e)}")
-        return jsonify({'status': 'error', 'message': 'An unexpected error occurred: ' + str(e)}), 500
+        update_job(job_id, state='failed', message='An unexpected error occurred: ' + str(e))
+
+
+def record_provisioning_time(method, duration):
+    with provisioning_times_lock:
+        times = provisioning_times[method]
+        times['count'] += 1
+        times['total'] += duration
+        times['max'] = max(times['max'], duration)
+        times['last'] = duration
+
+
+def resume_provisioning_jobs():
+    """Requeue jobs that were queued or running when the daemon last stopped."""
+    with jobs_lock:
+        provisioning_jobs.update(load_jobs())
+        pending = [(job_id, job.get('kind', 'create')) for job_id, job in provisioning_jobs.items()
+                   if job['state'] in ('queued', 'running')]
+        for job_id, _ in pending:
+            provisioning_jobs[job_id]['resumed'] = True
+    runners = {
+        'create': (provisioning_pool, run_provisioning_job),
+        'migrate': (migration_pool, run_migration_job),
+        'backup': (backup_pool, run_backup_job),
+        'restore': (backup_pool, run_restore_job),
+    }
+    for job_id, kind in pending:
+        logging.info(f"Resuming {kind} job {job_id}")
+        pool, runner = runners[kind]
+        pool.submit(runner, job_id)
+
+
+@app.route('/create', methods=['POST'])
+def create_container():
+    data = request.json
+    instance_name = data.get('name')
+    ram = data.get('ram')
+    disk = data.get('disk')
+    distro = data.get('distro', DEFAULT_DISTRO)
+
+    if not instance_name or not ram:
+        return jsonify({'status': 'error', 'message': 'Instance name and RAM are required.'}), 400
+
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    with jobs_lock:
+        prune_jobs(now)
+        provisioning_jobs[job_id] = {
+            'id': job_id,
+            'name': instance_name,
+            'ram': ram,
+            'disk': disk,
+            'ram_bytes': data.get('ram_bytes'),
+            'disk_bytes': data.get('disk_bytes'),
+            'distro': distro,
+            'idle_policy': data.get('idle_policy'),
+            'limits': data.get('limits'),
+            'state': 'queued',
+            'progress': 0,
+            'message': 'Waiting for a provisioning slot',
+            'created_at': now,
+            'updated_at': now,
+        }
+        save_jobs()
+    provisioning_pool.submit(run_provisioning_job, job_id)
+
+    return jsonify({'status': 'success', 'job_id': job_id, 'message': f'Container {instance_name} queued for creation.'}), 202
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    with jobs_lock:
+        job = provisioning_jobs.get(job_id)
+        if job is None:
+            return jsonify({'status': 'error', 'message': 'Job not found.'}), 404
+        return jsonify({'status': 'success', 'job': dict(job)}), 200
+
+@app.route('/provisioning/metrics', methods=['GET'])
+def provisioning_metrics():
+    with provisioning_times_lock:
+        times = {method: dict(stats) for method, stats in provisioning_times.items()}
+    for stats in times.values():
+        stats['average'] = stats['total'] / stats['count'] if stats['count'] else 0.0
+    return jsonify({'status': 'success', 'cache': image_cache.stats(), 'provisioning_times': times}), 200
+
+
+@app.route('/metrics/containers', methods=['GET'])
+def container_metrics():
+    """Usage samples for many containers in one reply.
+
+    Query parameters: names=a,b,c (defaults to every managed container),
+    resolution=raw|minute|hour and since=<unix timestamp>.
+    """
+    resolution = request.args.get('resolution', 'raw')
+    if resolution not in ('raw', 'minute', 'hour'):
+        return jsonify({'status': 'error', 'message': 'resolution must be raw, minute or hour.'}), 400
+    since = request.args.get('since', 0, type=int)
+
+    names = request.args.get('names')
+    if names is None:
+        with status_lock:
+            names = list(container_statuses.keys())
+    else:
+        names = [name for name in names.split(',') if name]
+
+    return jsonify({'status': 'success', 'fields': METRIC_FIELDS,
+                    'metrics': metrics_collector.query(names, resolution, since)}), 200
+
+
+def host_resources():
+    """Total and free RAM and container disk on this host, in bytes."""
+    meminfo = {}
+    with open('/proc/meminfo') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            meminfo[key] = int(value.split()[0]) * 1024  # Values are in kB
+    disk = os.statvfs(lxc.lxc_path)
+    return {
+        'ram_total': meminfo['MemTotal'],
+        'ram_free': meminfo.get('MemAvailable', meminfo['MemFree']),
+        'disk_total': disk.f_blocks * disk.f_frsize,
+        'disk_free': disk.f_bavail * disk.f_frsize,
+    }
+
+
+@app.route('/resources', methods=['GET'])
+def resources():
+    return jsonify({'status': 'success', 'resources': host_resources()}), 200
+
+
+@app.route('/health', methods=['GET'])
+def health():
+    # Cheap enough to be probed every few seconds: /proc reads, a statvfs and a dict count
+    load_1, load_5, load_15 = os.getloadavg()
+    with status_lock:
+        containers = len(container_statuses)
+        running = sum(1 for state in container_statuses.values() if state == 'RUNNING')
+        frozen = sum(1 for state in container_statuses.values() if state == 'FROZEN')
+    report = dict(host_resources(), load=[load_1, load_5, load_15], cpus=os.cpu_count(),
+                  containers=containers, running=running, frozen=frozen)
+    return jsonify({'status': 'success', 'health': report}), 200
+
 
 @app.route('/status', methods=['GET'])
 def container_status():
     instance_name = request.args.get('name')
-    
+    instance_names = request.args.get('names')
+
+    # Bulk lookup: /status?names=a,b,c returns every requested container in one reply
+    if instance_names is not None:
+        names = [name for name in instance_names.split(',') if name]
+        with status_lock:
+            statuses = {name: container_statuses.get(name, 'UNKNOWN') for name in names}
+        return jsonify({'status': 'success', 'instance_statuses': statuses}), 200
+
     if not instance_name:
         return jsonify({'status': 'error', 'message': 'Instance name is required.'}), 400
 
@@ -80,94 +568,727 @@ def container_status():
         logging.error(f"Error fetching status: {str(e)}")
         return jsonify({'status': 'error', 'message': 'An unexpected error occurred: ' + str(e)}), 500
 
-@app.route('/start', methods=['POST'])
-def start_container():
-    data = request.json
-    instance_name = data.get('name')
+@app.route('/events', methods=['GET'])
+def container_events():
+    """Long-lived NDJSON stream of state changes.
+
+    The first line is a snapshot of every managed container, then one line per
+    change. Empty lines are sent as heartbeats. A subscriber that falls too far
+    behind is disconnected and should reconnect to get a fresh snapshot.
+    """
+    subscriber = EventSubscriber()
+    with event_subscribers_lock:
+        event_subscribers.add(subscriber)
+    # Subscribe before taking the snapshot so no change can fall between the two
+    with status_lock:
+        snapshot = dict(container_statuses)
+
+    def generate():
+        try:
+            yield json.dumps({'type': 'snapshot', 'statuses': snapshot}) + '\n'
+            while not subscriber.dropped:
+                try:
+                    event = subscriber.queue.get(timeout=EVENT_HEARTBEAT_INTERVAL)
+                except queue.Empty:
+                    yield '\n'
+                    continue
+                yield json.dumps(event) + '\n'
+        finally:
+            with event_subscribers_lock:
+                event_subscribers.discard(subscriber)
+
+    return Response(generate(), content_type='application/x-ndjson')
+
 
+def start_one(instance_name):
+    """Start a container. Returns (success, message)."""
+    if instance_name in busy_containers:
+        return False, f'Container {instance_name} is {busy_containers[instance_name]}.'
+    if container_statuses.get(instance_name) == 'FROZEN':
+        return thaw(instance_name)
     try:
-        subprocess.run(['lxc-start', '-n', instance_name], check=True)
-        with status_lock:
-            container_statuses[instance_name] = 'RUNNING'
-        return jsonify({'status': 'success', 'message': f'Container {instance_name} started successfully!'}), 200
+        lxc.run(['lxc-start', '-n', instance_name])
+        set_container_status(instance_name, 'RUNNING')
+        return True, f'Container {instance_name} started successfully!'
     except subprocess.CalledProcessError as e:
         logging.error(f"Error starting container: {str(e)}")
-        return jsonify({'status': 'error', 'message': str(e)}), 500
-
-@app.route('/stop', methods=['POST'])
-def stop_container():
-    data = request.json
-    instance_name = data.get('name')
+        return False, str(e)
 
-    current_status = container_statuses.get(instance_name)
 
-    if current_status == 'STOPPED':
-        return jsonify({'status': 'success', 'message': f'Container {instance_name} is already stopped.'}), 200
+def stop_one(instance_name):
+    """Stop a container. Returns (success, message)."""
+    if instance_name in busy_containers:
+        return False, f'Container {instance_name} is {busy_containers[instance_name]}.'
+    if container_statuses.get(instance_name) == 'STOPPED':
+        return True, f'Container {instance_name} is already stopped.'
 
     try:
-        subprocess.run(['lxc-stop', '-n', instance_name], check=True)
-        with status_lock:
-            container_statuses[instance_name] = 'STOPPED'
-        return jsonify({'status': 'success', 'message': f'Container {instance_name} stopped successfully!'}), 200
+        if container_statuses.get(instance_name) == 'FROZEN':
+            lxc.run(['lxc-unfreeze', '-n', instance_name])  # Frozen processes can't handle the shutdown signal
+        lxc.run(['lxc-stop', '-n', instance_name])
+        set_container_status(instance_name, 'STOPPED')
+        return True, f'Container {instance_name} stopped successfully!'
     except subprocess.CalledProcessError as e:
         logging.error(f"Error stopping container {instance_name}: {str(e)}")
-        return jsonify({'status': 'error', 'message': f'Failed to stop the container: {str(e)}'}), 500
+        return False, f'Failed to stop the container: {str(e)}'
+
+
+def delete_one(instance_name):
+    """Destroy a container. Returns (success, message)."""
+    if instance_name in busy_containers:
+        return False, f'Container {instance_name} is {busy_containers[instance_name]}.'
+    try:
+        terminal_sessions.close_container(instance_name)
+        lxc.run(['lxc-destroy', '-n', instance_name])
+        remove_container(instance_name)
+        metrics_collector.forget(instance_name)
+        return True, f'Container {instance_name} deleted successfully!'
+    except subprocess.CalledProcessError as e:
+        logging.error(f"Error deleting container: {str(e)}")
+        return False, str(e)
+
+
+CONTAINER_ACTIONS = {'start': start_one, 'stop': stop_one, 'delete': delete_one}
+
+
+@app.route('/start', methods=['POST'])
+def start_container():
+    success, message = start_one(request.json.get('name'))
+    return jsonify({'status': 'success' if success else 'error', 'message': message}), 200 if success else 500
+
+
+@app.route('/stop', methods=['POST'])
+def stop_container():
+    success, message = stop_one(request.json.get('name'))
+    return jsonify({'status': 'success' if success else 'error', 'message': message}), 200 if success else 500
+
 
 @app.route('/delete', methods=['POST'])
 def delete_container():
-    data = request.json
+    success, message = delete_one(request.json.get('name'))
+    return jsonify({'status': 'success' if success else 'error', 'message': message}), 200 if success else 500
+
+
+def require_node_secret(view):
+    """Only let the panel and other nodes (requests carrying NODE_SECRET in X-Node-Token) reach a route."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not NODE_SECRET:
+            return jsonify({'status': 'error', 'message': 'NODE_SECRET is not configured on this node.'}), 403
+        if not hmac.compare_digest(request.headers.get('X-Node-Token', ''), NODE_SECRET):
+            return jsonify({'status': 'error', 'message': 'Invalid node token.'}), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def run_limited(action, instance_name):
+    # The node-wide semaphore caps lxc-* commands across all concurrent batches
+    with batch_semaphore:
+        return action(instance_name)
+
+
+@app.route('/batch/<action>', methods=['POST'])
+@require_node_secret
+def batch_action(action):
+    """Run start/stop/delete on many containers and stream one JSON line per result.
+
+    Body: {"names": [...], "concurrency": N}. Results arrive in completion order.
+    """
+    if action not in CONTAINER_ACTIONS:
+        return jsonify({'status': 'error', 'message': f'Unknown action {action}.'}), 404
+    data = request.json or {}
+    names = data.get('names') or []
+    if not isinstance(names, list) or not names:
+        return jsonify({'status': 'error', 'message': 'A list of names is required.'}), 400
+    try:
+        concurrency = max(1, min(int(data.get('concurrency', BATCH_MAX_CONCURRENCY)), BATCH_MAX_CONCURRENCY))
+    except (TypeError, ValueError):
+        return jsonify({'status': 'error', 'message': 'concurrency must be a number.'}), 400
+
+    def generate():
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(names))) as executor:
+            futures = {executor.submit(run_limited, CONTAINER_ACTIONS[action], name): name for name in names}
+            for future in as_completed(futures):
+                success, message = future.result()
+                yield json.dumps({'name': futures[future], 'status': 'success' if success else 'error',
+                                  'message': message}) + '\n'
+
+    return Response(generate(), content_type='application/x-ndjson')
+
+
+def send_archive(job, archive_path):
+    """Push an archive to the target daemon, resuming from whatever it already has after each error."""
+    if job['target'] not in NODE_PEERS:
+        raise RuntimeError(f"{job['target']} is not one of this node's peers (NODE_PEERS).")
+    client = get_client(job['target'])
+    limiter = RateLimiter(job.get('rate_limit', MIGRATION_RATE_LIMIT))
+    announce = {key: job.get(key) for key in ('name', 'size', 'sha256', 'ram_bytes', 'disk_bytes', 'distro', 'idle_policy',
+                                              'limits', 'restore')}
+    for attempt in range(MIGRATION_RETRIES + 1):
+        try:
+            response = client.post('/transfers', json=dict(announce, id=job['id']))
+            if response.status_code != 200:
+                raise RuntimeError(response.json().get('message'))
+            offset = response.json()['offset']
+            for chunk_offset, data in read_chunks(archive_path, offset):
+                limiter.consume(len(data))
+                response = client.request('PUT', f"/transfers/{job['id']}", params={'offset': chunk_offset}, data=data)
+                if response.status_code != 200:
+                    raise requests.RequestException(f'Chunk at {chunk_offset} rejected: HTTP {response.status_code}')
+                sent = chunk_offset + len(data)
+                update_job(job['id'], progress=10 + int(85 * sent / max(job['size'], 1)),
+                           message=f"Sent {sent // 1024 ** 2} of {job['size'] // 1024 ** 2} MB")
+            return
+        except (requests.RequestException, NodeUnavailable) as e:
+            if attempt == MIGRATION_RETRIES:
+                raise
+            logging.warning(f"Transfer of {job['name']} to {job['target']} interrupted, resuming: {str(e)}")
+            time.sleep(min(2 ** attempt, 30))
+
+
+class TransferOutcomeUnknown(Exception):
+    """The target could not be asked whether it restored a container, so it may be running there already."""
+
+
+def finish_transfer(job):
+    """Have the target restore a fully sent archive.
+
+    Raises RuntimeError when the target did not restore it, so the container can be brought
+    back here, and TransferOutcomeUnknown when the target stopped answering before saying.
+    """
+    client = get_client(job['target'])
+    path = f"/transfers/{job['id']}"
+    try:
+        response = client.post(f'{path}/complete', timeout=TRANSFER_COMPLETE_TIMEOUT)
+        if response.status_code == 200:
+            return
+        if response.json().get('state') != 'restoring':
+            raise RuntimeError(response.json().get('message'))
+    except (requests.RequestException, NodeUnavailable) as e:
+        logging.warning(f"No answer from {job['target']} restoring {job['name']}, asking how it went: {str(e)}")
+
+    # The target may still be unpacking, or may have finished and the reply got lost
+    deadline = time.monotonic() + TRANSFER_COMPLETE_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(TRANSFER_POLL_INTERVAL)
+        try:
+            response = client.get(path)
+        except (requests.RequestException, NodeUnavailable):
+            continue
+        state = response.json().get('state') if response.status_code == 200 else None
+        if state == 'completed':
+            return
+        if state != 'restoring':
+            raise RuntimeError(f"{job['target']} did not restore the container: {response.json().get('message') or state}")
+    raise TransferOutcomeUnknown(f"{job['target']} stopped answering while restoring {job['name']}")
+
+
+def run_migration_job(job_id):
+    """Move a container to another node: stop or checkpoint it, archive it, push the archive, restore it there.
+
+    The container is left stopped on this node; the panel deletes it once the instance points at the target.
+    Steps already done before a daemon restart (stopping, archiving, chunks sent) are not repeated.
+    """
+    with jobs_lock:
+        job = dict(provisioning_jobs[job_id])
+    instance_name = job['name']
+    container_dir = os.path.join(lxc.lxc_path, instance_name)
+    checkpoint_dir = os.path.join(container_dir, 'checkpoint')
+    archive_path = os.path.join(TRANSFERS_DIR, f'{job_id}.tar.gz')
+    busy_containers[instance_name] = 'being migrated'
+    try:
+        # An overlay clone is sent flattened: the image it reads through to only exists on this node
+        lower, writable = rootfs_layers(lxc.lxc_path, instance_name)
+        if 'restore' not in job:
+            thaw(instance_name)  # A frozen container moves like a running one and is thawed on arrival
+            # What the target should do once it has the container, decided before anything is stopped
+            was_running = container_statuses.get(instance_name) == 'RUNNING'
+            # A checkpoint records the overlay mount, which the flattened copy no longer has
+            live = bool(job.get('live') and was_running and not lower and shutil.which('criu'))
+            job = update_job(job_id, restore='checkpoint' if live else 'start' if was_running else None)
+
+        if not job.get('sha256') or not os.path.exists(archive_path):
+            if job['restore'] == 'checkpoint':
+                update_job(job_id, state='running', progress=5, message='Checkpointing container')
+                lxc.run(['lxc-checkpoint', '-s', '-n', instance_name, '-D', checkpoint_dir])
+            elif container_statuses.get(instance_name) == 'RUNNING':
+                update_job(job_id, state='running', progress=5, message='Stopping container')
+                lxc.run(['lxc-stop', '-n', instance_name])
+            set_container_status(instance_name, 'STOPPED')
+
+            update_job(job_id, state='running', progress=8, message='Compressing container')
+            os.makedirs(TRANSFERS_DIR, exist_ok=True)
+            sha256 = build_archive(container_dir, archive_path, overlay=(lower, writable) if lower else None)
+            job = update_job(job_id, sha256=sha256, size=os.path.getsize(archive_path))
+
+        update_job(job_id, state='running', progress=10, message='Sending container')
+        send_archive(job, archive_path)
+
+        update_job(job_id, state='running', progress=95, message='Restoring container on the target node')
+        finish_transfer(job)
+
+        os.remove(archive_path)
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
+        update_job(job_id, state='succeeded', progress=100,
+                   message=f"Container {instance_name} migrated to {job['target']}.")
+    except TransferOutcomeUnknown as e:
+        # Starting it here could leave two copies running; it stays stopped until someone checks the target
+        logging.error(f"Error migrating container {instance_name}: {str(e)}")
+        update_job(job_id, state='failed', message=f'Migration outcome unknown, {instance_name} was left stopped '
+                                                   f'here: {str(e)}')
+    except Exception as e:
+        logging.error(f"Error migrating container {instance_name}: {str(e)}")
+        update_job(job_id, state='failed', message=f'Migration failed: {str(e)}')
+        busy_containers.pop(instance_name, None)
+        # The container never left, so bring it back the way it was
+        if job.get('restore') == 'checkpoint' and os.path.isdir(checkpoint_dir):
+            restore_checkpoint(instance_name, checkpoint_dir)
+        elif job.get('restore'):
+            start_one(instance_name)
+    finally:
+        busy_containers.pop(instance_name, None)
+
+
+def restore_checkpoint(instance_name, checkpoint_dir):
+    try:
+        lxc.run(['lxc-checkpoint', '-r', '-n', instance_name, '-D', checkpoint_dir])
+        set_container_status(instance_name, 'RUNNING')
+    except subprocess.CalledProcessError as e:
+        logging.error(f"Error restoring checkpoint of {instance_name}, starting it cold: {str(e)}")
+        start_one(instance_name)
+    shutil.rmtree(checkpoint_dir, ignore_errors=True)
+
+
+@app.route('/limits', methods=['POST'])
+@require_node_secret
+def set_limits():
+    """Change a container's limits (and idle_policy, when given), e.g. after a plan change.
+
+    Running containers are resized in place.
+    """
+    data = request.json or {}
     instance_name = data.get('name')
+    limits = data.get('limits')
+    if not instance_name or not isinstance(limits, dict) or not limits.get('ram_bytes'):
+        return jsonify({'status': 'error', 'message': 'Instance name and limits with ram_bytes are required.'}), 400
+    if not isinstance(data.get('idle_policy') or {}, dict):
+        return jsonify({'status': 'error', 'message': 'idle_policy must be an object or null.'}), 400
+    with status_lock:
+        if instance_name not in container_statuses:
+            return jsonify({'status': 'error', 'message': 'Instance not found.'}), 404
+    if instance_name in busy_containers:
+        return jsonify({'status': 'error', 'message': f'{instance_name} is {busy_containers[instance_name]}.'}), 409
 
+    limits = with_project_id(instance_name, {key: value for key, value in limits.items() if key != 'project_id'})
     try:
-        subprocess.run(['lxc-destroy', '-n', instance_name], check=True)
+        errors = apply_limits(instance_name, limits)
+    except OSError as e:
+        logging.error(f"Error applying limits to {instance_name}: {str(e)}")
+        return jsonify({'status': 'error', 'message': f'Failed to write the container config: {str(e)}'}), 500
+    fields = {}
+    if 'idle_policy' in data:
+        # The new plan's policy replaces the old one; null means the container is no longer frozen
+        idle_freezer.set_policy(instance_name, data['idle_policy'])
+        fields['idle_policy'] = json.dumps(data['idle_policy']) if data['idle_policy'] else None
+    state_store.upsert(instance_name, limits=json.dumps(limits), ram_bytes=limits.get('ram_bytes'),
+                       disk_bytes=limits.get('disk_bytes'), **fields)
+    # Refused values (e.g. RAM below what the container uses on cgroup v1) still take effect at the next start
+    return jsonify({'status': 'success', 'warnings': errors, 'message': f'Limits of {instance_name} updated.'}), 200
+
+
+@app.route('/migrate', methods=['POST'])
+@require_node_secret
+def migrate_container():
+    """Move a container to the daemon at `target`. Body: {"name", "target", "live", "rate_limit"}."""
+    data = request.json or {}
+    instance_name = data.get('name')
+    target = data.get('target')
+    if not instance_name or not target:
+        return jsonify({'status': 'error', 'message': 'Instance name and target are required.'}), 400
+    if target not in NODE_PEERS:
+        # The archive and NODE_SECRET go to the target, so only known daemons qualify
+        return jsonify({'status': 'error', 'message': f'{target} is not one of this node\'s peers (NODE_PEERS).'}), 403
+    with status_lock:
+        if instance_name not in container_statuses:
+            return jsonify({'status': 'error', 'message': 'Instance not found.'}), 404
+    if instance_name in busy_containers:
+        return jsonify({'status': 'error', 'message': f'{instance_name} is {busy_containers[instance_name]}.'}), 409
+
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    with status_lock:
+        limits = container_limits.get(instance_name)
+    stored = state_store.get(instance_name) or {}
+    with jobs_lock:
+        prune_jobs(now)
+        provisioning_jobs[job_id] = {
+            'id': job_id,
+            'kind': 'migrate',
+            'name': instance_name,
+            'target': target,
+            'live': bool(data.get('live')),
+            'rate_limit': int(data.get('rate_limit', MIGRATION_RATE_LIMIT)),
+            'ram_bytes': limits.get('ram_bytes') if limits else stored.get('ram_bytes'),
+            'disk_bytes': limits.get('disk_bytes') if limits else stored.get('disk_bytes'),
+            'distro': stored.get('distro'),
+            'idle_policy': idle_freezer.policy(instance_name),
+            'limits': limits,
+            'state': 'queued',
+            'progress': 0,
+            'message': 'Waiting for a migration slot',
+            'created_at': now,
+            'updated_at': now,
+        }
+        save_jobs()
+    busy_containers[instance_name] = 'being migrated'
+    migration_pool.submit(run_migration_job, job_id)
+
+    return jsonify({'status': 'success', 'job_id': job_id, 'message': f'Migration of {instance_name} queued.'}), 202
+
+
+@app.route('/transfers', methods=['POST'])
+@require_node_secret
+def create_transfer():
+    """Announce (or rejoin) an incoming container transfer. Returns the offset to continue from."""
+    data = request.json or {}
+    transfer_id = str(data.get('id', ''))
+    instance_name = data.get('name')
+    if not transfer_id.isalnum() or not instance_name or not data.get('sha256') or data.get('size') is None:
+        return jsonify({'status': 'error', 'message': 'Transfer id, name, size and sha256 are required.'}), 400
+    if not CONTAINER_NAME_RE.match(str(instance_name)):
+        return jsonify({'status': 'error', 'message': 'Invalid container name.'}), 400
+
+    meta = incoming_transfers.meta(transfer_id)
+    if meta is None:
         with status_lock:
-            container_statuses.pop(instance_name, None)
-            # Clean up terminal process if it exists
-            with terminal_process_lock:
-                terminal_processes.pop(instance_name, None)
-        return jsonify({'status': 'success', 'message': f'Container {instance_name} deleted successfully!'}), 200
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Error deleting container: {str(e)}")
-        return jsonify({'status': 'error', 'message': str(e)}), 500
+            exists = instance_name in container_statuses
+        if exists or os.path.exists(os.path.join(lxc.lxc_path, instance_name)):
+            return jsonify({'status': 'error', 'message': f'{instance_name} already exists on this node.'}), 409
+    elif meta.get('completed'):
+        return jsonify({'status': 'success', 'offset': meta['size']}), 200
+    offset = incoming_transfers.create(transfer_id, data)
+    return jsonify({'status': 'success', 'offset': offset}), 200
+
+
+@app.route('/transfers/<transfer_id>', methods=['GET', 'PUT'])
+@require_node_secret
+def transfer_chunk(transfer_id):
+    """GET the transfer's state and received offset, or PUT the chunk that starts at ?offset=N."""
+    try:
+        meta = incoming_transfers.meta(transfer_id)
+        current = incoming_transfers.offset(transfer_id)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    if meta is None:
+        return jsonify({'status': 'error', 'message': 'Transfer not found.'}), 404
+    if request.method == 'GET':
+        with restoring_transfers_lock:
+            restoring = transfer_id in restoring_transfers
+        state = 'completed' if meta.get('completed') else 'restoring' if restoring else 'receiving'
+        return jsonify({'status': 'success', 'state': state, 'offset': meta['size'] if current is None else current}), 200
+    if current is None:
+        return jsonify({'status': 'error', 'message': 'Transfer already completed.'}), 409
+
+    offset = request.args.get('offset', type=int)
+    if offset is None:
+        return jsonify({'status': 'error', 'message': 'An integer ?offset= is required.'}), 400
+    length = request.content_length or 0
+    new_offset = incoming_transfers.append(transfer_id, offset, request.stream, length)
+    if new_offset != offset + length:
+        return jsonify({'status': 'error', 'message': 'Offset mismatch, resume from the returned offset.',
+                        'offset': new_offset}), 409
+    return jsonify({'status': 'success', 'offset': new_offset}), 200
+
+
+@app.route('/transfers/<transfer_id>/complete', methods=['POST'])
+@require_node_secret
+def complete_transfer(transfer_id):
+    """Verify a fully received archive, unpack it and start managing the container."""
+    try:
+        meta = incoming_transfers.meta(transfer_id)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    if meta is None:
+        return jsonify({'status': 'error', 'message': 'Transfer not found.'}), 404
+    instance_name = meta['name']
+    if meta.get('completed'):
+        return jsonify({'status': 'success', 'message': f'Container {instance_name} already restored.'}), 200
+    with restoring_transfers_lock:
+        if transfer_id in restoring_transfers:
+            return jsonify({'status': 'error', 'state': 'restoring',
+                            'message': f'Container {instance_name} is still being restored.'}), 409
+        restoring_transfers.add(transfer_id)
+    try:
+        return restore_transfer(transfer_id, meta)
+    finally:
+        with restoring_transfers_lock:
+            restoring_transfers.discard(transfer_id)
+
+
+def restore_transfer(transfer_id, meta):
+    instance_name = meta['name']
+    if not incoming_transfers.verify(transfer_id):
+        return jsonify({'status': 'error', 'message': 'Archive is incomplete or corrupt.'}), 409
+    if os.path.lexists(os.path.join(lxc.lxc_path, instance_name)):
+        return jsonify({'status': 'error', 'message': f'{instance_name} already exists on this node.'}), 409
+
+    try:
+        extract_archive(incoming_transfers.archive_path(transfer_id), lxc.lxc_path, instance_name)
+        # Whatever the source used, the container arrives as a plain directory
+        set_rootfs_setting(lxc.lxc_path, instance_name, f"dir:{os.path.join(lxc.lxc_path, instance_name, 'rootfs')}")
+    except (OSError, ValueError, tarfile.TarError) as e:
+        logging.error(f"Error unpacking migrated container {instance_name}: {str(e)}")
+        shutil.rmtree(os.path.join(lxc.lxc_path, instance_name), ignore_errors=True)
+        return jsonify({'status': 'error', 'message': f'Failed to unpack the container: {str(e)}'}), 500
+
+    limits = None
+    if meta.get('limits'):
+        # Project ids are per filesystem, so the container gets one of this node's
+        limits = {key: value for key, value in meta['limits'].items() if key != 'project_id'}
+        limits = with_project_id(instance_name, limits)
+        try:
+            apply_limits(instance_name, limits)
+        except OSError as e:
+            logging.error(f"Error applying limits to migrated container {instance_name}: {str(e)}")
+    add_container(instance_name, 'STOPPED', ram_bytes=meta.get('ram_bytes'), disk_bytes=meta.get('disk_bytes'),
+                  distro=meta.get('distro'), idle_policy=meta.get('idle_policy'), limits=limits)
+    incoming_transfers.mark_complete(transfer_id)
+
+    checkpoint_dir = os.path.join(lxc.lxc_path, instance_name, 'checkpoint')
+    if meta.get('restore') == 'checkpoint':
+        restore_checkpoint(instance_name, checkpoint_dir)
+    elif meta.get('restore') == 'start':
+        start_one(instance_name)
+    return jsonify({'status': 'success', 'message': f'Container {instance_name} restored.'}), 200
+
+
+def queue_job(kind, pool, runner, instance_name, **fields):
+    """Record a job for a container and hand it to a worker pool. Returns the job id."""
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    with jobs_lock:
+        prune_jobs(now)
+        provisioning_jobs[job_id] = dict(fields, id=job_id, kind=kind, name=instance_name, state='queued', progress=0,
+                                         message='Waiting for a worker', created_at=now, updated_at=now)
+        save_jobs()
+    pool.submit(runner, job_id)
+    return job_id
+
+
+@contextmanager
+def frozen(instance_name):
+    """Keep a container frozen for the duration, e.g. for the last pass of a backup, and thaw it after."""
+    busy_containers.setdefault(instance_name, 'being backed up')  # Keeps the idle freezer from thawing it
+    froze = False
+    try:
+        if container_statuses.get(instance_name) == 'RUNNING':
+            lxc.run(['lxc-freeze', '-n', instance_name])
+            set_container_status(instance_name, 'FROZEN')
+            froze = True
+        yield
+    finally:
+        if busy_containers.get(instance_name) == 'being backed up':
+            busy_containers.pop(instance_name, None)
+        if froze:
+            thaw(instance_name)
+
 
-def generate_output(instance_name):
-    """Generator to stream the terminal output."""
-    process = terminal_processes[instance_name]
+def run_backup_job(job_id):
+    """Back up a container's own files (the upper layer of an overlay clone).
+
+    A running container is read live, then frozen while the files that changed meanwhile are
+    read again, so the backup is consistent without copying the whole container first.
+    """
+    with jobs_lock:
+        job = dict(provisioning_jobs[job_id])
+    instance_name = job['name']
+    try:
+        _, writable = rootfs_layers(lxc.lxc_path, instance_name)
+        running = container_statuses.get(instance_name) == 'RUNNING'
+        update_job(job_id, state='running', progress=10, message='Backing up changed files')
+        with backup_lock:
+            backup_id, stats = backup_engine.backup(
+                instance_name, writable,
+                progress=lambda stats: update_job(job_id, message=f"Read {stats['read_bytes'] // 1024 ** 2} MB, "
+                                                                  f"stored {stats['stored_bytes'] // 1024 ** 2} MB"),
+                quiesce=(lambda: frozen(instance_name)) if running else None)
+
+            # Chunks only the pruned backups used are left for collect_backup_garbage
+            update_job(job_id, state='running', progress=90, message='Applying retention policy')
+            backup_engine.prune(instance_name, BACKUP_KEEP_LAST, BACKUP_KEEP_WEEKLY)
+        update_job(job_id, state='succeeded', progress=100, backup_id=backup_id, stats=stats,
+                   message=f"Backup {backup_id} of {instance_name} finished: {stats['read_bytes'] // 1024 ** 2} MB read, "
+                           f"{stats['stored_bytes'] // 1024 ** 2} MB new.")
+    except Exception as e:
+        logging.error(f"Error backing up container {instance_name}: {str(e)}")
+        update_job(job_id, state='failed', message=f'Backup failed: {str(e)}')
+
+
+def run_restore_job(job_id):
+    """Replace a container's files with a backup, stopping it meanwhile and starting it again if it was running.
+
+    The backup goes back where it was taken from: the rootfs, or an overlay clone's upper layer.
+    """
+    with jobs_lock:
+        job = dict(provisioning_jobs[job_id])
+    instance_name = job['name']
+    busy_containers[instance_name] = 'being restored'
+    staging = None
+    try:
+        _, rootfs = rootfs_layers(lxc.lxc_path, instance_name)
+        staging = rootfs + '.restore'
+        thaw(instance_name)
+        if 'was_running' not in job:
+            job = update_job(job_id, was_running=container_statuses.get(instance_name) == 'RUNNING')
+        if container_statuses.get(instance_name) == 'RUNNING':
+            update_job(job_id, state='running', progress=5, message='Stopping container')
+            lxc.run(['lxc-stop', '-n', instance_name])
+            set_container_status(instance_name, 'STOPPED')
+
+        update_job(job_id, state='running', progress=10, message='Restoring files')
+        shutil.rmtree(staging, ignore_errors=True)  # Left over from an interrupted restore
+        backup_engine.restore(instance_name, job['backup_id'], staging,
+                              progress=lambda done, total: update_job(job_id, progress=10 + int(85 * done / total)))
+        # Swap the restored tree in only once it is complete
+        old = rootfs + '.old'
+        if os.path.exists(rootfs):
+            os.rename(rootfs, old)
+        os.rename(staging, rootfs)
+        shutil.rmtree(old, ignore_errors=True)
+        if container_limits.get(instance_name):
+            apply_limits(instance_name, container_limits[instance_name])  # Tag the restored files for the disk quota
+        update_job(job_id, state='succeeded', progress=100,
+                   message=f"Container {instance_name} restored from backup {job['backup_id']}.")
+    except Exception as e:
+        logging.error(f"Error restoring container {instance_name}: {str(e)}")
+        if staging:
+            shutil.rmtree(staging, ignore_errors=True)
+        update_job(job_id, state='failed', message=f'Restore failed: {str(e)}')
+    finally:
+        busy_containers.pop(instance_name, None)
+        if job.get('was_running'):
+            start_one(instance_name)
+
+
+def collect_backup_garbage():
+    """Delete chunks no backup refers to any more. Reads every manifest, so it runs once per backup cycle."""
+    try:
+        with backup_lock:
+            removed = backup_engine.collect_garbage()
+        if removed:
+            logging.info(f"Deleted {removed} unreferenced backup chunks")
+    except Exception as e:
+        logging.error(f"Error collecting backup garbage: {str(e)}")
+
+
+def backup_forever():
+    """Queue a backup of every managed container each BACKUP_INTERVAL seconds, then clean up after them."""
     while True:
-        output = process.stdout.readline()  # Read output line by line
-        if output:
-            yield f"data: {output}\n\n"  # Format for server-sent events
-        if process.poll() is not None:  # Check if the process has terminated
-            break
-        time.sleep(0.1)  # Small delay to prevent busy-waiting
-
-
-@app.route('/terminal/<instance_name>', methods=['POST'])
-def start_terminal(instance_name):
-    if instance_name not in container_statuses:
-        return jsonify({'status': 'error', 'message': 'Instance not found.'}), 404
-    
-    if container_statuses[instance_name] != 'RUNNING':
-        return jsonify({'status': 'error', 'message': 'Container must be running to access the terminal.'}), 400
-    
-    if instance_name not in terminal_processes:
-        # Start the terminal process with the correct container name
-        process = subprocess.Popen(
-            ['lxc-attach', '-n', instance_name, '--', 'bash'],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            stdin=subprocess.PIPE,
-            text=True,
-            bufsize=1,
-            universal_newlines=True
-        )
-        terminal_processes[instance_name] = process
-    
-    return Response(generate_output(instance_name), content_type='text/event-stream')
+        time.sleep(BACKUP_INTERVAL)
+        with status_lock:
+            names = list(container_statuses)
+        for instance_name in names:
+            if instance_name not in busy_containers:
+                queue_job('backup', backup_pool, run_backup_job, instance_name)
+        # The pool has one worker, so this runs once the backups queued above have all finished
+        backup_pool.submit(collect_backup_garbage)
+
+
+@app.route('/backups', methods=['POST'])
+def create_backup():
+    instance_name = (request.json or {}).get('name')
+    with status_lock:
+        if instance_name not in container_statuses:
+            return jsonify({'status': 'error', 'message': 'Instance not found.'}), 404
+    if instance_name in busy_containers:
+        return jsonify({'status': 'error', 'message': f'{instance_name} is {busy_containers[instance_name]}.'}), 409
+    job_id = queue_job('backup', backup_pool, run_backup_job, instance_name)
+    return jsonify({'status': 'success', 'job_id': job_id, 'message': f'Backup of {instance_name} queued.'}), 202
+
+
+@app.route('/backups/<instance_name>', methods=['GET'])
+def list_backups(instance_name):
+    with status_lock:
+        if instance_name not in container_statuses:
+            return jsonify({'status': 'error', 'message': 'Instance not found.'}), 404
+    try:
+        return jsonify({'status': 'success', 'backups': backup_engine.list(instance_name)}), 200
+    except (OSError, ValueError) as e:
+        return jsonify({'status': 'error', 'message': f'Could not read backups: {str(e)}'}), 500
+
+
+@app.route('/backups/<instance_name>/<backup_id>/restore', methods=['POST'])
+@require_node_secret
+def restore_backup(instance_name, backup_id):
+    with status_lock:
+        if instance_name not in container_statuses:
+            return jsonify({'status': 'error', 'message': 'Instance not found.'}), 404
+    if not BACKUP_ID_RE.match(backup_id) or backup_id not in backup_engine.target.list_backups(instance_name):
+        return jsonify({'status': 'error', 'message': 'Backup not found.'}), 404
+    if instance_name in busy_containers:
+        return jsonify({'status': 'error', 'message': f'{instance_name} is {busy_containers[instance_name]}.'}), 409
+    busy_containers[instance_name] = 'waiting to be restored'
+    job_id = queue_job('restore', backup_pool, run_restore_job, instance_name, backup_id=backup_id)
+    return jsonify({'status': 'success', 'job_id': job_id,
+                    'message': f'Restore of {instance_name} from {backup_id} queued.'}), 202
+
+
+@sock.route('/terminal/<instance_name>')
+def terminal(ws, instance_name):
+    """Interactive shell over a WebSocket.
+
+    The daemon sends raw pty output as binary frames. The browser sends JSON text
+    frames: {"type": "input", "data": "..."} or {"type": "resize", "rows": R, "cols": C}.
+    The panel signs ?token= for this instance (see node_client.sign_terminal_token).
+    """
+    if not check_terminal_token(NODE_SECRET, instance_name, request.args.get('token')):
+        ws.close(reason=1008, message='Invalid or expired terminal token.')
+        return
+    with status_lock:
+        status = container_statuses.get(instance_name)
+    if status is None:
+        ws.close(reason=1008, message='Instance not found.')
+        return
+    if status == 'FROZEN' and thaw(instance_name)[0]:
+        status = 'RUNNING'
+    if status != 'RUNNING':
+        ws.close(reason=1008, message='Container must be running to access the terminal.')
+        return
+
+    rows = request.args.get('rows', 24, type=int)
+    cols = request.args.get('cols', 80, type=int)
+    session = terminal_sessions.open(instance_name, on_output=ws.send, on_close=ws.close, rows=rows, cols=cols)
+    try:
+        while not session.closed:
+            message = ws.receive(timeout=1)
+            if message is None:
+                continue
+            try:
+                event = json.loads(message)
+            except ValueError:
+                continue
+            if event.get('type') == 'input':
+                terminal_sessions.write(session, event.get('data', '').encode())
+                idle_freezer.touch(instance_name)
+            elif event.get('type') == 'resize':
+                terminal_sessions.resize(session, int(event.get('rows', rows)), int(event.get('cols', cols)))
+    except ConnectionClosed:
+        pass
+    finally:
+        terminal_sessions.close(session)
 
 if __name__ == '__main__':
-    # Start the thread for checking container status
-    status_thread = Thread(target=update_container_status)
-    status_thread.daemon = True
-    status_thread.start()
-    app.run(host='0.0.0.0', port=8080)  # Bind to all interfaces
+    restore_container_statuses()
+    state_store.start()
+    resume_provisioning_jobs()
+    terminal_sessions.start()
+
+    # Start the threads tracking container state
+    for target in (monitor_container_events, resync_container_statuses):
+        Thread(target=target, daemon=True).start()
+    Thread(target=metrics_collector.run_forever, daemon=True).start()
+    Thread(target=idle_freezer.run_forever, daemon=True).start()
+    Thread(target=image_cache.refresh_forever, args=(IMAGE_CACHE_REFRESH_INTERVAL,), daemon=True).start()
+    if BACKUP_INTERVAL:
+        Thread(target=backup_forever, daemon=True).start()
+    app.run(host=DAEMON_HOST, port=DAEMON_PORT, threaded=True)
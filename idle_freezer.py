@@ -0,0 +1,215 @@
+import logging
+import os
+import time
+from threading import Lock
+
+from container_metrics import ContainerCgroup, cgroup_v2
+
+# Used for any field a plan's idle_policy leaves out
+DEFAULT_POLICY = {
+    'after': 1800,  # Seconds a container must stay idle before it is frozen
+    'cpu_percent': 2.0,  # At or below this CPU use (percent of one core) counts as idle
+    'net_bps': 2048,  # At or below this traffic in + out (bytes/second) counts as idle
+    'wake_bytes': 512,  # Bytes received while frozen that thaw the container; less is ARP and other noise
+    'reclaim': True,  # Push a frozen container's memory out to swap (cgroup v2 memory.reclaim) to make room
+}
+
+
+def normalize_policy(policy):
+    """Fill in defaults for a plan's idle_policy. None or false means the container is never frozen."""
+    if not policy:
+        return None
+    return dict(DEFAULT_POLICY, **policy)
+
+
+def read_net_bytes(pid):
+    """Return (received, sent) bytes over every non-loopback interface in the network namespace of `pid`."""
+    received = sent = 0
+    try:
+        with open(f'/proc/{pid}/net/dev') as f:
+            for line in f.readlines()[2:]:  # Two header lines
+                interface, _, counters = line.partition(':')
+                if interface.strip() == 'lo':
+                    continue
+                fields = counters.split()
+                received += int(fields[0])
+                sent += int(fields[8])
+    except (OSError, ValueError, IndexError):
+        return None
+    return received, sent
+
+
+class Activity:
+    def __init__(self, now):
+        self.idle_since = now
+        self.previous = None  # (monotonic time, cpu_usec, received, sent) of the last reading
+        self.frozen_received = None  # Bytes received when the container was frozen, to spot inbound traffic
+
+
+class IdleFreezer:
+    """Freezes running containers that have been idle for their plan's policy, and thaws them on demand.
+
+    Every `interval` seconds, CPU use comes from the container's cgroup and traffic from
+    /proc/PID/net/dev inside its network namespace, so nothing is forked. A frozen
+    container's kernel network stack keeps counting packets, so it is checked every
+    `wake_interval` seconds and thawed once `wake_bytes` have arrived; TCP retransmits
+    cover the gap. Terminals, starts and anything else that needs the container call
+    touch() or thaw it directly.
+
+    `list_containers()` returns {name: state} for managed containers, `in_use()` the
+    names that must stay awake (open terminals, migrations), and `freeze(name)` /
+    `thaw(name)` change the container's state.
+    """
+
+    def __init__(self, list_containers, in_use, freeze, thaw, interval=30, wake_interval=2):
+        self.list_containers = list_containers
+        self.in_use = in_use
+        self.freeze = freeze
+        self.thaw = thaw
+        self.interval = interval
+        self.wake_interval = wake_interval
+        self.unified = cgroup_v2()
+        self.policies = {}  # name -> normalized policy, for containers that may be frozen
+        self.activity = {}  # name -> Activity
+        self.cgroups = {}
+        self.lock = Lock()
+
+    def set_policy(self, name, policy):
+        policy = normalize_policy(policy)
+        with self.lock:
+            if policy:
+                self.policies[name] = policy
+            else:
+                self.policies.pop(name, None)
+                self.activity.pop(name, None)
+
+    def policy(self, name):
+        with self.lock:
+            return self.policies.get(name)
+
+    def forget(self, name):
+        with self.lock:
+            self.policies.pop(name, None)
+            self.activity.pop(name, None)
+        self.cgroups.pop(name, None)
+
+    def touch(self, name):
+        """Restart a container's idle timer, e.g. on terminal input or after it was thawed."""
+        with self.lock:
+            activity = self.activity.get(name)
+            if activity:
+                activity.idle_since = time.monotonic()
+
+    def _cgroup(self, name):
+        cgroup = self.cgroups.get(name)
+        if cgroup is None or not cgroup.directory():
+            cgroup = self.cgroups[name] = ContainerCgroup(name, self.unified)
+        return cgroup
+
+    def _read(self, name):
+        """Return (cgroup, memory_bytes, cpu_usec, received, sent), or None if the container can't be measured."""
+        cgroup = self._cgroup(name)
+        reading = cgroup.read()
+        pid = cgroup.first_pid()
+        net = read_net_bytes(pid) if pid else None
+        if reading is None or net is None:
+            self.cgroups.pop(name, None)  # Look the cgroup up again next time, it may have moved
+            return None
+        return cgroup, reading[0], reading[1], net[0], net[1]
+
+    def check_idle(self):
+        """Measure running containers with a policy and freeze those idle for long enough."""
+        now = time.monotonic()
+        states = self.list_containers()
+        in_use = self.in_use()
+        with self.lock:
+            policies = dict(self.policies)
+        for name, policy in policies.items():
+            state = states.get(name)
+            if state != 'RUNNING':
+                if state != 'FROZEN':
+                    with self.lock:
+                        self.activity.pop(name, None)  # Stopped: its counters restart with the container
+                continue
+            reading = self._read(name)
+            with self.lock:
+                activity = self.activity.get(name)
+                if activity is None:
+                    activity = self.activity[name] = Activity(now)
+            if activity.frozen_received is not None:
+                activity.frozen_received = None  # Thawed by someone else since the last check
+                activity.idle_since = now
+            if reading is None:
+                activity.idle_since = now  # Never freeze what can't be measured
+                continue
+
+            cgroup, memory, cpu_usec, received, sent = reading
+            previous, activity.previous = activity.previous, (now, cpu_usec, received, sent)
+            if previous is None or now <= previous[0] or name in in_use:
+                activity.idle_since = now
+                continue
+            elapsed = now - previous[0]
+            cpu_percent = max(cpu_usec - previous[1], 0) / (elapsed * 1e6) * 100
+            net_bps = (max(received - previous[2], 0) + max(sent - previous[3], 0)) / elapsed
+            if cpu_percent > policy['cpu_percent'] or net_bps > policy['net_bps']:
+                activity.idle_since = now
+                continue
+            if now - activity.idle_since < policy['after']:
+                continue
+
+            if not self.freeze(name):
+                activity.idle_since = now
+                continue
+            activity.frozen_received = received
+            logging.info(f"Froze {name} after {int(now - activity.idle_since)}s idle "
+                         f"({cpu_percent:.1f}% CPU, {net_bps:.0f} B/s)")
+            if policy['reclaim']:
+                self.reclaim(cgroup, memory)
+
+    def reclaim(self, cgroup, memory):
+        """Ask the kernel to swap out a frozen container's memory so other containers can use it."""
+        if not self.unified:
+            return  # v1 has no equivalent for a cgroup that still has processes
+        try:
+            with open(os.path.join(cgroup.directory(), 'memory.reclaim'), 'w') as f:
+                f.write(str(memory))
+        except OSError:
+            pass  # Kernels before 5.19, or less could be reclaimed than asked (EAGAIN)
+
+    def check_wake(self):
+        """Thaw frozen containers that received traffic since they were frozen."""
+        states = self.list_containers()
+        in_use = self.in_use()  # e.g. frozen on purpose for a backup, and thawed by whoever froze it
+        with self.lock:
+            frozen = [(name, self.policies[name], self.activity.get(name)) for name in self.policies
+                      if states.get(name) == 'FROZEN' and name not in in_use]
+        for name, policy, activity in frozen:
+            cgroup = self._cgroup(name)
+            pid = cgroup.first_pid()
+            net = read_net_bytes(pid) if pid else None
+            if net is None:
+                continue
+            if activity is None or activity.frozen_received is None:
+                # Frozen before a daemon restart, or by hand: start counting from now
+                with self.lock:
+                    activity = self.activity.setdefault(name, Activity(time.monotonic()))
+                activity.frozen_received = net[0]
+                continue
+            if net[0] - activity.frozen_received >= policy['wake_bytes']:
+                logging.info(f"Thawing {name}: {net[0] - activity.frozen_received} bytes arrived while frozen")
+                activity.frozen_received = None
+                activity.previous = None
+                self.thaw(name)
+                self.touch(name)
+
+    def run_forever(self):
+        last_idle_check = 0
+        while True:
+            try:
+                self.check_wake()
+                if time.monotonic() - last_idle_check >= self.interval:
+                    last_idle_check = time.monotonic()
+                    self.check_idle()
+            except Exception as e:
+                logging.error(f"Error checking idle containers: {str(e)}")
+            time.sleep(self.wake_interval)
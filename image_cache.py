@@ -0,0 +1,180 @@
+import json
+import logging
+import os
+import subprocess
+import time
+from threading import Lock
+
+GOLDEN_PREFIX = 'golden-'
+
+
+class ImageCache:
+    """Per-node cache of pre-built base containers that new instances are snapshot-cloned from.
+
+    One golden container is kept per distro template: the distros passed in are pinned and
+    built up front, others are built in the background after their first miss. Golden images
+    older than `max_age` are rebuilt, and when the cache grows past `max_bytes` the least
+    recently used unpinned distros are evicted. Replaced images that still back overlay clones are
+    kept as retired and destroyed once nothing depends on them.
+    """
+
+    def __init__(self, index_path, backend, distros=('ubuntu',), max_age=7 * 24 * 3600, max_bytes=20 * 1024 ** 3):
+        self.index_path = index_path
+        self.backend = backend
+        self.distros = list(distros)
+        self.wanted = set(distros)
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        self.building = set()
+        self.metrics = {'hits': 0, 'misses': 0, 'builds': 0, 'build_failures': 0, 'evictions': 0}
+        self.images, self.retired = self._load_index()
+        self.wanted.update(self.images)
+
+    def _load_index(self):
+        if not os.path.exists(self.index_path):
+            return {}, []
+        try:
+            with open(self.index_path) as index_file:
+                index = json.load(index_file)
+            return index.get('images', {}), index.get('retired', [])
+        except (OSError, ValueError) as e:
+            logging.error(f"Could not read image cache index {self.index_path}: {str(e)}")
+            return {}, []
+
+    def _save_index(self):
+        """Write the index to disk atomically. Caller must hold self.lock."""
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as index_file:
+            json.dump({'images': self.images, 'retired': self.retired}, index_file)
+        os.replace(tmp_path, self.index_path)
+
+    def clone(self, distro, instance_name):
+        """Snapshot-clone the golden image for `distro` into `instance_name`.
+
+        Returns True on a cache hit. On a miss nothing is created and the caller
+        should fall back to a full template run.
+        """
+        with self.lock:
+            image = self.images.get(distro)
+            if image is None:
+                self.metrics['misses'] += 1
+                self.wanted.add(distro)
+                return False
+            image['last_used'] = time.time()
+            self.metrics['hits'] += 1
+            golden_name = image['name']
+
+        command = ['lxc-copy', '-n', golden_name, '-N', instance_name, '-s']
+        # Plain directory rootfs has no native snapshots, so stack an overlay on top of it
+        if self._backing_store(golden_name) == 'dir':
+            command += ['-B', 'overlay']
+        self.backend.run(command)
+        return True
+
+    def _backing_store(self, container_name):
+        try:
+            with open(os.path.join(self.backend.lxc_path, container_name, 'config')) as config_file:
+                for line in config_file:
+                    key, _, value = line.partition('=')
+                    if key.strip() in ('lxc.rootfs.path', 'lxc.rootfs'):
+                        value = value.strip()
+                        for store in ('btrfs', 'zfs', 'overlay', 'overlayfs', 'lvm'):
+                            if value.startswith(store + ':'):
+                                return store
+                        return 'dir'
+        except OSError:
+            pass
+        return 'dir'
+
+    def _rootfs_size(self, container_name):
+        try:
+            output = self.backend.output(['du', '-sb', os.path.join(self.backend.lxc_path, container_name)])
+            return int(output.split()[0])
+        except (subprocess.CalledProcessError, OSError, ValueError):
+            return 0
+
+    def build(self, distro):
+        """Build a fresh golden image for `distro` and retire the one it replaces."""
+        with self.lock:
+            if distro in self.building:
+                return
+            self.building.add(distro)
+
+        golden_name = f'{GOLDEN_PREFIX}{distro}-{int(time.time())}'
+        try:
+            logging.info(f"Building golden image {golden_name}")
+            self.backend.run(['lxc-create', '-n', golden_name, '-t', distro])
+            size = self._rootfs_size(golden_name)
+            with self.lock:
+                previous = self.images.get(distro)
+                if previous:
+                    self.retired.append(previous['name'])
+                now = time.time()
+                self.images[distro] = {'name': golden_name, 'built_at': now, 'last_used': now, 'size': size}
+                self.metrics['builds'] += 1
+                self._save_index()
+        except (subprocess.CalledProcessError, OSError) as e:
+            logging.error(f"Failed to build golden image {golden_name}: {str(e)}")
+            with self.lock:
+                self.metrics['build_failures'] += 1
+        finally:
+            with self.lock:
+                self.building.discard(distro)
+
+    def _destroy_retired(self):
+        with self.lock:
+            retired = list(self.retired)
+        for golden_name in retired:
+            # lxc-destroy refuses while overlay clones still depend on the image; try again next cycle
+            try:
+                self.backend.run(['lxc-destroy', '-n', golden_name])
+            except subprocess.CalledProcessError:
+                continue
+            with self.lock:
+                self.retired.remove(golden_name)
+                self._save_index()
+
+    def _evict_oversized(self):
+        with self.lock:
+            total = sum(image['size'] for image in self.images.values())
+            evictable = sorted(((distro, image) for distro, image in self.images.items() if distro not in self.distros),
+                               key=lambda item: item[1]['last_used'])
+            while total > self.max_bytes and evictable:
+                distro, image = evictable.pop(0)
+                logging.info(f"Evicting golden image {image['name']} to stay under the cache size limit")
+                del self.images[distro]
+                self.wanted.discard(distro)
+                self.retired.append(image['name'])
+                total -= image['size']
+                self.metrics['evictions'] += 1
+            self._save_index()
+
+    def refresh(self):
+        """Build missing or expired images, enforce the size limit and clean up retired images."""
+        now = time.time()
+        with self.lock:
+            wanted = list(self.wanted)
+        for distro in wanted:
+            with self.lock:
+                image = self.images.get(distro)
+            if image is None or now - image['built_at'] > self.max_age:
+                self.build(distro)
+        self._evict_oversized()
+        self._destroy_retired()
+
+    def refresh_forever(self, interval):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                logging.error(f"Error refreshing image cache: {str(e)}")
+            time.sleep(interval)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'metrics': dict(self.metrics),
+                'images': {distro: dict(image) for distro, image in self.images.items()},
+                'retired': list(self.retired),
+            }
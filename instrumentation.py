@@ -0,0 +1,222 @@
+import logging
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from threading import Lock
+
+from flask import Response, g, request
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# Per-request breakdown. A context variable, so work handed to a pool with submit_traced() still counts
+_breakdown = ContextVar('request_breakdown', default=None)
+_breakdown_lock = Lock()  # Pool workers of one request add to the same breakdown
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.series = {}  # label values -> [per-bucket counts..., sum, count]
+        self.lock = Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            series = sorted((key, list(values)) for key, values in self.series.items())
+        for key, values in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, [("le", bound)])} {cumulative}')
+            lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, [("le", "+Inf")])} {values[-1]}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, key)} {values[-2]}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, key)} {values[-1]}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.lock = Lock()
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._add(Counter(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help_text, labelnames, buckets))
+
+    def _add(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        with self.lock:
+            metrics = list(self.metrics)
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+# Every process exports its own metrics from this registry
+registry = Registry()
+request_duration = registry.histogram('http_request_duration_seconds', 'Time spent handling requests.',
+                                      ('route', 'method', 'status'))
+db_query_duration = registry.histogram('db_query_duration_seconds', 'Time spent in individual SQL statements.')
+db_queries_per_request = registry.histogram('db_queries_per_request', 'SQL statements issued per request.',
+                                            ('route',), buckets=COUNT_BUCKETS)
+db_time_per_request = registry.histogram('db_seconds_per_request', 'Time spent in SQL per request.', ('route',))
+job_duration = registry.histogram('job_duration_seconds', 'Scheduled job run time.', ('job',),
+                                  buckets=LATENCY_BUCKETS + (120, 300, 900, 1800, 3600))
+job_failures = registry.counter('job_failures_total', 'Scheduled job runs that raised.', ('job',))
+
+
+def record(category, seconds):
+    """Add `seconds` spent in `category` (db, daemon, lxc, ...) to the current request's breakdown."""
+    breakdown = _breakdown.get()
+    if breakdown is not None:
+        with _breakdown_lock:
+            entry = breakdown.setdefault(category, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+
+
+def submit_traced(executor, fn, *args, **kwargs):
+    """executor.submit() whose worker adds its db/daemon time to the submitting request's breakdown."""
+    return executor.submit(copy_context().run, fn, *args, **kwargs)
+
+
+@contextmanager
+def timed(category):
+    """Time a block and add it to the current request's breakdown."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(category, time.perf_counter() - started)
+
+
+@contextmanager
+def timed_job(name):
+    """Time a scheduled job run, counting it as failed if it raises."""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        job_failures.inc(job=name)
+        raise
+    finally:
+        job_duration.observe(time.perf_counter() - started, job=name)
+
+
+def instrument_engine(engine):
+    """Time every SQL statement run on `engine`."""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info['query_started'].pop()
+        db_query_duration.observe(seconds)
+        record('db', seconds)
+
+
+def instrument_app(app, slow_request_threshold=None, exclude=()):
+    """Time every request, serve the registry on /metrics and optionally log slow requests.
+
+    Requests slower than `slow_request_threshold` seconds are logged with their breakdown,
+    e.g. "db 12x 0.310s, daemon 2x 0.820s". Routes in `exclude` (long-lived streams) are not timed.
+    """
+    @app.before_request
+    def start_request_trace():
+        g.request_started = time.perf_counter()
+        _breakdown.set({})
+
+    @app.after_request
+    def remember_status(response):
+        g.response_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def finish_request_trace(exc):
+        breakdown = _breakdown.get() or {}
+        _breakdown.set(None)
+        started = g.pop('request_started', None)
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        if started is None or route in exclude:
+            return
+        seconds = time.perf_counter() - started
+        request_duration.observe(seconds, route=route, method=request.method,
+                                 status=g.get('response_status', 500))
+        db_count, db_seconds = breakdown.get('db', (0, 0.0))
+        if 'db' in breakdown or app.extensions.get('sqlalchemy'):
+            db_queries_per_request.observe(db_count, route=route)
+            db_time_per_request.observe(db_seconds, route=route)
+        if slow_request_threshold and seconds >= slow_request_threshold:
+            parts = [f'{category} {count}x {spent:.3f}s' for category, (count, spent) in sorted(breakdown.items())]
+            other = seconds - sum(spent for _, spent in breakdown.values())
+            parts.append(f'other {max(other, 0):.3f}s')
+            logging.warning(f"Slow request {request.method} {request.path} took {seconds:.3f}s: {', '.join(parts)}")
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,78 @@
+import json
+import logging
+from threading import Lock
+
+from node_client import get_client
+
+EVENT_READ_TIMEOUT = 45  # Seconds without even a heartbeat before the stream is considered dead
+RECONNECT_DELAY = 5  # Seconds to wait before reconnecting a dropped stream
+
+
+class LiveStatusTable:
+    """Container states pushed by node daemons, keyed by container name.
+
+    Entries are only kept while their node's event stream is connected, so anything
+    in the table is current; callers fall back to asking the daemon for the rest.
+    """
+
+    def __init__(self):
+        self.statuses = {}  # name -> (node ip, state)
+        self.lock = Lock()
+
+    def apply_snapshot(self, ip_address, statuses):
+        with self.lock:
+            self._drop_node(ip_address)
+            for name, state in statuses.items():
+                self.statuses[name] = (ip_address, state)
+
+    def set(self, ip_address, name, state):
+        with self.lock:
+            if state == 'DELETED':
+                # After a migration the old node reports the deletion of a container that lives on elsewhere
+                if self.statuses.get(name, (ip_address,))[0] == ip_address:
+                    self.statuses.pop(name, None)
+            else:
+                self.statuses[name] = (ip_address, state)
+
+    def disconnect(self, ip_address):
+        with self.lock:
+            self._drop_node(ip_address)
+
+    def _drop_node(self, ip_address):
+        """Caller must hold self.lock."""
+        for name in [name for name, (ip, _) in self.statuses.items() if ip == ip_address]:
+            del self.statuses[name]
+
+    def get_many(self, names):
+        """Return {name: state} for the names the table knows about."""
+        with self.lock:
+            return {name: self.statuses[name][1] for name in names if name in self.statuses}
+
+
+def follow_node_events(ip_address, table, on_event, keep_running, sleep):
+    """Keep an /events stream open to one node, feeding the table and calling on_event per change.
+
+    Runs until keep_running() returns False. `sleep` is the cooperative sleep of the caller's
+    async mode (socketio.sleep).
+    """
+    while keep_running():
+        try:
+            response = get_client(ip_address).get('/events', stream=True, timeout=EVENT_READ_TIMEOUT)
+            if response.status_code == 200:
+                logging.info(f"Following container events from {ip_address}")
+                for line in response.iter_lines():
+                    if not keep_running():
+                        break
+                    if not line:
+                        continue  # Heartbeat
+                    event = json.loads(line)
+                    if event['type'] == 'snapshot':
+                        table.apply_snapshot(ip_address, event['statuses'])
+                    else:
+                        table.set(ip_address, event['name'], event['state'])
+                        on_event(ip_address, event)
+                response.close()
+        except Exception as e:
+            logging.error(f"Event stream from {ip_address} failed: {str(e)}")
+        table.disconnect(ip_address)
+        sleep(RECONNECT_DELAY)
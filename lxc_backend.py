@@ -0,0 +1,230 @@
+import os
+import queue
+import random
+import shutil
+import subprocess
+import time
+import uuid
+from threading import Lock
+
+LXC_PATH = '/var/lib/lxc'
+ROOTFS_KEYS = ('lxc.rootfs.path', 'lxc.rootfs')  # lxc.rootfs is the name before LXC 3
+
+
+def rootfs_setting(lxc_path, container_name):
+    """Return the lxc.rootfs.path value from a container's config, or None."""
+    try:
+        with open(os.path.join(lxc_path, container_name, 'config')) as config_file:
+            for line in config_file:
+                key, _, value = line.partition('=')
+                if key.strip() in ROOTFS_KEYS:
+                    return value.strip()
+    except OSError:
+        pass
+    return None
+
+
+def rootfs_layers(lxc_path, container_name):
+    """Return (lower, writable): the directories a container's root filesystem is made of.
+
+    `writable` holds the container's own files: the rootfs directory for dir and btrfs
+    containers, and the upper directory for overlay clones, whose `rootfs` is only an
+    empty mountpoint. `lower` is the image an overlay clone reads through to, or None.
+    Block device backing stores (lvm, zfs, loop, ...) raise ValueError.
+    """
+    value = rootfs_setting(lxc_path, container_name)
+    if not value:
+        return None, os.path.join(lxc_path, container_name, 'rootfs')
+    if value.startswith('/'):
+        return None, value
+    store, _, location = value.partition(':')
+    if store in ('dir', 'btrfs'):
+        return None, location
+    if store in ('overlay', 'overlayfs'):
+        lower, _, upper = location.rpartition(':')
+        return lower, upper
+    raise ValueError(f'{container_name} uses the {store} backing store, which has no directory to read')
+
+
+def set_rootfs_setting(lxc_path, container_name, value):
+    """Point a container's config at a different root filesystem, e.g. dir:/var/lib/lxc/NAME/rootfs."""
+    config_path = os.path.join(lxc_path, container_name, 'config')
+    with open(config_path) as f:
+        lines = [line for line in f if line.partition('=')[0].strip() not in ROOTFS_KEYS]
+    if lines and not lines[-1].endswith('\n'):
+        lines[-1] += '\n'
+    lines.append(f'lxc.rootfs.path = {value}\n')
+    tmp_path = f'{config_path}.{uuid.uuid4().hex}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.writelines(lines)
+    os.replace(tmp_path, config_path)
+
+
+class LxcBackend:
+    """Runs the real lxc-* tools. Everything the daemon does to containers goes through here."""
+
+    lxc_path = LXC_PATH
+
+    def run(self, command):
+        """Run a command, raising CalledProcessError if it fails."""
+        return subprocess.run(command, check=True)
+
+    def output(self, command):
+        return subprocess.check_output(command).decode()
+
+    def monitor(self):
+        """Yield lxc-monitor lines until the monitor exits."""
+        process = subprocess.Popen(['lxc-monitor', '-n', '.*'], stdout=subprocess.PIPE, text=True)
+        try:
+            yield from process.stdout
+        finally:
+            process.wait()
+
+    def attach_command(self, container_name):
+        return ['lxc-attach', '-n', container_name, '--', '/bin/bash', '-l']
+
+
+class FakeLxcBackend:
+    """In-memory stand-in for the lxc-* tools, for benchmarks and development without LXC.
+
+    Commands are interpreted from the same argv the real backend would run. Each tool
+    sleeps for its configured latency (with +/-50% jitter) and fails with the configured
+    probability, e.g. latency={'create': 2.0, 'start': 0.3}, failure_rate={'create': 0.05}.
+    Containers get a small directory under `root`, like /var/lib/lxc, and directories that
+    appear there (e.g. from a migration) are picked up the way LXC would.
+    """
+
+    STATE_CHANGES = {'start': 'RUNNING', 'stop': 'STOPPED', 'freeze': 'FROZEN', 'unfreeze': 'RUNNING'}
+
+    def __init__(self, root, latency=None, failure_rate=None, seed=None):
+        self.lxc_path = root
+        self.latency = latency or {}
+        self.failure_rate = failure_rate or {}
+        self.random = random.Random(seed)
+        self.containers = {}
+        self.events = queue.Queue()
+        self.lock = Lock()
+
+    def _simulate(self, tool, command):
+        delay = self.latency.get(tool, 0)
+        if delay:
+            time.sleep(delay * self.random.uniform(0.5, 1.5))
+        if self.random.random() < self.failure_rate.get(tool, 0):
+            raise subprocess.CalledProcessError(1, command)
+
+    def _set_state(self, name, state):
+        self.containers[name] = state
+        self.events.put(f"'{name}' changed state to [{state}]\n")
+
+    def _exists(self, name):
+        """Caller must hold self.lock."""
+        if name not in self.containers and os.path.exists(os.path.join(self.lxc_path, name, 'config')):
+            self.containers[name] = 'STOPPED'
+        return name in self.containers
+
+    def _make_directory(self, name):
+        rootfs = os.path.join(self.lxc_path, name, 'rootfs')
+        os.makedirs(rootfs, exist_ok=True)
+        with open(os.path.join(self.lxc_path, name, 'config'), 'w') as config_file:
+            config_file.write(f'lxc.uts.name = {name}\nlxc.rootfs.path = dir:{rootfs}\n')
+
+    def run(self, command):
+        tool = command[0].replace('lxc-', '')
+        self._simulate(tool, command)
+        args = command[1:]
+        name = args[args.index('-n') + 1] if '-n' in args else None
+
+        with self.lock:
+            if tool in ('create', 'copy'):
+                new_name = args[args.index('-N') + 1] if tool == 'copy' else name
+                if self._exists(new_name) or (tool == 'copy' and not self._exists(name)):
+                    raise subprocess.CalledProcessError(1, command)
+                self._make_directory(new_name)
+                self._set_state(new_name, 'STOPPED')
+            elif tool == 'destroy':
+                if not self._exists(name) or self.containers[name] != 'STOPPED':
+                    raise subprocess.CalledProcessError(1, command)
+                del self.containers[name]
+                shutil.rmtree(os.path.join(self.lxc_path, name), ignore_errors=True)
+            elif tool == 'checkpoint':
+                if not self._exists(name):
+                    raise subprocess.CalledProcessError(1, command)
+                if '-r' in args:
+                    self._set_state(name, 'RUNNING')
+                else:
+                    os.makedirs(args[args.index('-D') + 1], exist_ok=True)
+                    self._set_state(name, 'STOPPED')
+            elif tool in self.STATE_CHANGES:
+                if not self._exists(name):
+                    raise subprocess.CalledProcessError(1, command)
+                self._set_state(name, self.STATE_CHANGES[tool])
+            elif name is not None and not self._exists(name):
+                raise subprocess.CalledProcessError(1, command)  # lxc-cgroup etc. on a missing container
+        return subprocess.CompletedProcess(command, 0)
+
+    def output(self, command):
+        tool = command[0].replace('lxc-', '')
+        self._simulate(tool, command)
+        if tool == 'ls':
+            with self.lock:
+                for name in os.listdir(self.lxc_path):
+                    self._exists(name)
+                rows = [f'{name} {state}' for name, state in sorted(self.containers.items())]
+            return '\n'.join(['NAME STATE'] + rows) + '\n'
+        if tool == 'du':
+            return f'{512 * 1024 ** 2}\t{command[-1]}\n'
+        return ''
+
+    def monitor(self):
+        while True:
+            yield self.events.get()
+
+    def attach_command(self, container_name):
+        return ['/bin/sh', '-i']
+
+
+class TimedBackend:
+    """Wraps a backend and reports each command to `observe(program, seconds, ok)`."""
+
+    def __init__(self, backend, observe):
+        self.backend = backend
+        self.observe = observe
+
+    def _timed(self, func, command):
+        started = time.perf_counter()
+        ok = False
+        try:
+            result = func(command)
+            ok = True
+            return result
+        finally:
+            self.observe(command[0], time.perf_counter() - started, ok)
+
+    def run(self, command):
+        return self._timed(self.backend.run, command)
+
+    def output(self, command):
+        return self._timed(self.backend.output, command)
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+
+def parse_rates(spec):
+    """Parse 'create=2,start=0.3' into {'create': 2.0, 'start': 0.3}."""
+    rates = {}
+    for item in filter(None, (spec or '').split(',')):
+        key, _, value = item.partition('=')
+        rates[key.strip()] = float(value)
+    return rates
+
+
+def make_backend(state_dir):
+    """Pick the backend from LXC_BACKEND (lxc or fake), configured by LXC_FAKE_LATENCY/LXC_FAKE_FAILURE."""
+    if os.environ.get('LXC_BACKEND', 'lxc') == 'fake':
+        root = os.path.join(state_dir, 'lxc')
+        os.makedirs(root, exist_ok=True)
+        return FakeLxcBackend(root,
+                              latency=parse_rates(os.environ.get('LXC_FAKE_LATENCY')),
+                              failure_rate=parse_rates(os.environ.get('LXC_FAKE_FAILURE')))
+    return LxcBackend()
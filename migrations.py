@@ -0,0 +1,121 @@
+import logging
+
+from sqlalchemy import create_engine, func, inspect, literal, select, text
+
+from billing import BILLING_PERIOD
+from credits import find_balance_mismatches
+from models import db, Instance, UserCredits, CreditEntry
+
+
+def add_missing_column(table, column):
+    """Add a column declared in models.py to an existing table that predates it. Returns True if added.
+
+    The type, and a scalar default for the rows already there, are compiled for the database in use.
+    """
+    columns = {existing['name'] for existing in inspect(db.engine).get_columns(table)}
+    if column in columns:
+        return False
+    model_column = db.metadata.tables[table].c[column]
+    dialect = db.engine.dialect
+    ddl = f'{dialect.identifier_preparer.quote(column)} {model_column.type.compile(dialect=dialect)}'
+    if model_column.default is not None and model_column.default.is_scalar:
+        default = literal(model_column.default.arg, model_column.type)
+        ddl += f" DEFAULT {default.compile(dialect=dialect, compile_kwargs={'literal_binds': True})}"
+    logging.info(f"Adding column {table}.{column}")
+    with db.engine.begin() as connection:
+        connection.execute(text(f'ALTER TABLE {dialect.identifier_preparer.quote(table)} ADD COLUMN {ddl}'))
+    return True
+
+
+def backfill_next_billing_date():
+    """Give instances created before next_billing_date existed a due date based on their last bill."""
+    if Instance.query.filter(Instance.next_billing_date.is_(None)).first() is None:
+        return
+    for instance in Instance.query.filter(Instance.next_billing_date.is_(None)):
+        last_billed = instance.last_billed_date or instance.creation_date
+        if last_billed:
+            instance.next_billing_date = last_billed + BILLING_PERIOD
+    db.session.commit()
+
+
+def backfill_credit_ledger():
+    """Open the ledger with each user's current balance, for balances that predate it."""
+    if CreditEntry.query.first() is not None:
+        return
+    opening = (select(UserCredits.user_id, UserCredits.balance, literal('opening_balance'), func.current_timestamp())
+               .where(UserCredits.balance != 0))
+    db.session.execute(CreditEntry.__table__.insert().from_select(
+        ['user_id', 'amount', 'reason', 'created_at'], opening))
+    db.session.commit()
+
+
+def create_missing_indexes():
+    """Create any index declared in models.py that an older database doesn't have yet."""
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                logging.info(f"Creating index {index.name}")
+                index.create(bind=db.engine)
+
+
+def upgrade_schema():
+    """Bring an existing database up to date with models.py. Safe to run on every start."""
+    db.create_all()
+
+    add_missing_column('instance', 'next_billing_date')
+    add_missing_column('node', 'ram_capacity')
+    add_missing_column('node', 'disk_capacity')
+    add_missing_column('instance', 'migrating')
+    create_missing_indexes()
+    # Also on a copied or hand-migrated database, where create_all() made the column but left it empty
+    backfill_next_billing_date()
+    backfill_credit_ledger()
+
+
+def copy_database(source_url):
+    """Copy every row from another database (e.g. an old users.db) into the configured one.
+
+    The target must be empty. On PostgreSQL the id sequences are moved past the copied rows.
+    """
+    source_engine = create_engine(source_url)
+    with source_engine.connect() as source, db.engine.begin() as target:
+        for table in db.metadata.sorted_tables:
+            if not inspect(source_engine).has_table(table.name):
+                continue
+            source_columns = {column['name'] for column in inspect(source_engine).get_columns(table.name)}
+            columns = [column for column in table.columns if column.name in source_columns]
+            rows = [dict(row._mapping) for row in source.execute(select(*columns))]
+            if rows:
+                target.execute(table.insert(), rows)
+            logging.info(f"Copied {len(rows)} rows into {table.name}")
+
+            if target.dialect.name == 'postgresql' and 'id' in table.c:
+                target.execute(text(
+                    f"SELECT setval(pg_get_serial_sequence('\"{table.name}\"', 'id'), "
+                    f"COALESCE((SELECT MAX(id) FROM \"{table.name}\"), 0) + 1, false)"))
+
+
+if __name__ == '__main__':
+    import argparse
+    from app import app
+
+    parser = argparse.ArgumentParser(description='Upgrade the panel database to the current schema.')
+    parser.add_argument('--copy-from', metavar='DATABASE_URL',
+                        help='copy all rows from this database first, e.g. sqlite:///instance/users.db')
+    parser.add_argument('--check-credits', action='store_true',
+                        help='list users whose balance does not match their credit ledger')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    with app.app_context():
+        db.create_all()
+        if args.copy_from:
+            copy_database(args.copy_from)
+        upgrade_schema()
+        if args.check_credits:
+            mismatches = find_balance_mismatches()
+            for user_id, balance, total in mismatches:
+                print(f'user {user_id}: balance {balance}, ledger {total}')
+            print(f'{len(mismatches)} mismatched balances')
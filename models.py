@@ -2,10 +2,46 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_bcrypt import Bcrypt
 from flask_login import UserMixin
 from datetime import datetime  # Correct import
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import sqlite3
 
 db = SQLAlchemy()
 bcrypt = Bcrypt()
 
+SQLITE_BUSY_TIMEOUT = 30  # Seconds a writer waits for SQLite's lock before failing
+
+
+def normalize_database_url(url):
+    # Heroku-style URLs use the scheme SQLAlchemy dropped in 1.4
+    if url.startswith('postgres://'):
+        url = 'postgresql://' + url[len('postgres://'):]
+    return url
+
+
+def engine_options(url, pool_size=10, max_overflow=20, pool_recycle=1800):
+    """SQLALCHEMY_ENGINE_OPTIONS suited to the database behind `url`."""
+    if url.startswith('sqlite'):
+        return {'connect_args': {'timeout': SQLITE_BUSY_TIMEOUT, 'check_same_thread': False}}
+    return {
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        'pool_recycle': pool_recycle,
+        'pool_pre_ping': True,  # Drop connections the server closed while idle
+    }
+
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers proceed while a worker holds the write lock
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT * 1000}')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.close()
+
+
 class User(db.Model, UserMixin):  # Inherit from UserMixin
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(150), nullable=False, unique=True)
@@ -18,25 +54,38 @@ class User(db.Model, UserMixin):  # Inherit from UserMixin
     def check_password(self, password):
         return bcrypt.check_password_hash(self.password, password)
 
+    def password_rounds(self):
+        # bcrypt hashes look like $2b$12$..., where 12 is the cost they were made with
+        return int(self.password.split('$')[2])
+
 class Instance(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(150), nullable=False, unique=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     plan = db.Column(db.String(50), nullable=False)
-    node_id = db.Column(db.Integer, db.ForeignKey('node.id'), nullable=False)
+    node_id = db.Column(db.Integer, db.ForeignKey('node.id'), nullable=False, index=True)
     status = db.Column(db.String(20), default='Stopped')
     creation_date = db.Column(db.DateTime, default=datetime.utcnow) 
     last_billed_date = db.Column(db.DateTime, nullable=True) 
+    next_billing_date = db.Column(db.DateTime, nullable=True, index=True)  # Billing job only reads rows that are due
     suspended = db.Column(db.Boolean, default=False)
+    migrating = db.Column(db.Boolean, default=False)  # Set while the container is being moved to another node
 
     user = db.relationship('User', backref=db.backref('instances', lazy=True))
 
+    __table_args__ = (
+        db.Index('ix_instance_user_id_name', 'user_id', 'name'),  # start/stop/delete/terminal lookups
+        db.Index('ix_instance_user_id_suspended', 'user_id', 'suspended'),  # /manage and add_credits
+    )
+
 class Node(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), unique=True, nullable=False)
     ip_address = db.Column(db.String(15), unique=True, nullable=False)  # IPv4 address
     instances = db.relationship('Instance', backref='node', lazy=True)
     is_active = db.Column(db.Boolean, default=True)
+    ram_capacity = db.Column(db.BigInteger, nullable=True)  # Bytes of RAM available to containers
+    disk_capacity = db.Column(db.BigInteger, nullable=True)  # Bytes of disk available to containers
 
     def __repr__(self):
         return f'<Node {self.name}>'
@@ -49,6 +98,18 @@ class UserCredits(db.Model):
     def __repr__(self):
         return f'<UserCredits {self.user_id}: {self.balance}>'
 
+class CreditEntry(db.Model):
+    """Append-only record of every credit change; UserCredits.balance is the running total of these."""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    amount = db.Column(db.Integer, nullable=False)  # Positive for credits, negative for charges
+    reason = db.Column(db.String(50), nullable=False)  # signup, billing, instance_create, admin, ...
+    reference = db.Column(db.String(150), nullable=True)  # Instance name or admin username
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f'<CreditEntry {self.user_id}: {self.amount:+d} {self.reason}>'
+
 class Subscription(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -0,0 +1,153 @@
+import hashlib
+import hmac
+import logging
+import time
+from threading import Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from instrumentation import record, registry
+
+DAEMON_PORT = 8080
+TERMINAL_TOKEN_TTL = 60  # Seconds a terminal token is valid; the page opens its WebSocket right after loading
+
+# Defaults for every node client, overridable through configure()
+settings = {
+    'connect_timeout': 3,  # Seconds to establish a TCP connection to a daemon
+    'read_timeout': 30,  # Seconds to wait for a daemon to answer
+    'max_retries': 2,  # Retries for failed connects (and idempotent requests)
+    'backoff_factor': 0.5,  # Sleep 0.5s, 1s, 2s... between retries
+    'pool_size': 10,  # Keep-alive connections kept open per node
+    'failure_threshold': 5,  # Consecutive failures before a node is marked degraded
+    'recovery_timeout': 30,  # Seconds a degraded node is skipped before it is tried again
+    'node_secret': '',  # Shared NODE_SECRET, sent as X-Node-Token so daemons accept the request
+}
+
+daemon_request_duration = registry.histogram('daemon_request_duration_seconds',
+                                             'Time until a node daemon answered (headers for streams).',
+                                             ('node', 'method', 'endpoint', 'outcome'))
+
+_clients = {}  # One client per node IP address
+_clients_lock = Lock()
+
+
+def sign_terminal_token(secret, instance_name, expires_at=None):
+    """Token letting a browser open the terminal of one instance on its node until `expires_at`."""
+    expires_at = int(expires_at or time.time() + TERMINAL_TOKEN_TTL)
+    signature = hmac.new(secret.encode(), f'terminal:{instance_name}:{expires_at}'.encode(), hashlib.sha256).hexdigest()
+    return f'{expires_at}.{signature}'
+
+
+def check_terminal_token(secret, instance_name, token):
+    expires_at, _, signature = (token or '').partition('.')
+    if not secret or not expires_at.isdigit() or int(expires_at) < time.time():
+        return False
+    expected = sign_terminal_token(secret, instance_name, int(expires_at)).partition('.')[2]
+    return hmac.compare_digest(signature, expected)
+
+
+class NodeUnavailable(Exception):
+    """Raised when a node's circuit breaker is open and the call is skipped."""
+
+
+class NodeClient:
+    """Pooled HTTP client for a single node daemon with retries and a circuit breaker."""
+
+    def __init__(self, ip_address, port=DAEMON_PORT):
+        self.base_url = f'http://{ip_address}:{port}'
+        self.ip_address = ip_address
+        self.session = requests.Session()
+
+        # Connection errors are always retried; read errors and 5xx only for idempotent methods
+        retry = Retry(total=settings['max_retries'],
+                      backoff_factor=settings['backoff_factor'],
+                      status_forcelist=(502, 503, 504),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings['pool_size'], max_retries=retry)
+        self.session.mount('http://', adapter)
+        if settings['node_secret']:
+            self.session.headers['X-Node-Token'] = settings['node_secret']
+
+        self.failures = 0
+        self.opened_at = None
+        self.lock = Lock()
+
+    @property
+    def degraded(self):
+        with self.lock:
+            return self.opened_at is not None
+
+    def _check_circuit(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            # Once the recovery timeout has passed, let a trial request through (half-open)
+            if time.monotonic() - self.opened_at < settings['recovery_timeout']:
+                raise NodeUnavailable(f'Node {self.ip_address} is degraded, skipping request.')
+
+    def _record_success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                logging.info(f"Node {self.ip_address} recovered")
+            self.failures = 0
+            self.opened_at = None
+
+    def _record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= settings['failure_threshold']:
+                if self.opened_at is None:
+                    logging.warning(f"Node {self.ip_address} marked degraded after {self.failures} failures")
+                self.opened_at = time.monotonic()
+
+    def request(self, method, path, timeout=None, **kwargs):
+        """Send a request to the daemon. `timeout` overrides the read timeout for slow calls."""
+        self._check_circuit()
+        read_timeout = timeout if timeout is not None else settings['read_timeout']
+        endpoint = '/' + path.lstrip('/').split('?')[0].split('/')[0]  # /jobs/<id> -> /jobs, keeps labels bounded
+        started = time.perf_counter()
+        outcome = 'error'
+        try:
+            response = self.session.request(method, self.base_url + path,
+                                            timeout=(settings['connect_timeout'], read_timeout),
+                                            **kwargs)
+            outcome = str(response.status_code)
+        except requests.RequestException:
+            self._record_failure()
+            raise
+        finally:
+            seconds = time.perf_counter() - started
+            daemon_request_duration.observe(seconds, node=self.ip_address, method=method, endpoint=endpoint,
+                                            outcome=outcome)
+            record('daemon', seconds)
+        self._record_success()
+        return response
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+
+def get_client(ip_address):
+    """Return the shared client for a node, creating it on first use."""
+    with _clients_lock:
+        client = _clients.get(ip_address)
+        if client is None:
+            client = _clients[ip_address] = NodeClient(ip_address)
+        return client
+
+
+def configure(**overrides):
+    """Update client settings and drop existing clients so the new settings take effect."""
+    unknown = set(overrides) - set(settings)
+    if unknown:
+        raise ValueError(f'Unknown node client settings: {", ".join(sorted(unknown))}')
+    settings.update(overrides)
+    with _clients_lock:
+        for client in _clients.values():
+            client.session.close()
+        _clients.clear()
@@ -0,0 +1,119 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from node_client import get_client
+
+HEALTH_TIMEOUT = 2  # Seconds a /health probe may take before it counts as failed
+SCORE_WEIGHT = 0.3  # Weight of the newest probe in the rolling score and latency
+
+
+class NodeHealth:
+    def __init__(self):
+        self.score = 1.0  # Rolling share of successful probes, 1.0 = every recent probe passed
+        self.latency = None  # Rolling probe latency in seconds
+        self.healthy = True  # Nodes are trusted until they fail, so a panel restart doesn't empty the rotation
+        self.failures = 0  # Consecutive failed probes
+        self.successes = 0  # Consecutive passed probes
+        self.report = None  # Last /health body: load, free memory and disk, container count
+        self.checked_at = None
+        self.error = None
+
+    def as_dict(self):
+        return {'score': round(self.score, 2), 'latency': self.latency, 'healthy': self.healthy,
+                'report': self.report, 'checked_at': self.checked_at, 'error': self.error}
+
+
+class HealthChecker:
+    """Probes every node's /health concurrently and keeps a rolling score per node.
+
+    A node leaves the rotation after `failure_threshold` failed probes in a row and
+    comes back after `recovery_threshold` passed ones. Request paths read the cached
+    results through is_available() and never probe a node themselves.
+
+    `list_nodes()` returns [(node_id, ip_address)] for the nodes to watch; `on_report(node_id, report)`
+    is called with every successful probe (the panel feeds free memory to the placement scheduler).
+    """
+
+    def __init__(self, list_nodes, on_report=None, interval=10, timeout=HEALTH_TIMEOUT,
+                 failure_threshold=3, recovery_threshold=2, sleep=time.sleep):
+        self.list_nodes = list_nodes
+        self.on_report = on_report
+        self.interval = interval
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.recovery_threshold = recovery_threshold
+        self.sleep = sleep
+        self.nodes = {}  # node_id -> NodeHealth
+        self.lock = Lock()
+
+    def probe(self, ip_address):
+        """Return (report, latency, error) for one node."""
+        started = time.monotonic()
+        try:
+            response = get_client(ip_address).get('/health', timeout=self.timeout)
+            latency = time.monotonic() - started
+            if response.status_code == 200:
+                return response.json().get('health'), latency, None
+            return None, latency, f'HTTP {response.status_code}'
+        except Exception as e:
+            return None, time.monotonic() - started, str(e)
+
+    def record(self, node_id, ip_address, report, latency, error):
+        with self.lock:
+            health = self.nodes.get(node_id)
+            if health is None:
+                health = self.nodes[node_id] = NodeHealth()
+            passed = report is not None
+            health.score = (1 - SCORE_WEIGHT) * health.score + SCORE_WEIGHT * (1.0 if passed else 0.0)
+            health.latency = latency if health.latency is None else (1 - SCORE_WEIGHT) * health.latency + SCORE_WEIGHT * latency
+            health.checked_at = time.time()
+            health.error = error
+            if passed:
+                health.report = report
+                health.failures = 0
+                health.successes += 1
+                if not health.healthy and health.successes >= self.recovery_threshold:
+                    health.healthy = True
+                    logging.warning(f"Node {ip_address} recovered, returning it to the rotation")
+            else:
+                health.successes = 0
+                health.failures += 1
+                if health.healthy and health.failures >= self.failure_threshold:
+                    health.healthy = False
+                    logging.warning(f"Node {ip_address} failed {health.failures} health checks, "
+                                    f"taking it out of the rotation: {error}")
+
+        if report is not None and self.on_report:
+            self.on_report(node_id, report)
+
+    def check_all(self):
+        nodes = self.list_nodes()
+        with self.lock:
+            for node_id in set(self.nodes) - {node_id for node_id, _ in nodes}:
+                del self.nodes[node_id]  # Deleted or deactivated nodes
+        if not nodes:
+            return
+        with ThreadPoolExecutor(max_workers=len(nodes)) as executor:
+            results = executor.map(lambda node: self.probe(node[1]), nodes)
+            for (node_id, ip_address), (report, latency, error) in zip(nodes, results):
+                self.record(node_id, ip_address, report, latency, error)
+
+    def run_forever(self):
+        while True:
+            try:
+                self.check_all()
+            except Exception as e:
+                logging.error(f"Error checking node health: {str(e)}")
+            self.sleep(self.interval)
+
+    def is_available(self, node_id):
+        with self.lock:
+            health = self.nodes.get(node_id)
+            return health is None or health.healthy
+
+    def get(self, node_id):
+        with self.lock:
+            health = self.nodes.get(node_id)
+            return health.as_dict() if health else None
@@ -0,0 +1,180 @@
+import logging
+import time
+from threading import Lock
+
+from sqlalchemy import func
+
+from models import db, Instance
+
+POLICIES = ('bin-pack', 'spread', 'least-loaded')
+
+
+class NodeCapacity:
+    def __init__(self, node_id):
+        self.node_id = node_id
+        self.ram_committed = 0
+        self.disk_committed = 0
+        self.instance_count = 0
+        self.ram_free = None  # Live free memory reported by the daemon
+        self.live_updated_at = 0
+
+
+class PlacementScheduler:
+    """Picks the node a new instance goes to, based on committed and live capacity.
+
+    Committed RAM/disk per node is computed once from the instances table and then
+    kept up to date incrementally through reserve() and release(). Because several
+    panel workers each hold their own counters, they are rebuilt from the database
+    every `rebuild_interval` seconds to correct any drift.
+
+    Policies:
+        bin-pack      fill the fullest node that still fits, keeping others free
+        spread        the node with the fewest instances
+        least-loaded  the node with the lowest share of its RAM committed
+
+    Nodes with no RAM capacity set are only used when no sized node has room.
+    """
+
+    def __init__(self, plans, policy='least-loaded', overcommit_ratio=1.0, rebuild_interval=300):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown placement policy {policy!r}, expected one of {", ".join(POLICIES)}')
+        self.plans = plans
+        self.policy = policy
+        self.overcommit_ratio = overcommit_ratio
+        self.rebuild_interval = rebuild_interval
+        self.capacities = {}
+        self.built_at = None
+        self.lock = Lock()
+
+    def _plan_sizes(self, plan_name):
+        plan = self.plans.get(plan_name)
+        if plan is None:
+            return 0, 0
+        return plan['ram_bytes'], plan['disk_bytes']
+
+    def rebuild(self):
+        """Recompute committed capacity for every node with one grouped query."""
+        capacities = {}
+        rows = db.session.query(Instance.node_id, Instance.plan, func.count(Instance.id)) \
+            .group_by(Instance.node_id, Instance.plan).all()
+        for node_id, plan_name, count in rows:
+            capacity = capacities.setdefault(node_id, NodeCapacity(node_id))
+            ram, disk = self._plan_sizes(plan_name)
+            capacity.ram_committed += ram * count
+            capacity.disk_committed += disk * count
+            capacity.instance_count += count
+
+        with self.lock:
+            # Keep live readings across rebuilds
+            for node_id, previous in self.capacities.items():
+                if node_id in capacities:
+                    capacities[node_id].ram_free = previous.ram_free
+                    capacities[node_id].live_updated_at = previous.live_updated_at
+            self.capacities = capacities
+            self.built_at = time.monotonic()
+
+    def _ensure_fresh(self):
+        if self.built_at is None or time.monotonic() - self.built_at > self.rebuild_interval:
+            self.rebuild()
+
+    def _capacity(self, node_id):
+        """Caller must hold self.lock."""
+        capacity = self.capacities.get(node_id)
+        if capacity is None:
+            capacity = self.capacities[node_id] = NodeCapacity(node_id)
+        return capacity
+
+    def reserve(self, node_id, plan_name):
+        ram, disk = self._plan_sizes(plan_name)
+        with self.lock:
+            capacity = self._capacity(node_id)
+            capacity.ram_committed += ram
+            capacity.disk_committed += disk
+            capacity.instance_count += 1
+
+    def release(self, node_id, plan_name):
+        ram, disk = self._plan_sizes(plan_name)
+        with self.lock:
+            capacity = self._capacity(node_id)
+            capacity.ram_committed = max(capacity.ram_committed - ram, 0)
+            capacity.disk_committed = max(capacity.disk_committed - disk, 0)
+            capacity.instance_count = max(capacity.instance_count - 1, 0)
+
+    def update_live(self, node_id, ram_free):
+        with self.lock:
+            capacity = self._capacity(node_id)
+            capacity.ram_free = ram_free
+            capacity.live_updated_at = time.monotonic()
+
+    def live_age(self, node_id):
+        with self.lock:
+            capacity = self.capacities.get(node_id)
+            if capacity is None or not capacity.live_updated_at:
+                return None
+            return time.monotonic() - capacity.live_updated_at
+
+    def _fits(self, node, capacity, ram, disk):
+        if node.ram_capacity and capacity.ram_committed + ram > node.ram_capacity * self.overcommit_ratio:
+            return False
+        if node.disk_capacity and capacity.disk_committed + disk > node.disk_capacity:
+            return False
+        # With overcommit the host only needs room for the share of the plan it will actually use
+        if capacity.ram_free is not None and capacity.ram_free < ram / self.overcommit_ratio:
+            return False
+        return True
+
+    def _load(self, node, capacity):
+        """Fraction of the node's (overcommitted) RAM already promised to instances."""
+        return capacity.ram_committed / (node.ram_capacity * self.overcommit_ratio)
+
+    def place(self, plan_name, nodes):
+        """Pick the best active node for `plan_name` and reserve the plan on it.
+
+        Returns None if nothing fits. Choosing and reserving happen under one lock so
+        concurrent signups can't both claim the last slot; call release() if the
+        instance is not created after all.
+        """
+        self._ensure_fresh()
+        ram, disk = self._plan_sizes(plan_name)
+        with self.lock:
+            candidates = []
+            for node in nodes:
+                if not node.is_active:
+                    continue
+                capacity = self._capacity(node.id)
+                if self._fits(node, capacity, ram, disk):
+                    candidates.append((node, capacity))
+
+            if not candidates:
+                logging.warning(f"No node has room for a {plan_name} instance")
+                return None
+
+            # Nodes without a configured RAM capacity are only used when no sized node fits
+            sized = [item for item in candidates if item[0].ram_capacity]
+            if not sized:
+                node, capacity = min(candidates, key=lambda item: item[1].instance_count)
+            elif self.policy == 'bin-pack':
+                node, capacity = max(sized, key=lambda item: self._load(*item))
+            elif self.policy == 'spread':
+                node, capacity = min(sized, key=lambda item: item[1].instance_count)
+            else:
+                node, capacity = min(sized, key=lambda item: self._load(*item))
+
+            capacity.ram_committed += ram
+            capacity.disk_committed += disk
+            capacity.instance_count += 1
+            return node
+
+    def resize(self, node, old_plan, new_plan):
+        """Move an instance on `node` from one plan to another. Returns False if a bigger plan doesn't fit there."""
+        self._ensure_fresh()
+        old_ram, old_disk = self._plan_sizes(old_plan)
+        new_ram, new_disk = self._plan_sizes(new_plan)
+        ram, disk = new_ram - old_ram, new_disk - old_disk
+        with self.lock:
+            capacity = self._capacity(node.id)
+            if (ram > 0 or disk > 0) and not self._fits(node, capacity, max(ram, 0), max(disk, 0)):
+                return False
+            capacity.ram_committed = max(capacity.ram_committed + ram, 0)
+            capacity.disk_committed = max(capacity.disk_committed + disk, 0)
+            return True
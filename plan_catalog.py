@@ -0,0 +1,104 @@
+import json
+import logging
+import os
+import re
+import time
+from threading import Lock
+
+SIZE_UNITS = {'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3, 'TB': 1024 ** 4}
+SIZE_RE = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?B)\s*$', re.IGNORECASE)
+
+
+def parse_size(value):
+    """Convert a plans.json size such as '512MB' or '1GB' into bytes."""
+    match = SIZE_RE.match(str(value))
+    if not match:
+        raise ValueError(f'Invalid size: {value!r}')
+    number, unit = match.groups()
+    return int(float(number) * SIZE_UNITS[unit.upper()])
+
+
+def plan_limits(plan):
+    """The resource limits a plan's containers get, as sent to the daemons. Optional fields left out are unlimited.
+
+    ram/disk/swap and io_read_bps/io_write_bps are sizes ('1GB', io per second); cpus is a
+    quota in cores (1.5), cpu_shares a relative weight (1024 = normal), cpuset a CPU list
+    ('0-3'), io_read_iops/io_write_iops and pids are counts.
+    """
+    limits = {'ram_bytes': parse_size(plan['ram']), 'disk_bytes': parse_size(plan['disk'])}
+    for key in ('swap', 'io_read_bps', 'io_write_bps'):
+        if plan.get(key) is not None:
+            limits['swap_bytes' if key == 'swap' else key] = parse_size(plan[key])
+    for key, convert in (('cpus', float), ('cpu_shares', int), ('cpuset', str),
+                         ('io_read_iops', int), ('io_write_iops', int), ('pids', int)):
+        if plan.get(key) is not None:
+            limits[key] = convert(plan[key])
+    return limits
+
+
+class PlanCatalog:
+    """In-memory view of plans.json, indexed by plan name.
+
+    The file is parsed once and re-read only when its mtime changes (checked at most
+    every `check_interval` seconds) or when reload() is called. If a changed file
+    can't be read, the error is logged and the last good plans are kept; only reload()
+    (and the very first load, with nothing to fall back on) raises.
+    """
+
+    def __init__(self, path, check_interval=2):
+        self.path = path
+        self.check_interval = check_interval
+        self.lock = Lock()
+        self.plans = []
+        self.by_name = {}
+        self.mtime = None
+        self.rejected_mtime = None  # mtime of a version that failed to load, so it isn't parsed every check
+        self.checked_at = 0
+
+    def _load(self):
+        """Parse the file and swap in the new plans. Caller must hold self.lock."""
+        mtime = os.path.getmtime(self.path)
+        with open(self.path) as plans_file:
+            plans = json.load(plans_file)
+        for plan in plans:
+            plan['ram_bytes'] = parse_size(plan['ram'])
+            plan['disk_bytes'] = parse_size(plan['disk'])
+            plan['limits'] = plan_limits(plan)
+        self.plans = plans
+        self.by_name = {plan['name']: plan for plan in plans}
+        self.mtime = mtime
+
+    def _refresh(self):
+        now = time.monotonic()
+        with self.lock:
+            if self.mtime is not None and now - self.checked_at < self.check_interval:
+                return
+            self.checked_at = now
+            if self.mtime is None:
+                self._load()
+                return
+            try:
+                mtime = os.path.getmtime(self.path)
+            except OSError as e:
+                logging.error(f"Error checking {self.path}, still serving the previous plans: {str(e)}")
+                return
+            if mtime in (self.mtime, self.rejected_mtime):
+                return
+            try:
+                self._load()
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                self.rejected_mtime = mtime
+                logging.error(f"Error reloading {self.path}, still serving the previous plans: {str(e)}")
+
+    def reload(self):
+        with self.lock:
+            self._load()
+            self.checked_at = time.monotonic()
+
+    def all(self):
+        self._refresh()
+        return self.plans
+
+    def get(self, name):
+        self._refresh()
+        return self.by_name.get(name)
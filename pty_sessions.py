@@ -0,0 +1,204 @@
+import fcntl
+import logging
+import os
+import queue
+import selectors
+import signal
+import struct
+import subprocess
+import termios
+import time
+from threading import Lock, Thread
+
+READ_SIZE = 65536
+OUTPUT_QUEUE_SIZE = 64  # Chunks queued for a slow client before its pty is no longer read, which pauses the shell
+
+
+class PtySession:
+    """One container shell (normally `lxc-attach`) running on its own pseudo-terminal."""
+
+    def __init__(self, container_name, process, master_fd, on_output, on_close):
+        self.container_name = container_name
+        self.process = process
+        self.master_fd = master_fd
+        self.on_output = on_output  # Called with each chunk of raw bytes read from the pty
+        self.on_close = on_close  # Called once when the shell exits or the session is reaped
+        self.last_activity = time.monotonic()
+        self.closed = False
+        self.paused = False  # Not being read until the client catches up with its queued output
+        self.exited = False  # The shell is gone; only its queued output is left to send
+        self.output = queue.Queue()  # Chunks waiting for on_output; b'' once the shell exited, None once closed
+
+
+class PtySessionManager:
+    """Runs terminal sessions and multiplexes all of their output on a single epoll thread.
+
+    Each session has its own sender thread calling on_output, so one slow client never
+    holds up the others. Sessions with no input or output for `idle_timeout` seconds are closed.
+    """
+
+    def __init__(self, attach_command, idle_timeout=900):
+        self.attach_command = attach_command  # Callable returning the argv that opens a shell in a container
+        self.idle_timeout = idle_timeout
+        self.selector = selectors.DefaultSelector()
+        self.sessions = set()
+        self.lock = Lock()
+        self.reader_thread = None
+
+    def start(self):
+        self.reader_thread = Thread(target=self._read_forever, daemon=True)
+        self.reader_thread.start()
+
+    def open(self, container_name, on_output, on_close, rows=24, cols=80):
+        master_fd, slave_fd = os.openpty()
+        try:
+            self._set_window_size(master_fd, rows, cols)
+            process = subprocess.Popen(
+                self.attach_command(container_name),
+                stdin=slave_fd, stdout=slave_fd, stderr=slave_fd,
+                start_new_session=True,
+                env={'TERM': 'xterm-256color', 'PATH': os.environ.get('PATH', '/usr/bin:/bin')},
+            )
+        except Exception:
+            os.close(master_fd)
+            raise
+        finally:
+            os.close(slave_fd)
+
+        os.set_blocking(master_fd, False)
+        session = PtySession(container_name, process, master_fd, on_output, on_close)
+        with self.lock:
+            self.sessions.add(session)
+            self.selector.register(master_fd, selectors.EVENT_READ, session)
+        Thread(target=self._send_forever, args=(session,), daemon=True).start()
+        return session
+
+    def write(self, session, data):
+        if session.closed:
+            return
+        session.last_activity = time.monotonic()
+        view = memoryview(data)
+        while view:
+            try:
+                written = os.write(session.master_fd, view)
+            except BlockingIOError:
+                time.sleep(0.001)  # The shell isn't draining its input; wait for room in the pty buffer
+                continue
+            except OSError:
+                self.close(session)
+                return
+            view = view[written:]
+
+    def resize(self, session, rows, cols):
+        if session.closed:
+            return
+        self._set_window_size(session.master_fd, rows, cols)
+        # lxc-attach isn't the foreground process of our pty, so tell it directly
+        try:
+            session.process.send_signal(signal.SIGWINCH)
+        except OSError:
+            pass
+
+    def close(self, session):
+        with self.lock:
+            if session.closed:
+                return
+            session.closed = True
+            self.sessions.discard(session)
+            try:
+                self.selector.unregister(session.master_fd)
+            except (KeyError, ValueError):
+                pass
+        session.output.put(None)  # Stops the sender thread
+        os.close(session.master_fd)
+        if session.process.poll() is None:
+            try:
+                os.killpg(session.process.pid, signal.SIGHUP)
+            except OSError:
+                pass
+        Thread(target=session.process.wait, daemon=True).start()  # Reap without blocking the caller
+        try:
+            session.on_close()
+        except Exception as e:
+            logging.error(f"Error closing terminal for {session.container_name}: {str(e)}")
+
+    def containers_in_use(self):
+        with self.lock:
+            return {session.container_name for session in self.sessions}
+
+    def close_container(self, container_name):
+        """Close every session attached to a container, e.g. before it is destroyed."""
+        with self.lock:
+            sessions = [session for session in self.sessions if session.container_name == container_name]
+        for session in sessions:
+            self.close(session)
+
+    def _pause(self, session):
+        with self.lock:
+            if not session.closed and not session.paused:
+                self.selector.unregister(session.master_fd)
+                session.paused = True
+
+    def _resume(self, session):
+        with self.lock:
+            if not session.closed and session.paused and not session.exited:
+                self.selector.register(session.master_fd, selectors.EVENT_READ, session)
+                session.paused = False
+
+    def _send_forever(self, session):
+        """Hand a session's output to on_output in order, on this session's own thread."""
+        while True:
+            data = session.output.get()
+            if data is None or session.closed:
+                return
+            if not data:
+                self.close(session)  # The shell exited and everything it wrote has been sent
+                return
+            try:
+                session.on_output(data)
+            except Exception:
+                self.close(session)
+                return
+            session.last_activity = time.monotonic()
+            if session.paused and session.output.qsize() <= OUTPUT_QUEUE_SIZE // 2:
+                self._resume(session)
+
+    def _set_window_size(self, fd, rows, cols):
+        fcntl.ioctl(fd, termios.TIOCSWINSZ, struct.pack('HHHH', rows, cols, 0, 0))
+
+    def _reap_idle(self):
+        now = time.monotonic()
+        with self.lock:
+            idle = [session for session in self.sessions if now - session.last_activity > self.idle_timeout]
+        for session in idle:
+            logging.info(f"Closing idle terminal for {session.container_name}")
+            self.close(session)
+
+    def _read_forever(self):
+        last_reap = time.monotonic()
+        while True:
+            # epoll picks up sessions registered from other threads while we wait
+            events = self.selector.select(timeout=1)
+            for key, _ in events:
+                session = key.data
+                if session.closed:
+                    continue
+                try:
+                    data = os.read(session.master_fd, READ_SIZE)
+                except BlockingIOError:
+                    continue
+                except OSError:
+                    data = b''  # EIO once the shell exits
+                if not data:
+                    session.exited = True
+                    self._pause(session)  # Nothing more to read; the sender closes it once the rest is sent
+                    session.output.put(b'')
+                    continue
+                session.last_activity = time.monotonic()
+                session.output.put(data)
+                if session.output.qsize() >= OUTPUT_QUEUE_SIZE:
+                    self._pause(session)  # The shell blocks on its writes until the client catches up
+
+            if time.monotonic() - last_reap > 10:
+                self._reap_idle()
+                last_reap = time.monotonic()
@@ -0,0 +1,53 @@
+REBALANCE_TOLERANCE = 0.1  # Stop once the busiest and idlest nodes are within this share of RAM of each other
+MAX_TARGET_LOAD = 0.9  # Never plan a move that takes a node past this share of its RAM
+LOAD_EPSILON = 1e-9  # Float noise: a move has to lower the peak by more than this, or it only swaps the nodes
+
+
+def node_load(ram_capacity, ram_committed, health_report=None):
+    """Share of a node's RAM in use: the higher of what is promised to instances and what the host reports."""
+    loads = []
+    if ram_capacity:
+        loads.append(ram_committed / ram_capacity)
+    if health_report and health_report.get('ram_total'):
+        loads.append(1 - health_report['ram_free'] / health_report['ram_total'])
+    return max(loads) if loads else None
+
+
+def plan_moves(nodes, instances, max_moves=10, tolerance=REBALANCE_TOLERANCE):
+    """Propose instance moves from the busiest nodes to the idlest ones.
+
+    `nodes` is {node_id: (load, ram_capacity)} for nodes that may give or take instances;
+    `instances` is [(instance, node_id, ram_bytes)]. Each step moves the instance that best
+    evens out the current busiest and idlest node, and only if it lowers the higher of the
+    two. Returns [(instance, source_id, target_id)].
+    """
+    loads = {node_id: load for node_id, (load, capacity) in nodes.items() if load is not None and capacity}
+    capacities = {node_id: capacity for node_id, (_, capacity) in nodes.items()}
+    placed = [(instance, node_id, ram) for instance, node_id, ram in instances if node_id in loads and ram]
+    moves = []
+
+    while len(moves) < max_moves and len(loads) > 1:
+        source = max(loads, key=loads.get)
+        target = min(loads, key=loads.get)
+        if loads[source] - loads[target] <= tolerance:
+            break
+
+        best = None
+        for index, (instance, node_id, ram) in enumerate(placed):
+            if node_id != source:
+                continue
+            new_source = loads[source] - ram / capacities[source]
+            new_target = loads[target] + ram / capacities[target]
+            if new_target > MAX_TARGET_LOAD or max(new_source, new_target) >= loads[source] - LOAD_EPSILON:
+                continue
+            gap = abs(new_source - new_target)
+            if best is None or gap < best[0]:
+                best = (gap, index, new_source, new_target)
+        if best is None:
+            break
+
+        _, index, loads[source], loads[target] = best
+        instance, _, ram = placed[index]
+        placed[index] = (instance, target, ram)
+        moves.append((instance, source, target))
+    return moves
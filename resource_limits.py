@@ -0,0 +1,274 @@
+import ctypes
+import ctypes.util
+import fcntl
+import logging
+import os
+import struct
+import uuid
+
+from container_metrics import CGROUP_ROOT, cgroup_v2, find_cgroup
+from lxc_backend import rootfs_layers
+
+CPU_PERIOD_US = 100000  # CFS period the cpus quota is expressed in
+PROJECT_ID_BASE = 100000  # First project quota id handed to a container, above ids admins tend to use by hand
+
+# Every cgroup file this module manages, so limits dropped from a plan are removed from container configs too
+V2_FILES = ('memory.max', 'memory.swap.max', 'cpu.weight', 'cpu.max', 'cpuset.cpus', 'io.max', 'pids.max')
+V1_FILES = ('memory.limit_in_bytes', 'memory.memsw.limit_in_bytes', 'cpu.shares', 'cpu.cfs_period_us',
+            'cpu.cfs_quota_us', 'cpuset.cpus', 'blkio.throttle.read_bps_device', 'blkio.throttle.write_bps_device',
+            'blkio.throttle.read_iops_device', 'blkio.throttle.write_iops_device', 'pids.max')
+
+# Project quotas: struct fsxattr for FS_IOC_FS[GS]ETXATTR and struct if_dqblk for quotactl(Q_SETQUOTA)
+FS_IOC_FSGETXATTR = 0x801c581f
+FS_IOC_FSSETXATTR = 0x401c5820
+FS_XFLAG_PROJINHERIT = 0x200
+FSXATTR = struct.Struct('=IIIII8s')
+Q_SETQUOTA = 0x800008
+PRJQUOTA = 2
+QIF_BLIMITS = 1
+QUOTA_BLOCK_SIZE = 1024
+
+
+class IfDqblk(ctypes.Structure):
+    _fields_ = [('dqb_bhardlimit', ctypes.c_uint64), ('dqb_bsoftlimit', ctypes.c_uint64),
+                ('dqb_curspace', ctypes.c_uint64), ('dqb_ihardlimit', ctypes.c_uint64),
+                ('dqb_isoftlimit', ctypes.c_uint64), ('dqb_curinodes', ctypes.c_uint64),
+                ('dqb_btime', ctypes.c_uint64), ('dqb_itime', ctypes.c_uint64), ('dqb_valid', ctypes.c_uint32)]
+
+
+def shares_to_weight(shares):
+    """Map v1 cpu.shares (2-262144, 1024 default) onto v2 cpu.weight (1-10000, 100 default)."""
+    shares = min(max(shares, 2), 262144)
+    return 1 + (shares - 2) * 9999 // 262142
+
+
+def block_device(path):
+    """Return 'MAJ:MIN' of the disk holding `path` (the whole disk, not a partition), or None for virtual filesystems."""
+    dev = os.stat(path).st_dev
+    device = f'{os.major(dev)}:{os.minor(dev)}'
+    if os.major(dev) == 0:
+        return None  # tmpfs, overlayfs, btrfs subvolumes: no block device to throttle
+    sys_path = f'/sys/dev/block/{device}'
+    if os.path.exists(os.path.join(sys_path, 'partition')):
+        try:
+            with open(os.path.join(os.path.realpath(sys_path), '..', 'dev')) as f:
+                device = f.read().strip()
+        except OSError:
+            pass
+    return device
+
+
+def mount_source(path):
+    """Return the device mounted at the filesystem holding `path`, as quotactl() wants it."""
+    path = os.path.realpath(path)
+    best = (None, '')
+    with open('/proc/self/mountinfo') as f:
+        for line in f:
+            fields = line.split()
+            mount_point = fields[4].replace('\\040', ' ')
+            source = fields[fields.index('-') + 2]
+            if (path == mount_point or path.startswith(mount_point.rstrip('/') + '/')) and len(mount_point) >= len(best[1]):
+                best = (source, mount_point)
+    return best[0]
+
+
+def cgroup_settings(limits, unified, device=None, live=False):
+    """Translate plan limits into [(controller, file, value)] in the order they must be written.
+
+    For a container config (`live` False) unset limits are left out, since a new cgroup
+    starts unlimited. Live writes also reset unset limits, so a downgrade to a plan
+    without, say, a CPU quota lifts the old one.
+    """
+    ram = limits.get('ram_bytes')
+    swap = limits.get('swap_bytes')
+    cpus = limits.get('cpus')
+    shares = limits.get('cpu_shares')
+    cpuset = limits.get('cpuset')
+    pids = limits.get('pids')
+    io = {key: limits.get(key) for key in ('io_read_bps', 'io_write_bps', 'io_read_iops', 'io_write_iops')}
+    settings = []
+
+    if unified:
+        if ram or live:
+            settings.append(('memory', 'memory.max', ram or 'max'))
+        if swap is not None or live:
+            settings.append(('memory', 'memory.swap.max', 'max' if swap is None else swap))
+        if shares or live:
+            settings.append(('cpu', 'cpu.weight', shares_to_weight(shares) if shares else 100))
+        if cpus or live:
+            settings.append(('cpu', 'cpu.max', f'{int(cpus * CPU_PERIOD_US)} {CPU_PERIOD_US}' if cpus else 'max'))
+        if cpuset or live:
+            settings.append(('cpuset', 'cpuset.cpus', cpuset or ''))  # Empty inherits the parent's CPUs
+        if device and (any(io.values()) or live):
+            values = ' '.join(f'{key}={value or "max"}' for key, value in
+                              (('rbps', io['io_read_bps']), ('wbps', io['io_write_bps']),
+                               ('riops', io['io_read_iops']), ('wiops', io['io_write_iops'])))
+            settings.append(('io', 'io.max', f'{device} {values}'))
+        if pids or live:
+            settings.append(('pids', 'pids.max', pids or 'max'))
+        return settings
+
+    if ram or live:
+        settings.append(('memory', 'memory.limit_in_bytes', ram or -1))
+        if swap is not None or live:
+            # memsw covers RAM plus swap and may never be below the RAM limit
+            settings.append(('memory', 'memory.memsw.limit_in_bytes', ram + swap if ram and swap is not None else -1))
+    if shares or live:
+        settings.append(('cpu', 'cpu.shares', shares or 1024))
+    if cpus or live:
+        settings.append(('cpu', 'cpu.cfs_period_us', CPU_PERIOD_US))
+        settings.append(('cpu', 'cpu.cfs_quota_us', int(cpus * CPU_PERIOD_US) if cpus else -1))
+    if cpuset or live:
+        settings.append(('cpuset', 'cpuset.cpus', cpuset or ''))  # Empty is replaced by the parent's CPUs
+    if device:
+        for key, filename in (('io_read_bps', 'read_bps_device'), ('io_write_bps', 'write_bps_device'),
+                              ('io_read_iops', 'read_iops_device'), ('io_write_iops', 'write_iops_device')):
+            if io[key] or live:
+                settings.append(('blkio', f'blkio.throttle.{filename}', f'{device} {io[key] or 0}'))  # 0 removes the limit
+    if pids or live:
+        settings.append(('pids', 'pids.max', pids or 'max'))
+    return settings
+
+
+class ResourceLimiter:
+    """Applies plan limits to containers by writing files, without forking lxc-cgroup per key.
+
+    apply() rewrites the cgroup keys in the container's LXC config so they hold from the
+    next start, writes the same values into its live cgroup if it is running (a plan
+    change takes effect immediately), and sets a project quota on its rootfs for the
+    disk size. Works with cgroup v1 and v2; project quotas need an XFS or ext4
+    filesystem mounted with prjquota, otherwise disk limits are skipped with a warning.
+    """
+
+    def __init__(self, lxc_path):
+        self.lxc_path = lxc_path
+        self.unified = cgroup_v2()
+        try:
+            self.device = block_device(lxc_path)
+        except OSError:
+            self.device = None
+        self.libc = None
+
+    def apply(self, container_name, limits):
+        """Apply limits to a container. Returns a list of problems; raises OSError if the config can't be written."""
+        errors = []
+        self.write_config(container_name, cgroup_settings(limits, self.unified, self.device))
+        errors += self.write_cgroup(container_name, cgroup_settings(limits, self.unified, self.device, live=True))
+        if limits.get('disk_bytes') and limits.get('project_id'):
+            try:
+                self.set_disk_quota(container_name, limits['project_id'], limits['disk_bytes'])
+            except OSError as e:
+                errors.append(f'disk quota: {e.strerror or str(e)}')
+            except ValueError as e:
+                errors.append(f'disk quota: {str(e)}')
+        return errors
+
+    def write_config(self, container_name, settings):
+        prefix = 'lxc.cgroup2.' if self.unified else 'lxc.cgroup.'
+        managed = {key for files in (V2_FILES, V1_FILES) for key in
+                   [f'lxc.cgroup2.{filename}' for filename in files] + [f'lxc.cgroup.{filename}' for filename in files]}
+        config_path = os.path.join(self.lxc_path, container_name, 'config')
+        with open(config_path) as f:
+            lines = [line for line in f if line.partition('=')[0].strip() not in managed]
+        if lines and not lines[-1].endswith('\n'):
+            lines[-1] += '\n'
+        lines += [f'{prefix}{filename} = {value}\n' for _, filename, value in settings]
+        tmp_path = f'{config_path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.writelines(lines)
+        os.replace(tmp_path, config_path)
+
+    def _directory(self, controller, container_name):
+        if self.unified:
+            return find_cgroup(CGROUP_ROOT, container_name)
+        return find_cgroup(os.path.join(CGROUP_ROOT, controller), container_name)
+
+    def write_cgroup(self, container_name, settings):
+        """Write settings into a running container's cgroup. Returns the ones the kernel refused."""
+        if not self.unified:
+            settings = self._order_v1_memory(container_name, settings)
+        errors = []
+        for controller, filename, value in settings:
+            directory = self._directory(controller, container_name)
+            if directory is None:
+                continue  # Not running, or the controller isn't mounted; the config covers the next start
+            if filename == 'cpuset.cpus' and not value:
+                # v2 takes an empty list to mean the parent's CPUs; v1 needs them spelled out
+                value = '\n' if self.unified else self._parent_cpus(directory)
+                if value is None:
+                    continue
+            try:
+                with open(os.path.join(directory, filename), 'w') as f:
+                    f.write(str(value))
+            except FileNotFoundError:
+                continue  # e.g. memory.memsw.* without swapaccount=1, memory.swap.max without swap accounting
+            except OSError as e:
+                errors.append(f'{filename}: {e.strerror}')
+        if errors:
+            logging.warning(f"Some limits could not be applied to {container_name}: {', '.join(errors)}")
+        return errors
+
+    def _parent_cpus(self, directory):
+        try:
+            with open(os.path.join(os.path.dirname(directory), 'cpuset.cpus')) as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+
+    def _order_v1_memory(self, container_name, settings):
+        """v1 needs memsw >= limit at every step: raise memsw first when growing, the limit first when shrinking."""
+        directory = self._directory('memory', container_name)
+        names = [filename for _, filename, _ in settings]
+        if not directory or 'memory.memsw.limit_in_bytes' not in names:
+            return settings
+        try:
+            with open(os.path.join(directory, 'memory.limit_in_bytes')) as f:
+                current = int(f.read())
+        except (OSError, ValueError):
+            return settings
+        new = dict((filename, value) for _, filename, value in settings)['memory.limit_in_bytes']
+        if new == -1 or new > current:
+            memsw = settings[names.index('memory.memsw.limit_in_bytes')]
+            settings = [memsw] + [setting for setting in settings if setting is not memsw]
+        return settings
+
+    def set_disk_quota(self, container_name, project_id, disk_bytes):
+        """Tag every file the container writes to with its project id and cap the project's blocks.
+
+        That is the rootfs directory, or the upper layer of an overlay clone: files it
+        reads from the golden image are shared and not counted against it.
+        """
+        _, rootfs = rootfs_layers(self.lxc_path, container_name)
+        # Files created after tagging inherit the id, so a tagged rootfs only needs its limit changed.
+        # A restored or migrated rootfs arrives untagged and is walked once.
+        if not self._set_project(rootfs, project_id, inherit=True):
+            for directory, dirnames, filenames in os.walk(rootfs):
+                self._set_project(directory, project_id, inherit=True)
+                for filename in filenames:
+                    path = os.path.join(directory, filename)
+                    if os.path.isfile(path) and not os.path.islink(path):
+                        self._set_project(path, project_id, inherit=False)
+
+        if self.libc is None:
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        blocks = -(-disk_bytes // QUOTA_BLOCK_SIZE)
+        quota = IfDqblk(dqb_bhardlimit=blocks, dqb_bsoftlimit=blocks, dqb_valid=QIF_BLIMITS)
+        device = mount_source(rootfs)
+        command = ctypes.c_int(((Q_SETQUOTA << 8) | PRJQUOTA) - (1 << 32))  # QCMD() overflows into the sign bit
+        if self.libc.quotactl(command, (device or '').encode(), project_id, ctypes.byref(quota)) != 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    def _set_project(self, path, project_id, inherit):
+        """Give a file or directory the project id. Returns True if it already had it."""
+        fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK)
+        try:
+            xflags, extsize, nextents, current, cowextsize, pad = FSXATTR.unpack(
+                fcntl.ioctl(fd, FS_IOC_FSGETXATTR, bytes(FSXATTR.size)))
+            flags = xflags | FS_XFLAG_PROJINHERIT if inherit else xflags
+            if current == project_id and flags == xflags:
+                return True
+            fcntl.ioctl(fd, FS_IOC_FSSETXATTR, FSXATTR.pack(flags, extsize, nextents, project_id, cowextsize, pad))
+            return False
+        finally:
+            os.close(fd)
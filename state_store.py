@@ -0,0 +1,101 @@
+import logging
+import sqlite3
+import time
+from threading import Lock, Thread
+
+COLUMNS = ('name', 'state', 'ram_bytes', 'disk_bytes', 'distro', 'idle_policy', 'limits', 'updated_at')
+# Columns added after the table was first created, with their types
+ADDED_COLUMNS = {'idle_policy': 'TEXT', 'limits': 'TEXT'}
+
+
+class StateStore:
+    """Durable record of the containers a daemon manages, kept in a local SQLite file.
+
+    Writes are queued and flushed by a background thread every `flush_interval`
+    seconds in a single transaction, so bursts of state changes cost one fsync.
+    Only the latest pending write per container is kept.
+    """
+
+    def __init__(self, path, flush_interval=0.5):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.pending = {}  # name -> dict of fields to upsert, or None to delete
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS containers ('
+            'name TEXT PRIMARY KEY, state TEXT NOT NULL, ram_bytes INTEGER, disk_bytes INTEGER, '
+            'distro TEXT, updated_at REAL NOT NULL)')
+        existing = {row[1] for row in self.connection.execute('PRAGMA table_info(containers)')}
+        for column, column_type in ADDED_COLUMNS.items():
+            if column not in existing:
+                self.connection.execute(f'ALTER TABLE containers ADD COLUMN {column} {column_type}')
+        self.connection.commit()
+        self.connection_lock = Lock()
+
+    def load(self):
+        """Return {name: {column: value}} for every recorded container."""
+        with self.connection_lock:
+            rows = self.connection.execute(f'SELECT {", ".join(COLUMNS)} FROM containers').fetchall()
+        return {row[0]: dict(zip(COLUMNS, row)) for row in rows}
+
+    def get(self, name):
+        """Return one container's {column: value}, including writes not flushed yet, or None."""
+        with self.lock:
+            pending = self.pending.get(name, {})
+        if pending is None:
+            return None
+        with self.connection_lock:
+            row = self.connection.execute(f'SELECT {", ".join(COLUMNS)} FROM containers WHERE name = ?',
+                                          (name,)).fetchone()
+        if row is None and not pending:
+            return None
+        return dict(dict(zip(COLUMNS, row)) if row else {}, **pending)
+
+    def upsert(self, name, **fields):
+        with self.lock:
+            existing = self.pending.get(name) or {}
+            self.pending[name] = dict(existing, **fields, updated_at=time.time())
+
+    def delete(self, name):
+        with self.lock:
+            self.pending[name] = None
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+
+        deletes = [(name,) for name, fields in pending.items() if fields is None]
+        upserts = {name: fields for name, fields in pending.items() if fields is not None}
+        try:
+            with self.connection_lock, self.connection:
+                if deletes:
+                    self.connection.executemany('DELETE FROM containers WHERE name = ?', deletes)
+                for name, fields in upserts.items():
+                    columns = ['name'] + list(fields)
+                    updates = ', '.join(f'{column} = excluded.{column}' for column in fields)
+                    self.connection.execute(
+                        f'INSERT INTO containers ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))}) '
+                        f'ON CONFLICT(name) DO UPDATE SET {updates}',
+                        [name] + list(fields.values()))
+        except sqlite3.Error:
+            # Put the writes back unless newer ones were queued meanwhile, then retry next cycle
+            with self.lock:
+                for name, fields in pending.items():
+                    self.pending.setdefault(name, fields)
+            raise
+
+    def flush_forever(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                logging.error(f"Error writing container state to {self.path}: {str(e)}")
+
+    def start(self):
+        Thread(target=self.flush_forever, daemon=True).start()
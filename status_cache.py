@@ -0,0 +1,167 @@
+import json
+import time
+from collections import OrderedDict
+from threading import Event, Lock, Thread
+
+
+class MemoryBackend:
+    """Per-process LRU store of (state, fetched_at) keyed by (node ip, instance name)."""
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get_many(self, keys):
+        found = {}
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is not None:
+                    self.entries.move_to_end(key)
+                    found[key] = entry
+        return found
+
+    def set_many(self, entries, expire):
+        with self.lock:
+            for key, entry in entries.items():
+                self.entries[key] = entry
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+class RedisBackend:
+    """Shared store so every panel worker sees the same statuses. Needs the `redis` package."""
+
+    def __init__(self, url, prefix='lxcpanel:status:'):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def _key(self, key):
+        return f'{self.prefix}{key[0]}:{key[1]}'
+
+    def get_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+        values = self.client.mget([self._key(key) for key in keys])
+        return {key: tuple(json.loads(value)) for key, value in zip(keys, values) if value is not None}
+
+    def set_many(self, entries, expire):
+        pipeline = self.client.pipeline(transaction=False)
+        for key, entry in entries.items():
+            pipeline.set(self._key(key), json.dumps(entry), ex=int(expire) + 1)
+        pipeline.execute()
+
+    def delete(self, key):
+        self.client.delete(self._key(key))
+
+
+class StatusCache:
+    """Instance statuses with a TTL, stale-while-revalidate and request collapsing.
+
+    Entries younger than `ttl` are served as is. Entries up to `stale_ttl` old are
+    served immediately while one background refresh per node fetches new values.
+    Anything older or missing is fetched inline, and concurrent requests for the
+    same (node, instance) wait for a single fetch instead of each calling the daemon.
+
+    `fetch_many(ip_address, names)` must return {name: state} for the names it could
+    resolve. `spawn(func, *args)` starts a background task (socketio.start_background_task).
+    """
+
+    def __init__(self, fetch_many, backend=None, ttl=5, stale_ttl=60, wait_timeout=5, spawn=None):
+        self.fetch_many = fetch_many
+        self.backend = backend or MemoryBackend()
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.wait_timeout = wait_timeout
+        self.spawn = spawn or (lambda func, *args: Thread(target=func, args=args, daemon=True).start())
+        self.in_flight = {}  # key -> Event set when its fetch finishes
+        self.refreshing = set()  # Node IPs with a background refresh running
+        self.lock = Lock()
+
+    def set(self, ip_address, name, state):
+        self.backend.set_many({(ip_address, name): (state, time.time())}, self.stale_ttl)
+
+    def invalidate(self, ip_address, name):
+        self.backend.delete((ip_address, name))
+
+    def _fetch(self, ip_address, names):
+        """Fetch `names` from the node, store the results and wake anyone waiting on them."""
+        keys = [(ip_address, name) for name in names]
+        try:
+            results = self.fetch_many(ip_address, names)
+            now = time.time()
+            self.backend.set_many({(ip_address, name): (state, now) for name, state in results.items()},
+                                  self.stale_ttl)
+            return results
+        finally:
+            with self.lock:
+                for key in keys:
+                    event = self.in_flight.pop(key, None)
+                    if event:
+                        event.set()
+
+    def _refresh_in_background(self, ip_address, names):
+        try:
+            self._fetch(ip_address, names)
+        finally:
+            with self.lock:
+                self.refreshing.discard(ip_address)
+
+    def get_many(self, ip_address, names):
+        """Return {name: state} for instances on one node, using the cache wherever possible."""
+        now = time.time()
+        cached = self.backend.get_many([(ip_address, name) for name in names])
+        statuses = {}
+        stale = []
+        missing = []
+        for name in names:
+            entry = cached.get((ip_address, name))
+            age = now - entry[1] if entry else None
+            if entry and age <= self.stale_ttl:
+                statuses[name] = entry[0]
+                if age > self.ttl:
+                    stale.append(name)
+            else:
+                missing.append(name)
+
+        if stale:
+            with self.lock:
+                start_refresh = ip_address not in self.refreshing
+                if start_refresh:
+                    self.refreshing.add(ip_address)
+                    for name in stale:
+                        self.in_flight.setdefault((ip_address, name), Event())
+            if start_refresh:
+                self.spawn(self._refresh_in_background, ip_address, stale)
+
+        if missing:
+            # Collapse with fetches already running for the same keys, fetch the rest ourselves
+            to_fetch = []
+            waiting = []
+            with self.lock:
+                for name in missing:
+                    event = self.in_flight.get((ip_address, name))
+                    if event is None:
+                        self.in_flight[(ip_address, name)] = Event()
+                        to_fetch.append(name)
+                    else:
+                        waiting.append((name, event))
+            if to_fetch:
+                statuses.update(self._fetch(ip_address, to_fetch))
+            if waiting:
+                deadline = time.monotonic() + self.wait_timeout
+                for name, event in waiting:
+                    event.wait(max(deadline - time.monotonic(), 0))
+                found = self.backend.get_many([(ip_address, name) for name, _ in waiting])
+                for (_, name), (state, _) in found.items():
+                    statuses[name] = state
+
+        return statuses
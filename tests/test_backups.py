@@ -0,0 +1,140 @@
+import os
+import time
+from contextlib import contextmanager
+
+import pytest
+
+from backups import GC_GRACE, BackupEngine, LocalTarget
+
+
+@pytest.fixture
+def engine(tmp_path):
+    return BackupEngine(LocalTarget(str(tmp_path / 'target')))
+
+
+@pytest.fixture
+def rootfs(tmp_path):
+    path = tmp_path / 'rootfs'
+    (path / 'etc').mkdir(parents=True)
+    (path / 'etc' / 'hostname').write_text('c1\n')
+    (path / 'data').write_bytes(os.urandom(100000))
+    os.symlink('/etc/hostname', path / 'hostname')
+    return path
+
+
+def tree(path):
+    """{relative path: contents, link target or None for directories} for comparing trees."""
+    found = {}
+    for directory, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            full = os.path.join(directory, name)
+            relative = os.path.relpath(full, path)
+            if os.path.islink(full):
+                found[relative] = ('link', os.readlink(full))
+            elif os.path.isdir(full):
+                found[relative] = None
+            else:
+                with open(full, 'rb') as f:
+                    found[relative] = f.read()
+    return found
+
+
+def age_chunks(target, seconds):
+    for directory, _, filenames in os.walk(os.path.join(target.root, 'chunks')):
+        for filename in filenames:
+            then = time.time() - seconds
+            os.utime(os.path.join(directory, filename), (then, then))
+
+
+def test_backup_and_restore_round_trip(engine, rootfs, tmp_path):
+    os.chmod(rootfs / 'etc' / 'hostname', 0o600)
+    backup_id, stats = engine.backup('c1', str(rootfs))
+    assert stats['files'] == 2
+    assert stats['read_bytes'] == 100003
+
+    engine.restore('c1', backup_id, str(tmp_path / 'restored'))
+    assert tree(tmp_path / 'restored') == tree(rootfs)
+    assert os.stat(tmp_path / 'restored' / 'etc' / 'hostname').st_mode & 0o777 == 0o600
+    assert [backup['id'] for backup in engine.list('c1')] == [backup_id]
+
+
+def test_backup_reads_only_changed_files(engine, rootfs):
+    engine.backup('c1', str(rootfs))
+    (rootfs / 'etc' / 'hostname').write_text('renamed\n')
+    _, stats = engine.backup('c1', str(rootfs))
+    assert stats['read_bytes'] == len('renamed\n')
+    assert stats['files'] == 2
+
+
+def test_quiesced_pass_rereads_files_changed_during_the_first(engine, rootfs, tmp_path):
+    calls = []
+
+    @contextmanager
+    def quiesce():
+        calls.append('frozen')
+        yield
+
+    original_scan = engine._scan
+
+    def scan(root, previous, stats, progress=None, throttled=True):
+        entries = original_scan(root, previous, stats, progress, throttled)
+        if not calls:
+            # The container writes while the first pass runs
+            (rootfs / 'etc' / 'hostname').write_text('written meanwhile\n')
+            (rootfs / 'new').write_text('created meanwhile\n')
+        return entries
+
+    engine._scan = scan
+    backup_id, stats = engine.backup('c1', str(rootfs), quiesce=quiesce)
+    assert calls == ['frozen']
+    assert stats['read_bytes'] == 100003 + len('written meanwhile\n') + len('created meanwhile\n')
+
+    engine.restore('c1', backup_id, str(tmp_path / 'restored'))
+    assert (tmp_path / 'restored' / 'etc' / 'hostname').read_text() == 'written meanwhile\n'
+    assert (tmp_path / 'restored' / 'new').read_text() == 'created meanwhile\n'
+
+
+def test_restore_refuses_an_existing_directory(engine, rootfs):
+    backup_id, _ = engine.backup('c1', str(rootfs))
+    with pytest.raises(FileExistsError):
+        engine.restore('c1', backup_id, str(rootfs))
+
+
+def test_prune_keeps_last_and_weekly(engine):
+    ids = ['20240101T000000Z', '20240108T000000Z', '20240115T000000Z', '20240116T000000Z', '20240117T000000Z']
+    for backup_id in ids:
+        engine.target.put_manifest('c1', backup_id, {'created_at': 0, 'stats': {}, 'entries': []})
+
+    expired = engine.prune('c1', keep_last=2, keep_weekly=2)
+    # The last two, plus the newest of the two most recent weeks (the 17th and the 8th)
+    assert expired == ['20240101T000000Z', '20240115T000000Z']
+    assert engine.target.list_backups('c1') == ['20240108T000000Z', '20240116T000000Z', '20240117T000000Z']
+
+
+def test_collect_garbage_keeps_referenced_chunks(engine, rootfs, tmp_path):
+    engine.backup('c1', str(rootfs))
+    other = tmp_path / 'other'
+    other.mkdir()
+    (other / 'only-here').write_bytes(b'unshared')
+    engine.target.put_manifest('c2', '20240101T000000Z', {'created_at': 0, 'stats': {}, 'entries': []})
+    engine.backup('c2', str(other))  # Leaves the manual manifest first; the real one is newest
+    age_chunks(engine.target, GC_GRACE + 60)
+
+    # Nothing is unreferenced yet
+    assert engine.collect_garbage() == 0
+    for backup_id in engine.target.list_backups('c2'):
+        engine.target.delete_manifest('c2', backup_id)
+    assert engine.collect_garbage() == 1
+
+    backup_id = engine.target.list_backups('c1')[0]
+    engine.restore('c1', backup_id, str(tmp_path / 'restored'))
+    assert tree(tmp_path / 'restored') == tree(rootfs)
+
+
+def test_collect_garbage_spares_recent_chunks(engine, rootfs):
+    backup_id, _ = engine.backup('c1', str(rootfs))
+    engine.target.delete_manifest('c1', backup_id)
+    assert engine.collect_garbage() == 0  # A backup running elsewhere may be about to reference them
+    age_chunks(engine.target, GC_GRACE + 60)
+    assert engine.collect_garbage() == 2
+
@@ -0,0 +1,181 @@
+import io
+import os
+import stat
+import tarfile
+
+import pytest
+
+from container_transfer import IncomingTransfers, build_archive, extract_archive, file_sha256
+
+
+def write_archive(path, members):
+    """Write a tar.gz from [(name, type, data_or_link_target)]."""
+    with tarfile.open(path, 'w:gz') as archive:
+        for name, kind, value in members:
+            info = tarfile.TarInfo(name)
+            if kind == 'dir':
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                archive.addfile(info)
+            elif kind == 'symlink':
+                info.type = tarfile.SYMTYPE
+                info.linkname = value
+                archive.addfile(info)
+            elif kind == 'hardlink':
+                info.type = tarfile.LNKTYPE
+                info.linkname = value
+                archive.addfile(info)
+            else:
+                info.size = len(value)
+                archive.addfile(info, io.BytesIO(value))
+    return path
+
+
+@pytest.fixture
+def lxc_path(tmp_path):
+    path = tmp_path / 'lxc'
+    path.mkdir()
+    return path
+
+
+@pytest.fixture
+def outside(tmp_path):
+    path = tmp_path / 'outside'
+    path.mkdir()
+    return path
+
+
+def test_build_and_extract_round_trip(tmp_path, lxc_path):
+    container = tmp_path / 'source' / 'c1'
+    (container / 'rootfs' / 'etc').mkdir(parents=True)
+    (container / 'config').write_text('lxc.uts.name = c1\n')
+    (container / 'rootfs' / 'etc' / 'hostname').write_text('c1\n')
+    os.symlink('/etc/hostname', container / 'rootfs' / 'hostname')
+
+    sha256 = build_archive(str(container), str(tmp_path / 'c1.tar.gz'))
+    assert sha256 == file_sha256(str(tmp_path / 'c1.tar.gz'))
+    extract_archive(str(tmp_path / 'c1.tar.gz'), str(lxc_path), 'c1')
+
+    assert (lxc_path / 'c1' / 'config').read_text() == 'lxc.uts.name = c1\n'
+    assert (lxc_path / 'c1' / 'rootfs' / 'etc' / 'hostname').read_text() == 'c1\n'
+    assert os.readlink(lxc_path / 'c1' / 'rootfs' / 'hostname') == '/etc/hostname'
+
+
+@pytest.mark.parametrize('members', [
+    # A file written through a symlink the archive created a moment earlier
+    [('c1', 'dir', None), ('c1/rootfs', 'dir', None), ('c1/rootfs/x', 'symlink', '{outside}'),
+     ('c1/rootfs/x/passwd', 'file', b'owned')],
+    # The same through a relative link
+    [('c1', 'dir', None), ('c1/x', 'symlink', '../../outside'), ('c1/x/passwd', 'file', b'owned')],
+    # A directory member does not turn the symlink back into a directory
+    [('c1', 'dir', None), ('c1/x', 'symlink', '{outside}'), ('c1/x', 'dir', None), ('c1/x/passwd', 'file', b'owned')],
+    # A regular file over an earlier symlink would be written through it
+    [('c1', 'dir', None), ('c1/x', 'symlink', '{outside}/passwd'), ('c1/x', 'file', b'owned')],
+    # A hard link to a symlink links whatever it points to
+    [('c1', 'dir', None), ('c1/x', 'symlink', '{outside}/passwd'), ('c1/y', 'hardlink', 'c1/x')],
+    # A hard link to a file outside the container
+    [('c1', 'dir', None), ('c1/y', 'hardlink', 'c2/passwd')],
+    [('c1', 'dir', None), ('c1/../passwd', 'file', b'owned')],
+    [('/passwd', 'file', b'owned')],
+    # Another container's directory
+    [('c2/passwd', 'file', b'owned')],
+])
+def test_extract_refuses_members_outside_the_container(tmp_path, lxc_path, outside, members):
+    (outside / 'passwd').write_text('root:x:0:0\n')
+    members = [(name, kind, value.format(outside=outside) if isinstance(value, str) else value)
+               for name, kind, value in members]
+    archive = write_archive(str(tmp_path / 'evil.tar.gz'), members)
+
+    with pytest.raises(ValueError):
+        extract_archive(archive, str(lxc_path), 'c1')
+    assert os.listdir(outside) == ['passwd']
+    assert (outside / 'passwd').read_text() == 'root:x:0:0\n'
+    assert os.listdir(lxc_path) == []
+
+
+def test_extract_refuses_bad_or_existing_names(tmp_path, lxc_path):
+    archive = write_archive(str(tmp_path / 'c1.tar.gz'), [('c1', 'dir', None)])
+    with pytest.raises(ValueError):
+        extract_archive(archive, str(lxc_path), '../c1')
+    (lxc_path / 'c1').mkdir()
+    with pytest.raises(ValueError):
+        extract_archive(archive, str(lxc_path), 'c1')
+
+
+def test_incoming_transfer_resumes_and_verifies(tmp_path):
+    data = os.urandom(3000)
+    archive = tmp_path / 'c1.tar.gz'
+    archive.write_bytes(data)
+    transfers = IncomingTransfers(str(tmp_path / 'incoming'))
+    meta = {'name': 'c1', 'size': len(data), 'sha256': file_sha256(str(archive))}
+
+    assert transfers.create('abc123', meta) == 0
+    assert transfers.append('abc123', 0, io.BytesIO(data[:1000]), 1000) == 1000
+    # A retried chunk at the wrong offset is ignored and the sender told where to continue
+    assert transfers.append('abc123', 0, io.BytesIO(data[:1000]), 1000) == 1000
+    # A chunk cut short is dropped whole
+    assert transfers.append('abc123', 1000, io.BytesIO(data[1000:1500]), 1000) == 1000
+    assert not transfers.verify('abc123')
+
+    # Rejoining after a dropped connection keeps what arrived
+    assert transfers.create('abc123', meta) == 1000
+    assert transfers.append('abc123', 1000, io.BytesIO(data[1000:]), 2000) == 3000
+    assert transfers.verify('abc123')
+    assert (tmp_path / 'incoming' / 'abc123.part').read_bytes() == data
+
+    transfers.mark_complete('abc123')
+    assert transfers.meta('abc123')['completed']
+    assert transfers.offset('abc123') is None
+    transfers.discard('abc123')
+    assert transfers.meta('abc123') is None
+
+
+def test_incoming_transfer_detects_corruption(tmp_path):
+    transfers = IncomingTransfers(str(tmp_path / 'incoming'))
+    transfers.create('abc123', {'name': 'c1', 'size': 4, 'sha256': '0' * 64})
+    transfers.append('abc123', 0, io.BytesIO(b'data'), 4)
+    assert not transfers.verify('abc123')
+
+
+def test_incoming_transfer_rejects_path_ids(tmp_path):
+    transfers = IncomingTransfers(str(tmp_path / 'incoming'))
+    with pytest.raises(ValueError):
+        transfers.create('../abc', {})
+
+
+def test_build_archive_flattens_overlay_clones(tmp_path, lxc_path):
+    golden = tmp_path / 'source' / 'golden' / 'rootfs'
+    (golden / 'etc').mkdir(parents=True)
+    (golden / 'var' / 'cache').mkdir(parents=True)
+    (golden / 'etc' / 'hostname').write_text('golden\n')
+    (golden / 'etc' / 'os-release').write_text('ubuntu\n')
+    (golden / 'etc' / 'removed').write_text('gone in the clone\n')
+    (golden / 'var' / 'cache' / 'old').write_text('hidden by an opaque directory\n')
+
+    clone = tmp_path / 'source' / 'c1'
+    upper = clone / 'delta0'
+    (clone / 'rootfs').mkdir(parents=True)  # Only the mountpoint
+    (clone / 'olwork').mkdir()
+    (upper / 'etc').mkdir(parents=True)
+    (upper / 'var' / 'cache').mkdir(parents=True)
+    (upper / 'etc' / 'hostname').write_text('c1\n')
+    (upper / 'home').mkdir()
+    (upper / 'home' / 'notes').write_text('new in the clone\n')
+    (upper / 'var' / 'cache' / 'new').write_text('fresh\n')
+    (clone / 'config').write_text(f'lxc.rootfs.path = overlay:{golden}:{upper}\n')
+    try:
+        os.mknod(upper / 'etc' / 'removed', 0o600 | stat.S_IFCHR, 0)
+        os.setxattr(upper / 'var' / 'cache', 'user.overlay.opaque', b'y')
+    except (PermissionError, OSError):
+        pytest.skip('Needs root for whiteouts and user xattrs on the temp filesystem')
+
+    build_archive(str(clone), str(tmp_path / 'c1.tar.gz'), overlay=(str(golden), str(upper)))
+    extract_archive(str(tmp_path / 'c1.tar.gz'), str(lxc_path), 'c1')
+
+    rootfs = lxc_path / 'c1' / 'rootfs'
+    assert sorted(os.listdir(lxc_path / 'c1')) == ['config', 'rootfs']
+    assert (rootfs / 'etc' / 'hostname').read_text() == 'c1\n'
+    assert (rootfs / 'etc' / 'os-release').read_text() == 'ubuntu\n'
+    assert not (rootfs / 'etc' / 'removed').exists()
+    assert (rootfs / 'home' / 'notes').read_text() == 'new in the clone\n'
+    assert os.listdir(rootfs / 'var' / 'cache') == ['new']
@@ -0,0 +1,122 @@
+import os
+import tempfile
+
+import pytest
+
+# daemon.py reads its settings and opens its state on import, so point it somewhere disposable first
+os.environ.setdefault('DAEMON_STATE_DIR', tempfile.mkdtemp(prefix='daemon-test-'))
+os.environ.setdefault('LXC_BACKEND', 'fake')
+
+import daemon  # noqa: E402
+
+SECRET = 'test-secret'
+HEADERS = {'X-Node-Token': SECRET}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(daemon, 'NODE_SECRET', SECRET)
+    monkeypatch.setattr(daemon, 'NODE_PEERS', {'10.0.0.2'})
+    return daemon.app.test_client()
+
+
+def test_migrate_needs_the_node_secret(client):
+    response = client.post('/migrate', json={'name': 'c1', 'target': '10.0.0.2'})
+    assert response.status_code == 403
+    response = client.post('/migrate', json={'name': 'c1', 'target': '10.0.0.2'}, headers={'X-Node-Token': 'wrong'})
+    assert response.status_code == 403
+
+
+@pytest.mark.parametrize('path', ['/limits', '/batch/delete', '/backups/c1/20240101T000000Z/restore'])
+def test_panel_only_routes_need_the_node_secret(client, path):
+    assert client.post(path, json={'name': 'c1', 'names': ['c1']}).status_code == 403
+
+
+def test_migrate_only_sends_to_peers(client):
+    headers = HEADERS
+    response = client.post('/migrate', json={'name': 'c1', 'target': 'attacker.example'}, headers=headers)
+    assert response.status_code == 403
+    # A peer gets past the check and on to the container lookup
+    response = client.post('/migrate', json={'name': 'c1', 'target': '10.0.0.2'}, headers=headers)
+    assert response.status_code == 404
+
+
+def test_send_archive_refuses_unknown_targets(client, tmp_path):
+    with pytest.raises(RuntimeError):
+        daemon.send_archive({'name': 'c1', 'target': 'attacker.example'}, str(tmp_path / 'c1.tar.gz'))
+
+
+class HeldPool:
+    """Stands in for a ThreadPoolExecutor so queued jobs can be inspected instead of run."""
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, fn, *args):
+        self.submitted.append((fn, args))
+
+
+@pytest.fixture
+def container():
+    limits = {'ram_bytes': 512 * 1024 ** 2, 'disk_bytes': 4 * 1024 ** 3, 'cpu_cores': 1, 'project_id': 1001}
+    daemon.add_container('c1', 'STOPPED', distro='debian', idle_policy={'after': 300}, limits=limits)
+    yield 'c1'
+    daemon.busy_containers.pop('c1', None)
+    daemon.remove_container('c1')
+
+
+def test_migrate_takes_the_limits_currently_applied(client, container, monkeypatch):
+    monkeypatch.setattr(daemon, 'migration_pool', HeldPool())
+    daemon.container_limits[container] = dict(daemon.container_limits[container], ram_bytes=1024 ** 3)
+    response = client.post('/migrate', json={'name': container, 'target': '10.0.0.2'},
+                           headers=HEADERS)
+    assert response.status_code == 202
+    job = daemon.provisioning_jobs[response.get_json()['job_id']]
+    assert job['limits']['ram_bytes'] == job['ram_bytes'] == 1024 ** 3
+    assert job['disk_bytes'] == 4 * 1024 ** 3
+    assert job['distro'] == 'debian'
+    assert job['idle_policy']['after'] == 300
+
+
+def test_plan_change_replaces_the_idle_policy(client, container, monkeypatch):
+    monkeypatch.setattr(daemon, 'apply_limits', lambda name, limits: [])
+    limits = {'ram_bytes': 1024 ** 3, 'disk_bytes': 8 * 1024 ** 3, 'cpu_cores': 2}
+    response = client.post('/limits', json={'name': container, 'limits': limits, 'idle_policy': {'after': 7200}},
+                           headers=HEADERS)
+    assert response.status_code == 200
+    assert daemon.idle_freezer.policy(container)['after'] == 7200
+    assert daemon.state_store.get(container)['idle_policy'] == '{"after": 7200}'
+
+    # A plan without one stops the container being frozen
+    response = client.post('/limits', json={'name': container, 'limits': limits, 'idle_policy': None},
+                           headers=HEADERS)
+    assert response.status_code == 200
+    assert daemon.idle_freezer.policy(container) is None
+    assert daemon.state_store.get(container)['idle_policy'] is None
+
+    response = client.post('/limits', json={'name': container, 'limits': limits, 'idle_policy': 'never'},
+                           headers=HEADERS)
+    assert response.status_code == 400
+
+
+def test_backup_cycle_collects_garbage_once_after_its_backups(container, monkeypatch):
+    pool = HeldPool()
+    monkeypatch.setattr(daemon, 'backup_pool', pool)
+    sleeps = iter([None])
+    monkeypatch.setattr(daemon.time, 'sleep', lambda seconds: next(sleeps))
+    with pytest.raises(StopIteration):  # Out of sleeps after one cycle
+        daemon.backup_forever()
+    assert [fn for fn, args in pool.submitted] == [daemon.run_backup_job, daemon.collect_backup_garbage]
+
+
+@pytest.mark.parametrize('concurrency', ['abc', None, [2]])
+def test_batch_rejects_a_bad_concurrency(client, concurrency):
+    response = client.post('/batch/stop', json={'names': ['c1'], 'concurrency': concurrency}, headers=HEADERS)
+    assert response.status_code == 400
+
+
+def test_stop_refuses_busy_containers(client, container):
+    daemon.busy_containers[container] = 'being migrated'
+    response = client.post('/stop', json={'name': container})
+    assert response.status_code == 500
+    assert 'being migrated' in response.get_json()['message']
@@ -0,0 +1,25 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Flask
+
+from instrumentation import instrument_app, record, submit_traced
+
+
+def test_pool_workers_add_to_the_request_breakdown(caplog):
+    app = Flask(__name__)
+    instrument_app(app, slow_request_threshold=1e-9)
+
+    @app.route('/fan-out')
+    def fan_out():
+        record('db', 0.5)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [submit_traced(executor, record, 'daemon', 0.25) for _ in range(2)]
+            for future in futures:
+                future.result()
+        return 'ok'
+
+    with caplog.at_level(logging.WARNING):
+        assert app.test_client().get('/fan-out').status_code == 200
+    assert 'daemon 2x 0.500s' in caplog.text
+    assert 'db 1x 0.500s' in caplog.text
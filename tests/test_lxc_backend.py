@@ -0,0 +1,41 @@
+import pytest
+
+from lxc_backend import rootfs_layers, set_rootfs_setting
+
+
+def write_config(lxc_path, name, text):
+    (lxc_path / name).mkdir()
+    (lxc_path / name / 'config').write_text(text)
+
+
+@pytest.mark.parametrize('setting, expected', [
+    ('dir:/var/lib/lxc/c1/rootfs', (None, '/var/lib/lxc/c1/rootfs')),
+    ('/var/lib/lxc/c1/rootfs', (None, '/var/lib/lxc/c1/rootfs')),
+    ('btrfs:/var/lib/lxc/c1/rootfs', (None, '/var/lib/lxc/c1/rootfs')),
+    ('overlay:/var/lib/lxc/golden/rootfs:/var/lib/lxc/c1/delta0',
+     ('/var/lib/lxc/golden/rootfs', '/var/lib/lxc/c1/delta0')),
+    ('overlayfs:/var/lib/lxc/golden/rootfs:/var/lib/lxc/c1/delta0',
+     ('/var/lib/lxc/golden/rootfs', '/var/lib/lxc/c1/delta0')),
+])
+def test_rootfs_layers(tmp_path, setting, expected):
+    write_config(tmp_path, 'c1', f'lxc.uts.name = c1\nlxc.rootfs.path = {setting}\n')
+    assert rootfs_layers(str(tmp_path), 'c1') == expected
+
+
+def test_rootfs_layers_old_key_and_default(tmp_path):
+    write_config(tmp_path, 'old', 'lxc.rootfs = /srv/old/rootfs\n')
+    assert rootfs_layers(str(tmp_path), 'old') == (None, '/srv/old/rootfs')
+    write_config(tmp_path, 'bare', 'lxc.uts.name = bare\n')
+    assert rootfs_layers(str(tmp_path), 'bare') == (None, str(tmp_path / 'bare' / 'rootfs'))
+
+
+def test_rootfs_layers_refuses_block_devices(tmp_path):
+    write_config(tmp_path, 'c1', 'lxc.rootfs.path = lvm:/dev/lxc/c1\n')
+    with pytest.raises(ValueError):
+        rootfs_layers(str(tmp_path), 'c1')
+
+
+def test_set_rootfs_setting_replaces_either_key(tmp_path):
+    write_config(tmp_path, 'c1', 'lxc.rootfs = overlay:/a:/b\nlxc.uts.name = c1')
+    set_rootfs_setting(str(tmp_path), 'c1', 'dir:/var/lib/lxc/c1/rootfs')
+    assert (tmp_path / 'c1' / 'config').read_text() == 'lxc.uts.name = c1\nlxc.rootfs.path = dir:/var/lib/lxc/c1/rootfs\n'
@@ -0,0 +1,59 @@
+from datetime import datetime
+
+import pytest
+from flask import Flask
+from sqlalchemy import inspect, text
+from sqlalchemy.dialects import postgresql
+
+from billing import BILLING_PERIOD
+from migrations import upgrade_schema
+from models import db, Instance
+
+OLD_TABLES = [
+    'CREATE TABLE user (id INTEGER PRIMARY KEY, username VARCHAR(150), email VARCHAR(150), password VARCHAR(150))',
+    'CREATE TABLE node (id INTEGER PRIMARY KEY, name VARCHAR(150), ip_address VARCHAR(150), is_active BOOLEAN)',
+    'CREATE TABLE instance (id INTEGER PRIMARY KEY, name VARCHAR(150) NOT NULL, user_id INTEGER NOT NULL, '
+    'plan VARCHAR(50) NOT NULL, node_id INTEGER NOT NULL, status VARCHAR(20), creation_date DATETIME, '
+    'last_billed_date DATETIME, suspended BOOLEAN)',
+]
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{tmp_path / 'panel.db'}"
+    db.init_app(app)
+    with app.app_context():
+        yield app
+
+
+def test_upgrade_adds_columns_and_backfills(app):
+    with db.engine.begin() as connection:
+        for statement in OLD_TABLES:
+            connection.execute(text(statement))
+        connection.execute(text("INSERT INTO instance (id, name, user_id, plan, node_id, last_billed_date) "
+                                "VALUES (1, 'c1', 1, 'small', 1, '2024-01-01 00:00:00.000000')"))
+
+    upgrade_schema()
+    upgrade_schema()  # Safe to run again
+
+    instance = db.session.get(Instance, 1)
+    assert instance.next_billing_date == datetime(2024, 1, 1) + BILLING_PERIOD
+    assert instance.migrating is False  # Existing rows get the model's default
+    assert {'ram_capacity', 'disk_capacity'} <= {column['name'] for column in inspect(db.engine).get_columns('node')}
+
+
+def test_backfill_runs_when_create_all_added_the_column(app):
+    # A database copied from an old one: create_all() already made next_billing_date, but it is empty
+    db.create_all()
+    with db.engine.begin() as connection:
+        connection.execute(text("INSERT INTO instance (id, name, user_id, plan, node_id, last_billed_date) "
+                                "VALUES (1, 'c1', 1, 'small', 1, '2024-01-01 00:00:00.000000')"))
+    upgrade_schema()
+    assert db.session.get(Instance, 1).next_billing_date == datetime(2024, 1, 1) + BILLING_PERIOD
+
+
+def test_column_types_compile_for_other_databases():
+    columns = db.metadata.tables['instance'].c
+    assert columns['next_billing_date'].type.compile(dialect=postgresql.dialect()) == 'TIMESTAMP WITHOUT TIME ZONE'
+    assert db.metadata.tables['node'].c['ram_capacity'].type.compile(dialect=postgresql.dialect()) == 'BIGINT'
@@ -0,0 +1,32 @@
+import time
+
+import node_client
+from node_client import check_terminal_token, get_client, sign_terminal_token
+
+
+def test_terminal_token_is_bound_to_secret_instance_and_expiry():
+    token = sign_terminal_token('secret', 'c1')
+    assert check_terminal_token('secret', 'c1', token)
+    assert not check_terminal_token('other', 'c1', token)
+    assert not check_terminal_token('secret', 'c2', token)
+    assert not check_terminal_token('', 'c1', sign_terminal_token('', 'c1'))
+    assert not check_terminal_token('secret', 'c1', None)
+
+
+def test_terminal_token_expires():
+    expired = sign_terminal_token('secret', 'c1', expires_at=time.time() - 1)
+    assert not check_terminal_token('secret', 'c1', expired)
+    # The expiry is signed, so pushing it forward breaks the token
+    signature = expired.partition('.')[2]
+    assert not check_terminal_token('secret', 'c1', f'{int(time.time()) + 3600}.{signature}')
+
+
+def test_configured_secret_is_sent_to_daemons():
+    original = node_client.settings['node_secret']
+    try:
+        node_client.configure(node_secret='secret')
+        assert get_client('10.0.0.9').session.headers['X-Node-Token'] == 'secret'
+        node_client.configure(node_secret='')
+        assert 'X-Node-Token' not in get_client('10.0.0.9').session.headers
+    finally:
+        node_client.configure(node_secret=original)
@@ -0,0 +1,115 @@
+import os
+import tempfile
+
+import pytest
+
+# The panel reads its database URL at import time; keep it off the bundled instance/users.db
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='panel-test-'), 'panel.db'))
+
+import app as panel  # noqa: E402  (monkey-patches everything for eventlet)
+from models import db, User, UserCredits, Node, Instance  # noqa: E402
+
+
+class FakeResponse:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+class FakeDaemon:
+    """Records the calls the panel makes and answers each path with a canned response."""
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.calls = []
+
+    def post(self, path, **kwargs):
+        self.calls.append((path, kwargs.get('json')))
+        return FakeResponse(*self.responses[path])
+
+
+@pytest.fixture
+def client(monkeypatch):
+    with panel.app.app_context():
+        db.drop_all()
+        db.create_all()
+        user = User(username='alice', password='unused')
+        node = Node(name='node1', ip_address='10.0.0.1')
+        db.session.add_all([user, node])
+        db.session.commit()
+        db.session.add(UserCredits(user_id=user.id, balance=1000))
+        db.session.commit()
+        panel.placement.rebuild()
+        monkeypatch.setattr(panel.socketio, 'start_background_task', lambda *args: None)
+        client = panel.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(user.id)
+        yield client
+        panel.user_cache.invalidate(user.id)
+
+
+def daemon_answering(monkeypatch, responses):
+    daemon = FakeDaemon(responses)
+    monkeypatch.setattr(panel, 'get_client', lambda ip_address: daemon)
+    return daemon
+
+
+def balance():
+    return UserCredits.query.one().balance
+
+
+def add_instance(name, plan):
+    instance = Instance(name=name, user_id=User.query.one().id, plan=plan, node_id=Node.query.one().id)
+    db.session.add(instance)
+    db.session.commit()
+    panel.placement.rebuild()
+
+
+def test_plan_change_sends_the_new_idle_policy(client, monkeypatch):
+    daemon = daemon_answering(monkeypatch, {'/limits': (200, {'status': 'success', 'warnings': []})})
+    add_instance('c1', 'Basic')
+    client.post('/plan/c1', data={'plan': 'Pro'})
+    assert Instance.query.one().plan == 'Pro'
+    path, body = daemon.calls[0]
+    assert path == '/limits'
+    assert body['limits'] == panel.plan_catalog.get('Pro')['limits']
+    # Pro has no idle policy, so the daemon must be told to stop freezing the container
+    assert 'idle_policy' in body and body['idle_policy'] is None
+
+    daemon.calls.clear()
+    client.post('/plan/c1', data={'plan': 'Standard'})
+    assert daemon.calls[0][1]['idle_policy'] == panel.plan_catalog.get('Standard')['idle_policy']
+
+
+def committed_ram(node_id):
+    with panel.placement.lock:
+        return panel.placement._capacity(node_id).ram_committed
+
+
+@pytest.mark.parametrize('reply', [(500, {'status': 'error', 'message': 'lxc-create failed'}), None])
+def test_failed_create_refunds_and_records_nothing(client, monkeypatch, reply):
+    calls = []
+    if reply is None:
+        def unreachable(ip_address):
+            calls.append(ip_address)
+            raise ConnectionError('node down')
+        monkeypatch.setattr(panel, 'get_client', unreachable)
+    else:
+        calls = daemon_answering(monkeypatch, {'/create': reply}).calls
+    node_id = Node.query.one().id
+    before = committed_ram(node_id)
+    client.post('/create', data={'name': 'c1', 'plan': 'Basic'})
+    assert calls  # Placed, charged and sent to the node before it failed
+    assert Instance.query.count() == 0
+    assert balance() == 1000
+    assert committed_ram(node_id) == before
+
+
+def test_create_charges_and_records_the_instance(client, monkeypatch):
+    daemon_answering(monkeypatch, {'/create': (202, {'status': 'success', 'job_id': 'job1'})})
+    client.post('/create', data={'name': 'c1', 'plan': 'Basic'})
+    assert Instance.query.one().name == 'c1'
+    assert balance() == 1000 - panel.plan_catalog.get('Basic')['cost']
@@ -0,0 +1,51 @@
+import json
+import os
+
+import pytest
+
+from plan_catalog import PlanCatalog
+
+
+def write_plans(path, plans, mtime):
+    path.write_text(plans if isinstance(plans, str) else json.dumps(plans))
+    os.utime(path, (mtime, mtime))
+
+
+PLANS = [{'name': 'small', 'ram': '512MB', 'disk': '10GB', 'price': 5}]
+
+
+def test_reloads_when_the_file_changes(tmp_path):
+    path = tmp_path / 'plans.json'
+    write_plans(path, PLANS, 1000)
+    catalog = PlanCatalog(str(path), check_interval=0)
+    assert catalog.get('small')['ram_bytes'] == 512 * 1024 ** 2
+
+    write_plans(path, PLANS + [{'name': 'large', 'ram': '4GB', 'disk': '80GB', 'price': 20}], 2000)
+    assert [plan['name'] for plan in catalog.all()] == ['small', 'large']
+
+
+@pytest.mark.parametrize('broken', ['[{"name": "small",', json.dumps([{'name': 'small', 'ram': 'lots', 'disk': '1GB'}]),
+                                    json.dumps([{'name': 'small'}])])
+def test_keeps_the_last_good_plans_when_a_change_is_broken(tmp_path, caplog, broken):
+    path = tmp_path / 'plans.json'
+    write_plans(path, PLANS, 1000)
+    catalog = PlanCatalog(str(path), check_interval=0)
+    catalog.all()
+
+    write_plans(path, broken, 2000)
+    assert catalog.get('small')['ram_bytes'] == 512 * 1024 ** 2
+    assert 'still serving the previous plans' in caplog.text
+    with pytest.raises((ValueError, KeyError)):
+        catalog.reload()
+
+    write_plans(path, PLANS + [{'name': 'large', 'ram': '4GB', 'disk': '80GB', 'price': 20}], 3000)
+    assert catalog.get('large') is not None
+
+
+def test_keeps_the_last_good_plans_when_the_file_disappears(tmp_path):
+    path = tmp_path / 'plans.json'
+    write_plans(path, PLANS, 1000)
+    catalog = PlanCatalog(str(path), check_interval=0)
+    catalog.all()
+    path.unlink()
+    assert catalog.get('small') is not None
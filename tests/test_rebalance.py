@@ -0,0 +1,50 @@
+from rebalance import MAX_TARGET_LOAD, node_load, plan_moves
+
+GB = 1024 ** 3
+
+
+def test_node_load_takes_the_higher_of_committed_and_used():
+    assert node_load(16 * GB, 4 * GB) == 0.25
+    assert node_load(16 * GB, 4 * GB, {'ram_total': 16 * GB, 'ram_free': 4 * GB}) == 0.75
+    assert node_load(None, 0) is None
+
+
+def test_moves_from_the_busiest_to_the_idlest_node():
+    nodes = {1: (0.75, 16 * GB), 2: (0.25, 16 * GB)}
+    instances = [('a', 1, 4 * GB), ('b', 1, 4 * GB), ('c', 1, 4 * GB), ('d', 2, 4 * GB)]
+    moves = plan_moves(nodes, instances)
+    assert len(moves) == 1
+    assert moves[0][1:] == (1, 2)
+
+
+def test_picks_the_instance_that_evens_out_load_best():
+    nodes = {1: (0.8, 10 * GB), 2: (0.2, 10 * GB)}
+    instances = [('small', 1, 1 * GB), ('right', 1, 3 * GB), ('large', 1, 5 * GB)]
+    assert plan_moves(nodes, instances, max_moves=1) == [('right', 1, 2)]
+
+
+def test_stops_within_tolerance():
+    nodes = {1: (0.55, 16 * GB), 2: (0.5, 16 * GB)}
+    assert plan_moves(nodes, [('a', 1, 1 * GB)]) == []
+
+
+def test_never_overloads_the_target():
+    nodes = {1: (1.0, 8 * GB), 2: (0.5, 8 * GB)}
+    # Moving it would take node 2 to 1.0, past MAX_TARGET_LOAD
+    assert MAX_TARGET_LOAD < 1.0
+    assert plan_moves(nodes, [('big', 1, 4 * GB)]) == []
+
+
+def test_skips_moves_that_dont_lower_the_peak():
+    nodes = {1: (0.6, 10 * GB), 2: (0.2, 10 * GB)}
+    # Moving 6 GB would just swap which node is busiest
+    assert plan_moves(nodes, [('huge', 1, 6 * GB)]) == []
+
+
+def test_ignores_unknown_nodes_and_respects_max_moves():
+    nodes = {1: (0.9, 10 * GB), 2: (0.0, 10 * GB), 3: (None, 10 * GB)}
+    instances = [(name, 1, 1 * GB) for name in 'abcdefghi'] + [('elsewhere', 4, 1 * GB)]
+    moves = plan_moves(nodes, instances, max_moves=2)
+    assert len(moves) == 2
+    assert all(source == 1 and target == 2 for _, source, target in moves)
+    assert len(plan_moves(nodes, instances)) == 4  # 0.9/0.0 evens out to 0.5/0.4
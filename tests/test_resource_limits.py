@@ -0,0 +1,35 @@
+from resource_limits import ResourceLimiter, cgroup_settings
+
+
+def test_live_v1_settings_reset_cpuset():
+    settings = cgroup_settings({'ram_bytes': 1024 ** 3}, unified=False, live=True)
+    assert ('cpuset', 'cpuset.cpus', '') in settings
+    assert ('cpuset', 'cpuset.cpus', '') not in cgroup_settings({'ram_bytes': 1024 ** 3}, unified=False)
+    assert ('cpuset', 'cpuset.cpus', '0-1') in cgroup_settings({'cpuset': '0-1'}, unified=False)
+
+
+def test_v1_cpuset_reset_writes_the_parents_cpus(tmp_path, monkeypatch):
+    (tmp_path / 'cpuset.cpus').write_text('0-7\n')
+    container = tmp_path / 'c1'
+    container.mkdir()
+    (container / 'cpuset.cpus').write_text('0-1\n')
+    limiter = ResourceLimiter(str(tmp_path))
+    limiter.unified = False
+    monkeypatch.setattr(limiter, '_directory', lambda controller, name: str(container))
+
+    assert limiter.write_cgroup('c1', [('cpuset', 'cpuset.cpus', '')]) == []
+    assert (container / 'cpuset.cpus').read_text() == '0-7'
+
+
+def test_disk_quota_targets_the_overlay_upper_layer(tmp_path, monkeypatch):
+    (tmp_path / 'c1' / 'delta0').mkdir(parents=True)
+    (tmp_path / 'c1' / 'config').write_text(f"lxc.rootfs.path = overlay:/golden/rootfs:{tmp_path / 'c1' / 'delta0'}\n")
+    tagged = []
+    limiter = ResourceLimiter(str(tmp_path))
+    monkeypatch.setattr(limiter, '_set_project', lambda path, project_id, inherit: tagged.append(path) or True)
+    monkeypatch.setattr('resource_limits.mount_source', lambda path: None)
+    try:
+        limiter.set_disk_quota('c1', 100001, 1024 ** 3)
+    except OSError:
+        pass  # No project quotas on the test filesystem
+    assert tagged == [str(tmp_path / 'c1' / 'delta0')]
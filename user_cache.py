@@ -0,0 +1,53 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from flask_login import UserMixin
+
+
+class CachedUser(UserMixin):
+    """The fields requests read from current_user, detached from any database session."""
+
+    def __init__(self, id, username, is_admin):
+        self.id = id
+        self.username = username
+        self.is_admin = bool(is_admin)
+
+    def __repr__(self):
+        return f'<CachedUser {self.username}>'
+
+
+class UserCache:
+    """Per-process LRU of logged-in users so load_user doesn't query the database on every request.
+
+    Changes made by this process are invalidated explicitly; `ttl` bounds how long
+    another worker's change (an admin flag, a password) can go unnoticed here.
+    """
+
+    def __init__(self, load, ttl=60, max_size=10000):
+        self.load = load  # user_id -> CachedUser or None
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()  # user_id -> (CachedUser, loaded_at)
+        self.lock = Lock()
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry and now - entry[1] < self.ttl:
+                self.entries.move_to_end(user_id)
+                return entry[0]
+
+        user = self.load(user_id)
+        if user is not None:
+            with self.lock:
+                self.entries[user_id] = (user, now)
+                self.entries.move_to_end(user_id)
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+        return user
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.entries.pop(user_id, None)
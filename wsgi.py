@@ -0,0 +1,4 @@
+# Entry point for gunicorn (gunicorn -k eventlet ... wsgi:app): app itself starts no tasks on import
+from app import app, start_background_tasks
+
+start_background_tasks()